@@ -17,6 +17,10 @@ pulseaudio -D
 
 pacmd load-module module-null-sink sink_name=virtual sink_properties=device.description=virtual
 pacmd set-default-sink virtual
+# a sink per station, named after it unless the station sets its sink
+for sink in $(python3 -c "import yaml; print(' '.join(s.get('sink', s['name']) for s in (yaml.safe_load(open('/fm/conf/config.yaml')) or {}).get('stations') or []))" 2>/dev/null); do
+    pacmd load-module module-null-sink sink_name=$sink sink_properties=device.description=$sink
+done
 sed -i -r "s/changeme/$MORPH_OVUM_PASSWORD/g" /fm/src/default-config.yaml
 
-python3 main.py -c /fm/conf/config.yaml
+exec python3 main.py -c /fm/conf/config.yaml
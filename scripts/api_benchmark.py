@@ -0,0 +1,339 @@
+#####################################################################
+#
+#   Load test the REST API and the websocket notification server
+#
+#   Boots InputHandler against stub AudioPlayers built on a fake vlc
+#   module (no libvlc or audio needed), serves the generated /api/*
+#   resources with a threaded WSGI server, then:
+#   1. GETs the read endpoints from -c concurrent clients for -d seconds
+#   2. Connects -w websocket clients and publishes -m messages to them
+#   Reports p50/p99 latency and throughput as markdown tables.
+#   Exits 1 if a p99 is over --max-p99 milliseconds, for CI
+#
+#   python api_benchmark.py -c 16 -d 10 -w 200 -m 200
+#   python api_benchmark.py --max-p99 50
+#
+#####################################################################
+import os
+import sys
+import json
+import types
+import asyncio
+import logging
+import tempfile
+from threading import Thread, Event
+from time import perf_counter, time, sleep
+from optparse import OptionParser
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(0, '../src')
+import requests
+import websockets
+from flask import Flask
+from flask_restful import Api
+from werkzeug.serving import make_server
+
+parser = OptionParser()
+parser.add_option('-c', '--concurrency', dest='concurrency', type='int', default=16,
+                          help='concurrent HTTP clients', metavar='N')
+parser.add_option('-d', '--duration', dest='duration', type='float', default=10,
+                          help='seconds to drive each endpoint', metavar='SECONDS')
+parser.add_option('-e', '--endpoints', dest='endpoints',
+                          default='music/currenttrack,music/currentplaylist?limit=50,music/history,help',
+                          help='comma separated GET resources under /api/', metavar='ENDPOINTS')
+parser.add_option('--etag', dest='etag', action='store_true', default=False,
+                          help='send If-None-Match with the last ETag received')
+parser.add_option('-t', '--tracks', dest='tracks', type='int', default=10000,
+                          help='tracks in the stub music playlist', metavar='N')
+parser.add_option('-w', '--websockets', dest='websockets', type='int', default=200,
+                          help='concurrent websocket clients', metavar='N')
+parser.add_option('-m', '--messages', dest='messages', type='int', default=200,
+                          help='messages published to websocket clients', metavar='N')
+parser.add_option('-r', '--rate', dest='rate', type='float', default=100,
+                          help='websocket messages published per second', metavar='RATE')
+parser.add_option('-p', '--port', dest='port', type='int', default=18139,
+                          help='HTTP port, the websocket server uses port + 1', metavar='PORT')
+parser.add_option('--max-p99', dest='max_p99', type='float', default=0,
+                          help='exit 1 if a p99 is over MS milliseconds, 0 never', metavar='MS')
+(options, args) = parser.parse_args()
+
+
+#####################################################################
+#
+#   Fake vlc module, just enough of python-vlc for the read paths
+#
+#####################################################################
+vlc = types.ModuleType('vlc')
+
+class EventManager:
+    def event_attach(self, event_type, callback, *args, **kwargs):
+        pass
+
+class Media:
+    def __init__(self, mrl):
+        self.mrl = mrl if '://' in mrl else 'file://' + mrl
+    def get_mrl(self):
+        return self.mrl
+    def get_meta(self, meta):
+        return None
+    def get_duration(self):
+        return -1
+    def parse(self):
+        pass
+    def parse_with_options(self, flags, timeout):
+        return -1
+    def subitems(self):
+        return []
+    def event_manager(self):
+        return EventManager()
+    def release(self):
+        pass
+
+class MediaList(list):
+    def add_media(self, media):
+        self.append(media)
+    def insert_media(self, media, index):
+        self.insert(index, media)
+    def remove_index(self, index):
+        del self[index]
+    def index_of_item(self, media):
+        return self.index(media) if media in self else -1
+    def count(self):
+        return len(self)
+    def lock(self):
+        pass
+    def unlock(self):
+        pass
+
+class MediaPlayer:
+    def __init__(self):
+        self.media = None
+        self.volume = 100
+    def get_media(self):
+        return self.media
+    def set_media(self, media):
+        self.media = media
+    def is_playing(self):
+        return self.media is not None
+    def audio_get_volume(self):
+        return self.volume
+    def audio_set_volume(self, volume):
+        self.volume = volume
+    def event_manager(self):
+        return EventManager()
+
+class MediaListPlayer:
+    def __init__(self):
+        self.media_player = MediaPlayer()
+        self.media_list = MediaList()
+    def set_media_list(self, media_list):
+        self.media_list = media_list
+    def get_media_player(self):
+        return self.media_player
+    def play_item_at_index(self, index):
+        self.media_player.media = self.media_list[index]
+    def is_playing(self):
+        return self.media_player.is_playing()
+
+class Instance:
+    def __init__(self, *args):
+        pass
+    def media_new(self, mrl):
+        return Media(mrl)
+    def media_list_new(self):
+        return MediaList()
+    def media_list_player_new(self):
+        return MediaListPlayer()
+    def media_player_new(self):
+        return MediaPlayer()
+
+class Enum:
+    '''Any attribute is a distinct value, e.g. vlc.EventType.MediaPlayerPlaying'''
+    def __getattr__(self, name):
+        return name
+
+for cls in [EventManager, Media, MediaList, MediaPlayer, MediaListPlayer, Instance]:
+    setattr(vlc, cls.__name__, cls)
+for enum in ['EventType', 'State', 'Meta', 'MediaParseFlag']:
+    setattr(vlc, enum, Enum())
+sys.modules['vlc'] = vlc
+
+import player_backend
+import io_functions
+import flask_resources
+from media_library import MediaLibrary
+from play_history import PlayHistory
+
+
+#####################################################################
+#
+#   Stub AudioPlayers: real Playlists, history and websocket server
+#
+#####################################################################
+class StubAudioPlayers:
+    player_state = player_backend.AudioPlayers.player_state
+    notify_clients = player_backend.AudioPlayers.notify_clients
+    notification_snapshot = player_backend.AudioPlayers.notification_snapshot
+
+    def __init__(self, tracks, websocket_port):
+        index_dir = tempfile.mkdtemp()
+        self.config_data = {
+            'audio_dirs'    :{'music':index_dir, 'ambience':index_dir, 'clips':index_dir},
+            'playlist_dir'  :index_dir,
+            'busy_wait'     :0,
+            'job_workers'   :2
+        }
+        self.i = vlc.Instance()
+        self.library = MediaLibrary(os.path.join(index_dir, 'benchmark.sqlite3'))
+        self.tags = None
+        self.mp_music = self.i.media_list_player_new()
+        self.mp_ambience = self.i.media_list_player_new()
+        self.pl_music = player_backend.Playlist(self.i, self.mp_music, self.library)
+        self.pl_ambience = player_backend.Playlist(self.i, self.mp_ambience, self.library)
+        self.pl_music.extend(self.library.track_ids(['/benchmark/music/%07d.mp3' % i for i in range(tracks)]))
+        self.pl_ambience.extend(self.library.track_ids(['/benchmark/ambience/%03d.ogg' % i for i in range(10)]))
+        self.pl_music.play(0)
+        self.pl_ambience.play(0)
+        self.music_playing = True
+        self.ambience_playing = True
+        self.history = PlayHistory(['music', 'ambience'])
+        for i in range(100):
+            self.history.append('music', i, '%07d.mp3' % i)
+        for i in range(10):
+            self.history.append('ambience', i, '%03d.ogg' % i)
+
+        self.stream_relay = None
+        self.notification_server = player_backend.NotificationWebsocketsServer(
+            {
+                'interface'     :'127.0.0.1',
+                'port'          :websocket_port,
+                'max_clients'   :options.websockets + 1,
+                'queue_depth'   :options.messages + 1,
+                'ping_interval' :20,
+                'ping_timeout'  :20,
+                'slow_clients'  :'drop'
+            },
+            snapshot=self.notification_snapshot
+        )
+
+
+def percentiles(latencies):
+    '''Returns the p50 and p99 of a list of seconds, in milliseconds'''
+    if not latencies:
+        return float('nan'), float('nan')
+    latencies = sorted(latencies)
+    return (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    )
+
+def http_client(url, stop, latencies, errors):
+    session = requests.Session()
+    etag = None
+    while not stop.is_set():
+        headers = {'If-None-Match':etag} if options.etag and etag else {}
+        start = perf_counter()
+        try:
+            response = session.get(url, headers=headers)
+            latencies.append(perf_counter() - start)
+            if response.status_code not in [200, 304]:
+                errors.append(response.status_code)
+            etag = response.headers.get('ETag', etag)
+        except requests.RequestException as exc:
+            errors.append(exc)
+
+def http_benchmark(endpoint):
+    '''Returns latencies and errors of -c clients GETting an endpoint for -d seconds'''
+    stop = Event()
+    latencies, errors = [], []
+    threads = [
+        Thread(target=http_client, args=('http://127.0.0.1:%d/api/%s' % (options.port, endpoint), stop, latencies, errors))
+        for _ in range(options.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    sleep(options.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+async def websocket_benchmark(players):
+    '''Returns the connect (to snapshot) latencies, delivery latencies,
+    messages received and seconds taken for the websocket clients'''
+    connect_latencies, delivery_latencies = [], []
+    received = [0]
+
+    async def client(ready):
+        start = perf_counter()
+        async with websockets.connect('ws://127.0.0.1:%d' % (options.port + 1), max_size=None) as websocket:
+            await websocket.recv()
+            connect_latencies.append(perf_counter() - start)
+            ready.set()
+            for _ in range(options.messages):
+                message = json.loads(await websocket.recv())
+                delivery_latencies.append(time() - message['sent'])
+                received[0] += 1
+
+    ready_events = [asyncio.Event() for _ in range(options.websockets)]
+    clients = [asyncio.create_task(client(ready)) for ready in ready_events]
+    for ready in ready_events:
+        await ready.wait()
+
+    def publish():
+        for i in range(options.messages):
+            players.notification_server.publish({'event':'benchmark', 'i':i, 'sent':time()})
+            sleep(1 / options.rate)
+
+    start = perf_counter()
+    publisher = Thread(target=publish)
+    publisher.start()
+    await asyncio.gather(*clients)
+    publisher.join()
+    return connect_latencies, delivery_latencies, received[0], perf_counter() - start
+
+
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+player_backend.Debug = False
+players = StubAudioPlayers(options.tracks, options.port + 1)
+ih = io_functions.InputHandler(players)
+
+app = Flask(__name__)
+api = Api(app)
+app.secret_key = 'benchmark'
+flask_resources.limiter.init_app(app)
+flask_resources.bind_flask_resources(api, ih)
+server = make_server('127.0.0.1', options.port, app, threaded=True)
+Thread(target=server.serve_forever, daemon=True).start()
+
+print(f'REST API: {options.concurrency} clients, {options.duration}s per endpoint, ETags {"on" if options.etag else "off"}\n')
+print('| Endpoint | Requests | Errors | Requests/s | p50 (ms) | p99 (ms) |')
+print('| ------ | ------ | ------ | ------ | ------ | ------ |')
+p99s = {}
+for endpoint in options.endpoints.split(','):
+    latencies, errors = http_benchmark(endpoint)
+    p50, p99 = percentiles(latencies)
+    p99s[endpoint] = p99
+    print(f'| {endpoint} | {len(latencies)} | {len(errors)} | {len(latencies) / options.duration:.0f} | {p50:.2f} | {p99:.2f} |')
+
+sleep(0.5)  # let the websocket server start
+connect_latencies, delivery_latencies, received, seconds = asyncio.run(websocket_benchmark(players))
+connect_p50, connect_p99 = percentiles(connect_latencies)
+delivery_p50, delivery_p99 = percentiles(delivery_latencies)
+p99s['websocket connect to snapshot'] = connect_p99
+p99s['websocket message delivery'] = delivery_p99
+print(f'\nWebsockets: {options.websockets} clients, {options.messages} messages at {options.rate:g}/s\n')
+print('| Measure | Count | Per second | p50 (ms) | p99 (ms) |')
+print('| ------ | ------ | ------ | ------ | ------ |')
+print(f'| connect to snapshot | {len(connect_latencies)} | | {connect_p50:.2f} | {connect_p99:.2f} |')
+print(f'| message delivery | {received} | {received / seconds:.0f} | {delivery_p50:.2f} | {delivery_p99:.2f} |')
+print(f'\nServer stats: {players.notification_server.stats}')
+
+server.shutdown()
+players.library.close()
+
+if options.max_p99:
+    over = {measure:p99 for measure, p99 in p99s.items() if not p99 <= options.max_p99}   # nan: none measured
+    for measure, p99 in over.items():
+        print(f'Error: {measure} p99 {p99:.2f} ms is over {options.max_p99:g} ms', file=sys.stderr)
+    if over:
+        sys.exit(1)
@@ -5,12 +5,11 @@
 #####################################################################
 import sys
 import json
-from inspect import getfullargspec
 # insert at 1, 0 is the script path (or '' in REPL)
 sys.path.insert(0, '../src')
 import io_functions
 
-api_flags = ['admin', 'busy', 'patience']
+api_flags = ['admin', 'background', 'busy', 'patience']
 
 api_list = []
 readme_table_post = '**POST requests**\n\n'
@@ -28,12 +27,16 @@ for attr_name in dir(io_functions.InputHandler):
             'resource'      :attr_name.replace('_', '/'),
             'description'   :attr.__doc__
         }
-        is_post = len(getfullargspec(attr)[0]) > 1
+        is_post = len(io_functions.api_args(attr)) > 0
 
-        readme_tmp = '| `' + attr_name.replace('_', '/') + '` '
+        readme_tmp = '| `' + attr_name.replace('_', '/')
+        if hasattr(attr, 'query_args'):
+            readme_tmp += '?' + '&'.join(attr.query_args)
+            method_data_for_json['query_args'] = list(attr.query_args)
+        readme_tmp += '` '
 
-        if len(getfullargspec(attr)[0]) > 1:
-            method_arg = getfullargspec(attr)[0][1]
+        if is_post:
+            method_arg = io_functions.api_args(attr)[0]
             readme_tmp += '| `' + method_arg + '` |'
             method_data_for_json['argument'] = method_arg
         else:
@@ -0,0 +1,79 @@
+#####################################################################
+#
+#   Benchmark clearing, shuffling and appending to playlists
+#
+#   Compares editing a vlc.MediaList in place (the old approach)
+#   against the Playlist class, which rebuilds a vlc.MediaList once
+#   per change, and against a Playlist window (virtual queue).
+#   Requires libvlc.
+#
+#   python playlist_benchmark.py -s 1000,10000,100000
+#
+#####################################################################
+import os
+import sys
+import tempfile
+from time import perf_counter
+from random import shuffle
+from optparse import OptionParser
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(0, '../src')
+import vlc
+import player_backend
+from media_library import MediaLibrary
+
+parser = OptionParser()
+parser.add_option('-s', '--sizes', dest='sizes', default='1000,10000,100000',
+                          help='comma separated playlist sizes', metavar='SIZES')
+(options, args) = parser.parse_args()
+sizes = [int(size) for size in options.sizes.split(',')]
+
+
+def timed(func, *args):
+    start = perf_counter()
+    func(*args)
+    return perf_counter() - start
+
+def legacy_clear(media_list):
+    while media_list.count() > 0:
+        media_list.remove_index(0)
+
+def legacy_shuffle(media_list):
+    list_of_media = [media_list[i] for i in range(media_list.count())]
+    shuffle(list_of_media)
+    legacy_clear(media_list)
+    for media in list_of_media:
+        media_list.add_media(media)
+
+def legacy_append(media_list, paths):
+    for path in paths:
+        media_list.add_media(vlc.Media(path))
+
+def playlist_clear(playlist):
+    playlist.order = playlist.order[:0]
+    playlist.materialise()
+
+
+instance = vlc.Instance('--quiet --no-video')
+index_dir = tempfile.mkdtemp()
+library = MediaLibrary(os.path.join(index_dir, 'benchmark.sqlite3'))
+
+print('| Items | Operation | MediaList in place (s) | Playlist (s) | Playlist window (s) |')
+print('| ------ | ------ | ------ | ------ | ------ |')
+for size in sizes:
+    paths = ['/benchmark/%07d.mp3' % i for i in range(size)]
+    track_ids = library.track_ids(paths)
+
+    media_list = instance.media_list_new()
+    playlist = player_backend.Playlist(instance, instance.media_list_player_new(), library, window=0)
+    window = player_backend.Playlist(instance, instance.media_list_player_new(), library, window=50)
+
+    results = [
+        ('append', timed(legacy_append, media_list, paths), timed(playlist.extend, track_ids), timed(window.extend, track_ids)),
+        ('shuffle', timed(legacy_shuffle, media_list), timed(playlist.shuffle), timed(window.shuffle)),
+        ('clear', timed(legacy_clear, media_list), timed(playlist_clear, playlist), timed(playlist_clear, window)),
+    ]
+    for operation, legacy_time, playlist_time, window_time in results:
+        print(f'| {size} | {operation} | {legacy_time:.3f} | {playlist_time:.3f} | {window_time:.3f} |')
+
+library.close()
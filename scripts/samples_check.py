@@ -0,0 +1,56 @@
+#####################################################################
+#
+#   Check the shipped samples are indexed and played
+#
+#   Indexes ../samples into a temporary MediaLibrary and checks:
+#   1. Every file of samples/music, ambience and clips (where present) is indexed
+#   2. A ClipPool of samples/clips chooses each clip before repeating
+#   Exits non-zero if any check fails.
+#
+#   python samples_check.py
+#
+#####################################################################
+import os
+import sys
+import tempfile
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(0, '../src')
+from media_library import MediaLibrary
+from clip_pool import ClipPool
+
+samples_dir = os.path.abspath('../samples')
+
+
+def check(name, got, expected):
+    ok = got == expected
+    print(f'| {name} | {expected} | {got} | {"ok" if ok else "FAIL"} |')
+    return ok
+
+
+index_dir = tempfile.mkdtemp()
+library = MediaLibrary(os.path.join(index_dir, 'samples.sqlite3'))
+results = []
+
+print('| Check | Expected | Got | |')
+print('| ------ | ------ | ------ | ------ |')
+
+# 1. every sample is indexed
+for player in ['music', 'ambience', 'clips']:
+    directory = os.path.join(samples_dir, player)
+    if not os.path.isdir(directory):
+        continue
+    library.refresh(directory)
+    files = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    indexed = sorted(library.paths(library.audio_file_ids(directory)).values())
+    results.append(check(player + ' indexed', indexed, files))
+
+# 2. the clips are each chosen once before any repeats
+clips_dir = os.path.join(samples_dir, 'clips')
+pool = ClipPool(library, None, clips_dir)
+clips = os.listdir(clips_dir)
+chosen = [pool.choose() for clip in clips]
+results.append(check('clips chosen', sorted(os.path.basename(choice[1]) for choice in chosen if choice), sorted(clips)))
+
+library.close()
+print(f'\n{sum(results)}/{len(results)} checks passed')
+sys.exit(0 if all(results) else 1)
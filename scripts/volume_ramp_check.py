@@ -0,0 +1,120 @@
+#####################################################################
+#
+#   Check VolumeScheduler ramps against a fake clock
+#
+#   Ticks the scheduler at -r ticks per second of fake time, without
+#   sleeping, and compares the volumes set with the ramp expected:
+#   1. A linear and a log fade reach their targets on time
+#   2. A fade replacing a running one starts where that one had got to
+#   3. A cancelled ramp stops where it is and sets its Event
+#   Exits non-zero if any volume is more than 1 off.
+#
+#   python volume_ramp_check.py -r 50
+#
+#####################################################################
+import sys
+import math
+from optparse import OptionParser
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(0, '../src')
+from volume_scheduler import VolumeScheduler
+
+parser = OptionParser()
+parser.add_option('-r', '--tick-rate', dest='tick_rate', type='int', default=50,
+                          help='ticks per second of fake time', metavar='RATE')
+(options, args) = parser.parse_args()
+
+
+class FakeClock:
+    '''Time advanced in whole ticks, so it does not drift from sums of 1 / tick_rate'''
+    def __init__(self):
+        self.ticks = 0
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+    def tick(self):
+        self.ticks += 1
+        self.now = 1000.0 + self.ticks / options.tick_rate
+
+class FakePlayer:
+    '''Records every volume set, with the fake time it was set at'''
+    def __init__(self, clock, volume):
+        self.clock = clock
+        self.volume = volume
+        self.sets = []
+    def audio_get_volume(self):
+        return self.volume
+    def audio_set_volume(self, volume):
+        self.volume = volume
+        self.sets.append((self.clock.now, volume))
+
+def run(scheduler, clock, seconds):
+    '''Ticks the scheduler for seconds of fake time'''
+    for _ in range(int(round(seconds * options.tick_rate))):
+        clock.tick()
+        scheduler.tick()
+
+def check(name, got, expected):
+    '''Volumes may be 1 off from rounding, anything else must be equal'''
+    if type(expected) == float:
+        ok = abs(got - expected) <= 1
+        expected = f'{expected:.1f}'
+    else:
+        ok = got == expected
+    print(f'| {name} | {expected} | {got} | {"ok" if ok else "FAIL"} |')
+    return ok
+
+def elapsed(start):
+    return clock.now - start
+
+
+clock = FakeClock()
+scheduler = VolumeScheduler(tick_rate=options.tick_rate, clock=clock)
+music, ambience = FakePlayer(clock, 100), FakePlayer(clock, 80)
+scheduler.register('music', music)
+scheduler.register('ambience', ambience)
+results = []
+
+print('| Check | Expected | Got | |')
+print('| ------ | ------ | ------ | ------ |')
+
+# 1. linear 100 -> 0 and log 80 -> 20 over 2 seconds
+start = clock.now
+music_done = scheduler.fade('music', 0, duration=2)
+ambience_done = scheduler.fade('ambience', 20, duration=2, curve='log')
+for _ in range(3):
+    run(scheduler, clock, 0.5)
+    seconds = elapsed(start)
+    results.append(check(f'linear at {seconds:.2f}s', music.volume, 100 * (1 - seconds / 2)))
+    results.append(check(f'log at {seconds:.2f}s', ambience.volume, 80 - 60 * math.log10(1 + 9 * seconds / 2)))
+run(scheduler, clock, 2 - elapsed(start))
+results.append(check('linear at 2s', music.volume, 0.0))
+results.append(check('log at 2s', ambience.volume, 20.0))
+results.append(check('linear done on the first tick >= 2s', music_done.is_set(), elapsed(start) >= 2))
+results.append(check('last set on that tick', music.sets[-1][0] == clock.now, True))
+
+# 2. fade up to 100 over 2s, replaced after 1s by a fade to 0 over 1s
+start = clock.now
+first = scheduler.fade('music', 100, duration=2)
+run(scheduler, clock, 1)
+reached = 100 * elapsed(start) / 2
+start = clock.now
+second = scheduler.fade('music', 0, duration=1)
+results.append(check('replaced ramp ended', first.is_set(), True))
+run(scheduler, clock, 0.5)
+results.append(check('replacing starts from where it was', music.volume, reached * (1 - elapsed(start))))
+run(scheduler, clock, 1)
+results.append(check('replacing at target', music.volume, 0.0))
+
+# 3. cancel half way
+start = clock.now
+done = scheduler.fade('ambience', 100, duration=2)
+run(scheduler, clock, 1)
+stopped_at = 20 + 80 * elapsed(start) / 2
+scheduler.cancel('ambience')
+run(scheduler, clock, 1)
+results.append(check('cancelled ramp stays', ambience.volume, stopped_at))
+results.append(check('cancelled ramp done', done.is_set(), True))
+
+print(f'\n{sum(results)}/{len(results)} checks passed, {len(music.sets)} music volumes set')
+sys.exit(0 if all(results) else 1)
@@ -0,0 +1,102 @@
+######################################################################
+#
+#   Clip Pool
+#
+#   1. Defines ClipPool class
+#       The clips of the clips directory, indexed by the MediaLibrary
+#       Split into pools (subdirectories) with weights and hours of the day
+#       Each pool hands out its clips from a shuffle-bag
+#
+######################################################################
+import os
+import datetime
+from threading import Lock
+from random import choices, randrange, shuffle
+
+
+######################################################################
+#
+#   1. Defines ClipPool class
+#
+######################################################################
+class ClipPool:
+    '''Chooses clips from pools of the clips directory.
+    pools are dicts of directory (relative to clips_dir), weight and hours
+    ([start, end), wrapping past midnight if start > end). No pools means
+    the whole clips directory, at any hour.
+    A pool plays all of its clips, in a shuffled order, before any repeats,
+    and a new order never starts with the clip just played.
+    Clips are indexed once and again after invalidate() (library changes),
+    and their tags and durations are parsed in the background. Clips are not
+    left out for a missing duration, a parse may just have timed out; a clip
+    that cannot play ends on its player's EncounteredError'''
+    def __init__(self, library, tags, clips_dir, pools=None):
+        self.library = library
+        self.tags = tags
+        self.clips_dir = os.path.abspath(clips_dir)
+        self.pools = [
+            {
+                'directory' :os.path.abspath(os.path.join(self.clips_dir, pool.get('directory', '.'))),
+                'weight'    :pool.get('weight', 1),
+                'hours'     :pool.get('hours', [0, 24])
+            }
+            for pool in (pools or [{}])
+        ]
+        self.lock = Lock()
+        self.ids = [[] for pool in self.pools]      # track ids of each pool
+        self.bags = [[] for pool in self.pools]     # track ids left to play of each pool
+        self.last_played = None
+        self.stale = True
+
+    def invalidate(self):
+        '''Marks the index stale, so the next choice indexes the clips again'''
+        self.stale = True
+
+    def refresh(self):
+        '''Indexes the clips of each pool and queues tag parses of new ones'''
+        self.library.refresh(self.clips_dir)
+        for i, pool in enumerate(self.pools):
+            ids = self.library.audio_file_ids(pool['directory'])
+            if self.tags:
+                self.tags.songs(ids)
+            # keep the bag's order, dropping removed clips and adding new ones anywhere
+            known = set(ids)
+            bag = [track_id for track_id in self.bags[i] if track_id in known]
+            for track_id in known - set(self.ids[i]):
+                bag.insert(randrange(len(bag) + 1), track_id)
+            self.bags[i] = bag
+            self.ids[i] = ids
+        self.stale = False
+
+    def duration(self, track_id):
+        '''Returns a clip's cached duration in seconds, or None if it is not known'''
+        duration = self.tags.duration(track_id) if self.tags else None
+        return duration / 1000 if duration else None
+
+    def in_hours(self, pool, hour):
+        start, end = pool['hours']
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def choose(self, now=None):
+        '''Returns (track id, path) of the next clip, or None if no pool has clips now'''
+        with self.lock:
+            if self.stale:
+                self.refresh()
+            hour = (now or datetime.datetime.now()).hour
+            active = [i for i, pool in enumerate(self.pools) if self.ids[i] and self.in_hours(pool, hour)]
+            if not active:
+                return None
+            i = choices(active, weights=[self.pools[i]['weight'] for i in active])[0]
+
+            if not self.bags[i]:
+                bag = list(self.ids[i])
+                shuffle(bag)
+                # the bag is popped from its end
+                if len(bag) > 1 and bag[-1] == self.last_played:
+                    bag[0], bag[-1] = bag[-1], bag[0]
+                self.bags[i] = bag
+            track_id = self.bags[i].pop()
+            self.last_played = track_id
+            return track_id, self.library.paths([track_id])[track_id]
@@ -3,19 +3,27 @@
 #   Flask Resource Generation
 #
 #   1. Defines admin login process & Creates admin API resource
+#      and the job status resource
 #   2. Provides function to create multiple API resources from InputHandler class methods
 #   3. Provides function to bind API resources to a flask API
 #   4. Define Web UI resources
 #
 ######################################################################
-from flask import session, make_response
+from flask import session, make_response, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_restful import Resource, reqparse
 from inspect import getfullargspec
 from hashlib import sha256
 from functools import partial
+from threading import Lock
 import datetime
+import gzip
+import os
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 limiter = Limiter(key_func=get_remote_address)
 
@@ -65,26 +73,43 @@ class Admin(Resource):
             return {'msg':'you are not admin', 'data':False}
 
 
+class Job(Resource):
+    '''Returns the status of a background job via GET /api/jobs/<id>'''
+    def __init__(self, jobs):
+        super(Job, self).__init__()
+        self.jobs = jobs
+
+    def get(self, job_id):
+        status = self.jobs.status(job_id)
+        if status is None:
+            return {'msg':'no job ' + str(job_id), 'err':True, 'data':None}, 404
+        return {'msg':f'job {job_id} {status["state"]}', 'err':False, 'data':status}
+
+
 ######################################################################
 #
 #   2. Provides function to create multiple API resources from InputHandler class methods
 #
 ######################################################################
-def rest_resource_generate(func_name, func, class_instance):
+def rest_resource_generate(func_name, func, class_instance, station=''):
     '''Generate REST resources for an io function
     input: music_lsp
     output: 'MusicLsp', ['/music/lsp', '/music/lsp/']
+    A station's resources are under /api/<station>/
     '''
     class_name = ''
-    for segment in func_name.split('_'):
+    for segment in ([station] if station else []) + func_name.split('_'):
         class_name += segment[0].upper() + segment[1::]
 
     rest_url_resources = []
-    rest_res = '/api/' + func_name.replace('_','/')
+    rest_res = '/api/' + (station + '/' if station else '') + func_name.replace('_','/')
     rest_url_resources.append(rest_res)
 
-    arg_list = getfullargspec(getattr(class_instance.__class__, func_name))[0]
-    arg_list.remove('self')
+    arg_spec = getfullargspec(getattr(class_instance.__class__, func_name))
+    query_args = getattr(func, 'query_args', ())
+    arg_list = [arg for arg in arg_spec[0] if arg != 'self' and arg not in query_args]
+    # optional query string arguments take the type of their default value
+    query_defaults = dict(zip(arg_spec[0][::-1], (arg_spec[3] or ())[::-1]))
 
     if arg_list:
         def post_handler():
@@ -111,14 +136,38 @@ def rest_resource_generate(func_name, func, class_instance):
             dict(post=post_func)
         )
     else:
+        def get_handler():
+            parser = reqparse.RequestParser()
+            for arg in query_args:
+                parser.add_argument(
+                    arg,
+                    dest=arg,
+                    location='args',
+                    type=type(query_defaults[arg]),
+                    default=query_defaults[arg],
+                    help=arg
+                )
+            args = parser.parse_args()
+
+            if not hasattr(func, 'etag_func'):
+                return func(**args)
+
+            # answer unchanged resources without building them
+            etag = '-'.join([func.etag_func(class_instance)] + [str(args[arg]) for arg in query_args])
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+            return func(**args), 200, {'ETag':'"' + etag + '"'}
+
         if hasattr(func, 'is_admin_method'):
-            post_func = partial(admin_check, func=func)
+            get_func = partial(admin_check, func=get_handler)
         else:
-            post_func = func
+            get_func = get_handler
         rest_resource_class = type(
             class_name,
             (Resource,),
-            dict(get=post_func)
+            dict(get=staticmethod(get_func))
         )
 
     return rest_resource_class, rest_url_resources
@@ -129,14 +178,14 @@ def rest_resource_generate(func_name, func, class_instance):
 #   3. Provides function to bind API resources to a flask API
 #
 ######################################################################
-def bind_flask_resources(flask_api, class_instance):
-    '''Generate Flask RESTful API via methods of InputHandler'''
+def bind_flask_resources(flask_api, class_instance, station=''):
+    '''Generate Flask RESTful API via methods of InputHandler, under /api/<station>/ if given'''
     for attr_name in dir(class_instance):
         attr = getattr(class_instance, attr_name)
         if hasattr(attr, 'is_api_method'): 
-            tmp_class, rest_url_resources = rest_resource_generate(attr_name, attr, class_instance)
+            tmp_class, rest_url_resources = rest_resource_generate(attr_name, attr, class_instance, station=station)
            
-            flask_api.add_resource(tmp_class, *rest_url_resources)
+            flask_api.add_resource(tmp_class, *rest_url_resources, endpoint=tmp_class.__name__.lower())
 
 
 ######################################################################
@@ -144,135 +193,127 @@ def bind_flask_resources(flask_api, class_instance):
 #   4. Define Web UI resources
 #
 ######################################################################
-def web_ui_adder(api):
-    api.add_resource(WebUI_index, '/')
-    api.add_resource(WebUI_gif, '/MorphOvum.gif')
-    api.add_resource(WebUI_og_image, '/morphovum-og.png')
-    api.add_resource(WebUI_style_css, '/style.css')
-    api.add_resource(WebUI_cp_index, '/control_panel/')
-    api.add_resource(WebUI_cp_js, '/control_panel/control_panel.js')
-    api.add_resource(WebUI_json, '/control_panel/api_data.json')
-    api.add_resource(WebUI_favicon, '/favicon.ico')
+#   url: (file in ./www, Content-Type, Cache-Control)
+#   no-cache still lets browsers keep a copy, revalidated with a cheap 304
+web_ui_files = {
+    '/':                                ('index.html', 'text/html', 'no-cache'),
+    '/MorphOvum.gif':                   ('MorphOvum.gif', 'image/gif', 'public, max-age=86400'),
+    '/morphovum-og.png':                ('morphovum-og.png', 'image/png', 'public, max-age=31536000'),
+    '/style.css':                       ('style.css', 'text/css', 'no-cache'),
+    '/control_panel/':                  ('control_panel.html', 'text/html', 'no-cache'),
+    '/control_panel/control_panel.js':  ('control_panel.js', 'application/javascript', 'no-cache'),
+    '/control_panel/api_data.json':     ('api_data.json', 'application/json', 'no-cache'),
+    '/favicon.ico':                     ('favicon.ico', 'image/x-icon', 'public, max-age=86400'),
     # JavaScript modules
-    api.add_resource(WebUI_js_main, '/js/main.js')
-    api.add_resource(WebUI_js_utils, '/js/utils.js')
-    api.add_resource(WebUI_js_websocket, '/js/websocket.js')
-    api.add_resource(WebUI_js_visualizer, '/js/visualizer.js')
-    api.add_resource(WebUI_js_audio_player, '/js/audio-player.js')
-    api.add_resource(WebUI_js_track_manager, '/js/track-manager.js')
-    api.add_resource(WebUI_js_admin_controls, '/js/admin-controls.js')
-
-class WebUI_index(Resource):
-    def get(self):
-        from flask import request
-        with open('./www/index.html') as f:
-            html_content = f.read()
-        
-        # Inject absolute URLs for Open Graph metadata (for social media crawlers)
-        base_url = request.url_root.rstrip('/')
-        html_content = html_content.replace('{{BASE_URL}}', base_url)
-        
-        response = make_response(html_content)
-        response.headers['Content-Type'] = 'text/html'
-        return response
-
-class WebUI_gif(Resource):
-    def get(self):
-        with open('./www/MorphOvum.gif', 'rb') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'image/gif'
-        return response
-
-class WebUI_og_image(Resource):
-    def get(self):
-        with open('./www/morphovum-og.png', 'rb') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'image/png'
-        # Add cache control headers for better social media compatibility
-        response.headers['Cache-Control'] = 'public, max-age=31536000'
-        return response
-
-class WebUI_style_css(Resource):
-    def get(self):
-        with open('./www/style.css') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'text/css'
-        return response
-
-class WebUI_cp_index(Resource):
-    def get(self):
-        with open('./www/control_panel.html') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'text/html'
-        return response
-
-class WebUI_cp_js(Resource):
-    def get(self):
-        with open('./www/control_panel.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
-
-
-class WebUI_json(Resource):
-    def get(self):
-        with open('./www/api_data.json') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-class WebUI_favicon(Resource):
-    def get(self):
-        with open('./www/favicon.ico', 'rb') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'image/x-icon'
-        return response
-
-class WebUI_js_main(Resource):
-    def get(self):
-        with open('./www/js/main.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
-
-class WebUI_js_utils(Resource):
-    def get(self):
-        with open('./www/js/utils.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
+    '/js/main.js':                      ('js/main.js', 'application/javascript', 'no-cache'),
+    '/js/utils.js':                     ('js/utils.js', 'application/javascript', 'no-cache'),
+    '/js/websocket.js':                 ('js/websocket.js', 'application/javascript', 'no-cache'),
+    '/js/visualizer.js':                ('js/visualizer.js', 'application/javascript', 'no-cache'),
+    '/js/audio-player.js':              ('js/audio-player.js', 'application/javascript', 'no-cache'),
+    '/js/track-manager.js':             ('js/track-manager.js', 'application/javascript', 'no-cache'),
+    '/js/admin-controls.js':            ('js/admin-controls.js', 'application/javascript', 'no-cache'),
+}
+#   files with {{BASE_URL}} replaced by the request's URL root (Open Graph metadata)
+web_ui_templates = ['index.html']
+#   already compressed image formats are not gzipped
+compressible_types = ['text/html', 'text/css', 'application/javascript', 'application/json', 'image/x-icon']
+
+class StaticAsset:
+    '''A file held in memory with its gzip and brotli encodings, ETag and Last-Modified'''
+    def __init__(self, data, mtime, content_type, cache_control):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.mtime = mtime
+        self.last_modified = datetime.datetime.fromtimestamp(int(mtime), datetime.timezone.utc)
+        self.etag = sha256(data).hexdigest()[:32]
+        self.encodings = {'identity':data}
+        if content_type in compressible_types:
+            self.encodings['gzip'] = gzip.compress(data, 9)
+            if brotli:
+                self.encodings['br'] = brotli.compress(data)
+        self.encodings = {
+            encoding: encoded for encoding, encoded in self.encodings.items()
+            if len(encoded) <= len(data)
+        }
+
+    def response(self):
+        '''Returns 304 Not Modified or the best encoding the client accepts'''
+        # the ETag is weak as it is shared by every encoding
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(self.etag)
+        else:
+            not_modified = bool(request.if_modified_since) and request.if_modified_since >= self.last_modified
 
-class WebUI_js_websocket(Resource):
-    def get(self):
-        with open('./www/js/websocket.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
+        if not_modified:
+            response = make_response('', 304)
+        else:
+            encoding = max(
+                self.encodings,
+                key=lambda encoding: (request.accept_encodings[encoding] if encoding != 'identity' else 0.001, -len(self.encodings[encoding]))
+            )
+            response = make_response(self.encodings[encoding])
+            response.headers['Content-Type'] = self.content_type
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(self.etag, weak=True)
+        response.last_modified = self.last_modified
+        response.headers['Cache-Control'] = self.cache_control
+        response.headers['Vary'] = 'Accept-Encoding'
         return response
 
-class WebUI_js_visualizer(Resource):
-    def get(self):
-        with open('./www/js/visualizer.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
+class StaticAssets:
+    '''The web UI files, read once at startup. With reload, a file whose mtime
+    has changed is read again on its next request'''
+    def __init__(self, root='./www', files=web_ui_files, reload=False):
+        self.root = root
+        self.files = files
+        self.reload = reload
+        self.lock = Lock()
+        self.assets = {}        # url: StaticAsset
+        self.rendered = {}      # (url, url root): StaticAsset of a template
+        for url in files:
+            self.load(url)
+
+    def load(self, url):
+        file_name, content_type, cache_control = self.files[url]
+        path = os.path.join(self.root, file_name)
+        mtime = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            self.assets[url] = StaticAsset(f.read(), mtime, content_type, cache_control)
+        if file_name in web_ui_templates:
+            self.rendered = {key: asset for key, asset in self.rendered.items() if key[0] != url}
+
+    def get(self, url):
+        '''Returns the StaticAsset of a url, rendering templates for the request's URL root'''
+        with self.lock:
+            if self.reload and os.path.getmtime(os.path.join(self.root, self.files[url][0])) != self.assets[url].mtime:
+                self.load(url)
+            asset = self.assets[url]
+            if self.files[url][0] not in web_ui_templates:
+                return asset
+
+            base_url = request.url_root.rstrip('/')
+            if (url, base_url) not in self.rendered:
+                # the Host header picks the URL root, so only keep a few
+                if len(self.rendered) > 16:
+                    self.rendered.clear()
+                self.rendered[(url, base_url)] = StaticAsset(
+                    asset.encodings['identity'].replace(b'{{BASE_URL}}', base_url.encode('utf-8')),
+                    asset.mtime,
+                    asset.content_type,
+                    asset.cache_control
+                )
+            return self.rendered[(url, base_url)]
 
-class WebUI_js_audio_player(Resource):
-    def get(self):
-        with open('./www/js/audio-player.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
+class WebUI(Resource):
+    '''Serves the web UI files from a StaticAssets'''
+    def __init__(self, assets):
+        super(WebUI, self).__init__()
+        self.assets = assets
 
-class WebUI_js_track_manager(Resource):
     def get(self):
-        with open('./www/js/track-manager.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
+        return self.assets.get(request.url_rule.rule).response()
 
-class WebUI_js_admin_controls(Resource):
-    def get(self):
-        with open('./www/js/admin-controls.js') as f:
-            response = make_response(f.read())
-        response.headers['Content-Type'] = 'application/javascript'
-        return response
+def web_ui_adder(api, reload=False):
+    assets = StaticAssets(reload=reload)
+    api.add_resource(WebUI, *web_ui_files, resource_class_kwargs={'assets': assets})
@@ -2,7 +2,9 @@
 #       Admin Only (admin)
 #       Backend busy (busy)
 #       Rate limiting (patience)
-#   2. Defines the intput handler class
+#   2. Defines the URL pre-flight class
+#       Checks web URLs with one HEAD or ranged GET on a pooled session
+#   3. Defines the intput handler class
 #       Takes an AudioPlayers class
 #       Defines meta-functions
 #       Defines functions to be used by the API
@@ -11,9 +13,13 @@
 import os
 import datetime
 import player_backend
+from job_queue import JobQueue, report_progress
 import decorator
 import re
 import requests
+from collections import OrderedDict
+from threading import Lock
+from time import time
 from inspect import getfullargspec
 import vlc
 
@@ -23,18 +29,19 @@ import vlc
 #
 ######################################################################
 @decorator.decorator
-def busy(func, *args, **kwargs):
+def busy(func, player='', *args, **kwargs):
     '''Certain commands may take time. In order to avoid multiple
-    high-cost commands issued at once, this sets the InputHandler
-    to a "busy" state until the command is completed.'''
+    high-cost commands issued at once, each player (music, ambience)
+    runs one at a time. Others for the same player wait up to busy_wait
+    seconds, then are turned away. Other players are unaffected.'''
     io_instance = args[0]
-    if io_instance.busy:
-        return {'msg':'Busy. Please try again', 'err':True, 'data':None}
-    else:
-        io_instance.busy = True
-        out = func(*args, **kwargs)
-        io_instance.busy = False
-        return out
+    lock = io_instance.player_locks[player]
+    if not lock.acquire(timeout=io_instance.audio_players.config_data['busy_wait']):
+        return {'msg':player + ' is busy. Please try again', 'err':True, 'data':None}
+    try:
+        return func(*args, **kwargs)
+    finally:
+        lock.release()
 
 def busy_flag(func):
     '''adds the is_busy_method attribute'''
@@ -43,19 +50,32 @@ def busy_flag(func):
     return func
 
 @decorator.decorator
-def patience(func, *args, **kwargs):
-    '''Disallow certain commands being spammed too frequently'''
+def patience(func, player='', *args, **kwargs):
+    '''Disallow certain commands being spammed too frequently, per player'''
     io_instance = args[0]
     timeout = 3
     now = datetime.datetime.today()
 
-    diff = (now - io_instance.last_change).seconds
+    with io_instance.patience_lock:
+        diff = (now - io_instance.last_change.get(player, datetime.datetime.min)).seconds
+        if diff < timeout:
+            return {'msg':'Please wait ' + str(timeout - diff) + ' seconds', 'err':True, 'data':None}
+        io_instance.last_change[player] = now
+    return func(*args, **kwargs)
 
-    if diff < timeout:
-        return {'msg':'Please wait ' + str(timeout - diff) + ' seconds', 'err':True, 'data':None}
-    else:
-        io_instance.last_change = now
-        return func(*args, **kwargs)
+@decorator.decorator
+def background(func, *args, **kwargs):
+    '''Long commands (directory walks, stream checks) would hold up the HTTP
+    request. They are run by the job queue instead, returning the job straight
+    away. Its status is at /api/jobs/<id> and websockets clients get job events'''
+    io_instance = args[0]
+    job = io_instance.jobs.submit(func.__name__, func, *args, **kwargs)
+    return {'msg':f'job {job.id} queued: {func.__name__}', 'err':False, 'data':job.status()}
+
+def background_flag(func):
+    '''adds the is_background_method attribute'''
+    func.is_background_method = True
+    return func
 
 def patience_flag(func):
     '''adds the is_patience_method attribute'''
@@ -72,10 +92,85 @@ def api(func):
     func.is_api_method = True
     return func
 
+def query(*arg_names):
+    '''adds the query_args attribute.
+    These optional arguments are read from a GET request's query string'''
+    def add_query_args(func):
+        func.query_args = arg_names
+        return func
+    return add_query_args
+
+def etag(version_func):
+    '''adds the etag_func attribute.
+    version_func(InputHandler) returns the resource's version without building it,
+    so unchanged resources can be answered with 304 Not Modified'''
+    def add_etag_func(func):
+        func.etag_func = version_func
+        return func
+    return add_etag_func
+
+def api_args(func):
+    '''Returns the arguments of an API function, which are POSTed'''
+    return [
+        arg for arg in getfullargspec(func)[0]
+        if arg != 'self' and arg not in getattr(func, 'query_args', ())
+    ]
+
+
+######################################################################
+#
+#   2.  Defines the URL pre-flight class
+#
+######################################################################
+class UrlChecker:
+    '''Checks that web URLs answer before VLC is given them.
+    A HEAD request is tried first. Servers that refuse HEAD (and radio streams)
+    get a GET for the first byte, streamed so the body is never downloaded.
+    Connections are pooled, requests have hard (connect, read) timeouts and
+    results are cached for ttl seconds (answered) or negative_ttl seconds (failed)'''
+    def __init__(self, timeout=(3.05, 5), ttl=300, negative_ttl=10, max_entries=256, pool_size=8):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.cache = OrderedDict()  # url: (error message or None, expiry time)
+
+    def check(self, url):
+        '''Returns an error message, or None if the url answered'''
+        with self.lock:
+            if url in self.cache and self.cache[url][1] > time():
+                return self.cache[url][0]
+        error = self.preflight(url)
+        with self.lock:
+            self.cache[url] = (error, time() + (self.negative_ttl if error else self.ttl))
+            self.cache.move_to_end(url)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return error
+
+    def preflight(self, url):
+        try:
+            r = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+            r.close()
+            if r.status_code not in [200, 206]:
+                # stream=True stops after the headers, closing drops the body
+                r = self.session.get(url, timeout=self.timeout, headers={'Range':'bytes=0-0'}, stream=True)
+                r.close()
+            if r.status_code not in [200, 206]:
+                return 'url ' + url + ' returned status code ' + str(r.status_code)
+        except requests.exceptions.RequestException as e:
+            return 'request to url ' + url + ' failed with error message: ' + str(e)
+        return None
+
 
 ######################################################################
 #
-#   2.  Defines the intput handler class
+#   3.  Defines the intput handler class
 #
 ######################################################################
 class InputHandler:
@@ -85,8 +180,12 @@ class InputHandler:
     '''
     def __init__(self, audio_players):
         self.audio_players = audio_players
-        self.last_change = datetime.datetime.today()
-        self.busy = False
+        self.last_change = {}       # player: time of its last @patience command
+        self.patience_lock = Lock()
+        self.player_locks = {'music':Lock(), 'ambience':Lock()}
+        self.jobs = JobQueue(workers=audio_players.config_data['job_workers'])
+        self.url_checker = UrlChecker()
+        self.jobs.callbacks.append(self.job_changed)
         self.last_chance = datetime.datetime.today()
         self.api_methods = None
         self.generate_help()
@@ -97,8 +196,8 @@ class InputHandler:
         for attr_name in dir(self):
             attr = getattr(self, attr_name)
             if hasattr(attr, 'is_api_method'):
-                if len(getfullargspec(attr)[0]) > 1:
-                    arg = getfullargspec(attr)[0][1]
+                if api_args(attr):
+                    arg = api_args(attr)[0]
                 else:
                     arg = False
 
@@ -106,10 +205,16 @@ class InputHandler:
                     'description'   :attr.__doc__,
                     'arg'           :arg
                 }
+                if hasattr(attr, 'query_args'):
+                    self.api_methods[attr_name]['query_args'] = list(attr.query_args)
 
     def make_output_data(self, msg, err=False, data=None):
         return {'err':err, 'msg':msg, 'data':data}
 
+    def job_changed(self, job):
+        '''JobQueue callback, notifies websockets clients of job progress and completion'''
+        self.audio_players.notification_server.publish(dict(job.status(), event='job'))
+
     def ls_funcs(self, directory, music_or_ambience, ls_type):
         '''Deals with listing, playing, cuing and appending files or directories to various players'''
         base_dir = self.audio_players.config_data['audio_dirs'][music_or_ambience]
@@ -121,32 +226,31 @@ class InputHandler:
         if not os.path.exists(path):
             return self.make_output_data('no file or directory named "' + directory + '"', err=True)
 
-        mp = getattr(self.audio_players, 'mp_' + music_or_ambience)
-        ml = getattr(self.audio_players, 'ml_' + music_or_ambience)
+        playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
 
         if ls_type == 'lsp':
             player_backend.modify_media_list(
                 path,
-                ml,
-                mp,
-                switch_current=True
+                playlist,
+                switch_current=True,
+                progress=report_progress
             )
             return self.make_output_data('' + music_or_ambience + ' set to: ' + directory)
         elif ls_type == 'lsc':
             player_backend.modify_media_list(
                 path,
-                ml,
-                mp,
+                playlist,
                 append=True,
-                shuffle=False
+                shuffle=False,
+                progress=report_progress
             )
             return self.make_output_data(music_or_ambience + ' appended with: ' + directory)
         elif ls_type == 'lsa':
             player_backend.modify_media_list(
                 path,
-                ml,
-                mp,
+                playlist,
                 append=True,
+                progress=report_progress
             )
             return self.make_output_data(music_or_ambience + ' added and shuffled with: ' + directory)
         elif ls_type == 'ls':
@@ -166,26 +270,22 @@ class InputHandler:
             if not re.search('http(?:s?)://(?:www\.)?youtu(?:be\.com\/watch\?v=|\.be\/)([\w\-\_]{11})((amp;)?[\w\=]*|$)', url):
                 return self.make_output_data('YouTube url "' + url + '" abnormal', err=True)
 
-        try:
-            r = requests.get(url)
-            if r.status_code != 200:
-                return self.make_output_data('url ' + url + ' returned status code ' + str(r.status_code), err=True)
-        except requests.exceptions.RequestException as e:
-            return self.make_output_data('GET request to url ' + url + ' failed with error message: ' + str(e), err=True)
+        error = self.url_checker.check(url)
+        if error:
+            return self.make_output_data(error, err=True)
 
         mp = getattr(self.audio_players, 'mp_' + music_or_ambience)
-        ml = getattr(self.audio_players, 'ml_' + music_or_ambience)
+        playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
 
         if wp_type == 'wp':
             if player_backend.check_mrl(url):
                 return self.make_output_data(f'Error: VLC cannot play {url}. Not added.')
             player_backend.modify_media_list(
                 url,
-                ml,
-                mp,
+                playlist,
                 switch_current=True
             )
-            track = player_backend.media_list_player_get_song(mp)
+            track = playlist.current_song()
             return self.make_output_data(music_or_ambience + ' playing: ' + track)
 
         elif wp_type == 'wc':
@@ -193,40 +293,55 @@ class InputHandler:
                 return self.make_output_data(f'Error: VLC cannot play {url}. Not added.')
             player_backend.modify_media_list(
                 url,
-                ml,
-                mp,
+                playlist,
                 append=True,
                 shuffle=False
             )
             return self.make_output_data(music_or_ambience + ' enqeued with: ' + url)
 
-    def current_funcs(self, music_or_ambience, track_or_playlist):
+    def current_funcs(self, music_or_ambience, track_or_playlist, offset=0, limit=0):
         '''Returns current song or list of media currently in a player's MediaList'''
-        mp = getattr(self.audio_players, 'mp_' + music_or_ambience)
-        is_playing = mp.is_playing()
-
         if track_or_playlist == 'track':
             mp = getattr(self.audio_players, 'mp_' + music_or_ambience)
-            track = player_backend.media_list_player_get_song(mp)
+            is_playing = mp.is_playing()
+            playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
+            track = playlist.current_song()
 
             return self.make_output_data(track, data={'track':track, 'is_playing':is_playing})
         elif track_or_playlist == 'playlist':
-            ml = getattr(self.audio_players, 'ml_' + music_or_ambience)
-            output_data = []
-            for media in ml:
-                output_data.append(player_backend.media_get_song(media))
+            # the event-kept play state matches the ETag of playlist_version
+            is_playing = getattr(self.audio_players, music_or_ambience + '_playing')
+            playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
+            version, songs = playlist.snapshot()
+            offset = max(offset, 0)
+            page = list(songs[offset:offset + limit] if limit > 0 else songs[offset:])
+
+            return self.make_output_data(
+                f'tracks {offset + 1}-{offset + len(page)} of {len(songs)}',
+                data={
+                    'playlist'  :page,
+                    'is_playing':is_playing,
+                    'offset'    :offset,
+                    'total'     :len(songs),
+                    'version'   :version
+                }
+            )
 
-            return self.make_output_data(' '.join(output_data), data={'playlist':output_data, 'is_playing':is_playing})
+    def playlist_version(self, music_or_ambience):
+        '''Version of the currentplaylist response. Changes with the playlist or play state'''
+        playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
+        is_playing = getattr(self.audio_players, music_or_ambience + '_playing')
+        return playlist.snapshot_version() + ('-playing' if is_playing else '-stopped')
 
     def skip_funcs(self, music_or_ambience):
         '''Skips (runs next()) on the current track of a player'''
         mp = getattr(self.audio_players, 'mp_' + music_or_ambience)
-        ml = getattr(self.audio_players, 'ml_' + music_or_ambience)
-        old_track = player_backend.media_list_player_get_song(mp)
-        if ml.count() == 1:
+        playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
+        old_track = playlist.current_song()
+        if len(playlist) == 1:
             return self.make_output_data('only one file in playlist: ' + old_track, err=True)
         mp.next()
-        new_track = player_backend.media_list_player_get_song(mp)
+        new_track = playlist.current_song()
 
         return self.make_output_data(music_or_ambience + ' player skipped track: ' + old_track + ' \n now playing: ' + new_track, data={'old_track':old_track, 'new_track':new_track})
 
@@ -239,8 +354,8 @@ class InputHandler:
             status = 'stopped'
         else:
             # Shuffle the playlist when toggling on
-            ml = getattr(self.audio_players, 'ml_' + music_or_ambience)
-            player_backend.media_list_shuffle(ml)
+            playlist = getattr(self.audio_players, 'pl_' + music_or_ambience)
+            playlist.shuffle(keep_current=False)
             mp.play()
             status = 'playing'
         return self.make_output_data(f'{music_or_ambience} is {status}')
@@ -259,10 +374,15 @@ class InputHandler:
             status = 'repeating playlist'
         return self.make_output_data(f'{music_or_ambience} is now {status}')
 
-    def history_funcs(self, music_or_ambience):
-        '''Returns up to 100 of the last played tracks for a player'''
-        history = getattr(self.audio_players, 'history_' + music_or_ambience)
-        return self.make_output_data(str(len(history)) + ' tracks in history', data=history)
+    def history_funcs(self, music_or_ambience, offset=0, limit=0):
+        '''Returns a page of the last played tracks for a player, oldest first.
+        offset counts back from the newest track'''
+        offset = max(offset, 0)
+        entries, total = self.audio_players.history.page(music_or_ambience, offset=offset, limit=max(limit, 0))
+        return self.make_output_data(
+            f'{len(entries)} of {total} tracks in history',
+            data={'history':entries, 'offset':offset, 'total':total}
+        )
 
     #   API Definitions
     @api
@@ -270,6 +390,41 @@ class InputHandler:
         '''Return the available commands and their arguments, if any'''
         return self.make_output_data(str(self.api_methods), data=self.api_methods)
 
+    @api
+    def jobs_ls(self):
+        '''Return the status of recent background jobs, newest first'''
+        statuses = self.jobs.statuses()
+        return self.make_output_data(
+            '\n'.join(f'{status["id"]}: {status["name"]} {status["state"]}' for status in statuses),
+            data=statuses
+        )
+
+    @api
+    def startup(self):
+        '''Return the seconds from process start to each startup phase (config, stream, playlists, first audio)'''
+        phases = player_backend.startup_timer.report()
+        data = {'phases':phases, 'playlists_loaded':self.audio_players.playlists_loaded.is_set()}
+        return self.make_output_data('\n'.join(f'{phase}: {seconds:.2f}s' for phase, seconds in phases.items()), data=data)
+
+    @api
+    def websocket_stats(self):
+        '''Return the number of websocket clients and messages sent, dropped or disconnected for being too slow'''
+        server = self.audio_players.notification_server
+        data = dict(server.stats, clients=len(server.users))
+        return self.make_output_data(' '.join(f'{key}: {value}' for key, value in data.items()), data=data)
+
+    @api
+    def stream_listeners(self):
+        '''Return the number of stream listeners, bytes sent, and each listener's mount, seconds and bytes'''
+        relay = self.audio_players.stream_relay
+        if relay is None:
+            return self.make_output_data('stream_relay is disabled, listeners are not counted', err=True)
+        data = relay.snapshot()
+        return self.make_output_data(
+            f'listeners: {data["listeners"]}/{data["max_listeners"]} peak: {data["peak"]} rejected: {data["rejected"]} bytes_sent: {data["bytes_sent"]}',
+            data=data
+        )
+
     @admin
     @api
     def music_ls(self, directory='.'):
@@ -278,59 +433,69 @@ class InputHandler:
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='music')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='music')
+    @busy_flag
     def music_lsp(self, directory_or_file='.'):
         '''Play a file or the contents of a subdirectory in the music directory'''
         return self.ls_funcs(directory_or_file, 'music', 'lsp')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='music')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='music')
+    @busy_flag
     def music_lsc(self, directory_or_file='.'):
         '''Enqueue a file or the contents of a subdirectory in the music directory'''
         return self.ls_funcs(directory_or_file, 'music', 'lsc')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='music')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='music')
+    @busy_flag
     def music_lsa(self, directory_or_file='.'):
         '''Add and shuffle a file or the contents of a subdirectory in the music directory'''
         return self.ls_funcs(directory_or_file, 'music', 'lsa')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='music')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='music')
+    @busy_flag
     def music_wp(self, url):
         '''Play the web resource in the music player'''
         return self.wp_funcs(url, 'music', 'wp')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='music')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='music')
+    @busy_flag
     def music_wc(self, url):
         '''Enqueue the web resource in the music player'''
         return self.wp_funcs(url, 'music', 'wc')
 
     @admin
     @api
-    @busy
+    @busy(player='music')
     @busy_flag
-    @patience
+    @patience(player='music')
     @patience_flag
     def music_skip(self):
         '''Skip the currently playing music track'''
@@ -338,7 +503,7 @@ class InputHandler:
 
     @admin
     @api
-    @patience
+    @patience(player='music')
     @patience_flag
     def music_toggle(self):
         '''Toggle the playing of the music player'''
@@ -346,7 +511,7 @@ class InputHandler:
 
     @admin
     @api
-    @patience
+    @patience(player='music')
     @patience_flag
     def music_repeat(self):
         '''Toggle the repeat_mode of the music player'''
@@ -358,14 +523,18 @@ class InputHandler:
         return self.current_funcs('music', 'track')
 
     @api
-    def music_currentplaylist(self):
-        '''Return the currently playing music playlist'''
-        return self.current_funcs('music', 'playlist')
+    @query('offset', 'limit')
+    @etag(lambda self: self.playlist_version('music'))
+    def music_currentplaylist(self, offset=0, limit=0):
+        '''Return the currently playing music playlist. Paged by the offset and limit query arguments'''
+        return self.current_funcs('music', 'playlist', offset=offset, limit=limit)
 
     @api
-    def music_history(self):
-        '''Returns the last music tracks played (max 100)'''
-        return self.history_funcs('music')
+    @query('offset', 'limit')
+    @etag(lambda self: self.audio_players.history.version('music'))
+    def music_history(self, offset=0, limit=0):
+        '''Returns the last music tracks played, with when and how long. Paged back from the newest by the offset and limit query arguments'''
+        return self.history_funcs('music', offset=offset, limit=limit)
 
     @api
     def playlist_ls(self):
@@ -378,8 +547,12 @@ class InputHandler:
 
     @admin
     @api
-    @patience
+    @patience(player='music')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='music')
+    @busy_flag
     def playlist_lsp(self, playlist=''):
         '''Plays a playlist from available playlists. An int n input will play the nth playlist'''
         try:
@@ -395,32 +568,31 @@ class InputHandler:
         else:
             player_backend.modify_media_list(
                 path,
-                self.audio_players.ml_music,
-                self.audio_players.mp_music,
-                switch_current=True
+                self.audio_players.pl_music,
+                switch_current=True,
+                progress=report_progress
             )
             return self.make_output_data('ok! music set to: ' + playlist)
 
     @admin
     @api
-    @patience
+    @patience(player='music')
     @patience_flag
     def playlist_save(self, playlist=''):
         '''Save the current music playlist to the playlist's dir as an m3u'''
-        ml = self.audio_players.ml_music
-        output_data = []
+        paths = self.audio_players.pl_music.paths()
         with open(os.path.join(self.audio_players.config_data['playlist_dir'], f'{playlist}.m3u'), 'w+') as f:
             f.write('#EXTM3U')
-            for media in ml:
-                f.write('\n#EXTINF:,' + media.get_mrl())
-                f.write('\n' + media.get_mrl()[7::])
+            for path in paths:
+                f.write('\n#EXTINF:,' + path)
+                f.write('\n' + path)
             f.write('\n')
 
         return self.make_output_data(f'{playlist}.m3u created')
 
     @admin
     @api
-    @patience
+    @patience(player='music')
     @patience_flag
     def playlist_delete(self, playlist=''):
         '''Deletes a playlist from available playlists. An int n input will play the nth playlist'''
@@ -446,59 +618,69 @@ class InputHandler:
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='ambience')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='ambience')
+    @busy_flag
     def ambience_lsp(self, directory_or_file='.'):
         '''Play a file or the contents of a subdirectory in the ambience directory'''
         return self.ls_funcs(directory_or_file, 'ambience', 'lsp')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='ambience')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='ambience')
+    @busy_flag
     def ambience_lsc(self, directory_or_file='.'):
         '''Enqueue a file or the contents of a subdirectory in the music directory'''
         return self.ls_funcs(directory_or_file, 'ambience', 'lsc')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='ambience')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='ambience')
+    @busy_flag
     def ambience_lsa(self, directory_or_file='.'):
         '''Add and shuffle a file or the contents of a subdirectory in the ambience directory'''
         return self.ls_funcs(directory_or_file, 'ambience', 'lsa')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='ambience')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='ambience')
+    @busy_flag
     def ambience_wp(self, url):
         '''Play the web resource in the ambience player'''
         return self.wp_funcs(url, 'ambience', 'wp')
 
     @admin
     @api
-    @busy
-    @busy_flag
-    @patience
+    @patience(player='ambience')
     @patience_flag
+    @background
+    @background_flag
+    @busy(player='ambience')
+    @busy_flag
     def ambience_wc(self, url):
         '''Enqueue the web resource in the ambience player'''
         return self.wp_funcs(url, 'ambience', 'wc')
 
     @admin
     @api
-    @busy
+    @busy(player='ambience')
     @busy_flag
-    @patience
+    @patience(player='ambience')
     @patience_flag
     def ambience_skip(self):
         '''Skip the current ambience track'''
@@ -506,7 +688,7 @@ class InputHandler:
 
     @admin
     @api
-    @patience
+    @patience(player='ambience')
     @patience_flag
     def ambience_toggle(self):
         '''Toggle the playing of the ambience player'''
@@ -514,7 +696,7 @@ class InputHandler:
 
     @admin
     @api
-    @patience
+    @patience(player='ambience')
     @patience_flag
     def ambience_repeat(self):
         '''Toggle the repeat_mode of the music player'''
@@ -526,14 +708,18 @@ class InputHandler:
         return self.current_funcs('ambience', 'track')
 
     @api
-    def ambience_currentplaylist(self):
-        '''Return the currently playing ambience playlist'''
-        return self.current_funcs('ambience', 'playlist')
+    @query('offset', 'limit')
+    @etag(lambda self: self.playlist_version('ambience'))
+    def ambience_currentplaylist(self, offset=0, limit=0):
+        '''Return the currently playing ambience playlist. Paged by the offset and limit query arguments'''
+        return self.current_funcs('ambience', 'playlist', offset=offset, limit=limit)
 
     @api
-    def ambience_history(self):
-        '''Returns up to 100 of the last played tracks for a player'''
-        return self.history_funcs('ambience')
+    @query('offset', 'limit')
+    @etag(lambda self: self.audio_players.history.version('ambience'))
+    def ambience_history(self, offset=0, limit=0):
+        '''Returns the last ambience tracks played, with when and how long. Paged back from the newest by the offset and limit query arguments'''
+        return self.history_funcs('ambience', offset=offset, limit=limit)
 
     @admin
     @api
@@ -545,13 +731,12 @@ class InputHandler:
 
     @admin
     @api
-    @patience
+    @patience(player='clips')
     @patience_flag
     def clips_now(self):
         '''Schedule a clip to be played now'''
         if not self.audio_players.clips_thread.clips_on:
             return self.make_output_data('clips not enabled. try /clips/toggle first', err=True)
 
-        now = datetime.datetime.today()
-        self.audio_players.clips_thread.clip_schedule = now
-        return self.make_output_data('clip scheduled for ' + str(now)[:-7:])
+        now = self.audio_players.clips_thread.play_now()
+        return self.make_output_data('clip scheduled for ' + now.strftime('%Y-%m-%d %H:%M:%S'))
@@ -0,0 +1,122 @@
+######################################################################
+#
+#   Job Queue
+#
+#   1. Defines Job class
+#       State, progress and result of one command
+#   2. Defines JobQueue class
+#       Runs commands in a pool of worker threads
+#       Keeps the most recent jobs for status queries
+#       Reports job changes to callbacks (websocket notifications)
+#
+######################################################################
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Lock, local
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+#   the Job run by the current worker thread, for report_progress()
+current = local()
+
+
+######################################################################
+#
+#   1. Defines Job class
+#
+######################################################################
+class Job:
+    '''A command run by a JobQueue.
+    state is queued, running, done or failed. result is the command's output data'''
+    def __init__(self, job_id, name):
+        self.id = job_id
+        self.name = name
+        self.state = 'queued'
+        self.progress = None
+        self.result = None
+        self.created = datetime.datetime.now()
+        self.started = None
+        self.finished = None
+
+    def status(self):
+        '''Returns the job as a JSON serialisable dict'''
+        return {
+            'id'        :self.id,
+            'name'      :self.name,
+            'state'     :self.state,
+            'progress'  :self.progress,
+            'result'    :self.result,
+            'created'   :self.created.strftime(TIME_FORMAT),
+            'started'   :self.started.strftime(TIME_FORMAT) if self.started else None,
+            'finished'  :self.finished.strftime(TIME_FORMAT) if self.finished else None
+        }
+
+
+######################################################################
+#
+#   2. Defines JobQueue class
+#
+######################################################################
+class JobQueue:
+    '''Runs commands in worker threads and keeps the last max_jobs of them.
+    callbacks(job) are called whenever a job changes state or reports progress'''
+    def __init__(self, workers=2, max_jobs=100):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.ids = count(1)
+        self.lock = Lock()
+        self.callbacks = []
+
+    def submit(self, name, func, *args, **kwargs):
+        '''Queues func(*args, **kwargs). Returns its Job'''
+        with self.lock:
+            job = Job(next(self.ids), name)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.notify(job)
+        self.pool.submit(self.run, job, func, args, kwargs)
+        return job
+
+    def run(self, job, func, args, kwargs):
+        job.state = 'running'
+        job.started = datetime.datetime.now()
+        self.notify(job)
+        current.job, current.queue = job, self
+        try:
+            job.result = func(*args, **kwargs)
+            job.state = 'failed' if type(job.result) == dict and job.result.get('err') else 'done'
+        except Exception as e:
+            job.result = {'err':True, 'msg':str(e), 'data':None}
+            job.state = 'failed'
+        finally:
+            current.job = None
+            job.finished = datetime.datetime.now()
+            self.notify(job)
+
+    def status(self, job_id):
+        '''Returns the status of a job, or None if unknown or forgotten'''
+        job = self.jobs.get(job_id)
+        return job.status() if job else None
+
+    def statuses(self):
+        '''Returns the status of every kept job, newest first'''
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job.status() for job in reversed(jobs)]
+
+    def notify(self, job):
+        for callback in self.callbacks:
+            try:
+                callback(job)
+            except Exception:
+                pass
+
+def report_progress(progress):
+    '''Sets the progress of the job this thread is running, if any'''
+    job = getattr(current, 'job', None)
+    if job is not None:
+        job.progress = progress
+        current.queue.notify(job)
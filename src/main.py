@@ -4,17 +4,19 @@
 #
 #       1. Imports config.yaml data
 #       2. Creates Flask app
-#       3. Creates AudioPlayers and InputHandler instances
+#       3. Creates AudioPlayers and InputHandler instances for each station
 #       4. Converts InputHandler API functions to Resources and binds them to Flask App
-#       5. Binds Admin Resource to Flask App
+#       5. Binds Admin and Job Resources to Flask App
 #       6. Optionally binds Web UI Resources to Flask App
-#       7. Runs the API
+#       7. Runs the API until interrupted or terminated
 #
 ######################################################################
 import player_backend
 import io_functions
 import flask_resources
 import os
+import signal
+from threading import Thread
 from flask import Flask, make_response
 from flask_restful import Api
 from string import ascii_uppercase, digits
@@ -52,6 +54,7 @@ if options.config_file and os.path.isfile(options.config_file):
     config_data = player_backend.load_config(config_file=options.config_file)
 else:
     config_data = player_backend.load_config()
+player_backend.startup_timer.mark('config validated')
 
 
 ######################################################################
@@ -69,24 +72,39 @@ flask_resources.limiter.init_app(app)
 
 ######################################################################
 #
-#       3. Creates AudioPlayers and InputHandler instances
+#       3. Creates AudioPlayers and InputHandler instances for each station
+#
+#       Stations share one VLC instance, media library and tag cache
+#       Without stations in the config there is one, named ''
 #
 ######################################################################
-players_instance = player_backend.AudioPlayers(config_data)
-ih = io_functions.InputHandler(players_instance)
+station_configs = player_backend.station_configs(config_data)
+shared_media = player_backend.SharedMedia(config_data, station_configs)
+stations = {}   # name: InputHandler
+for station_conf in station_configs:
+    stations[station_conf['name']] = io_functions.InputHandler(player_backend.AudioPlayers(station_conf, shared_media))
+ih = next(iter(stations.values()))
+player_backend.startup_timer.mark('players created')
 
 
 ######################################################################
 #
 #       4. Converts InputHandler API functions to Resources and binds them to Flask App
 #
+#       The first station is at /api/, every station at /api/<station>/
+#       Binding the first station twice is intended: the web UI and
+#       single station clients use /api/ whatever the station is named
+#
 ######################################################################
 flask_resources.bind_flask_resources(api, ih)
+for name, station_ih in stations.items():
+    if name:
+        flask_resources.bind_flask_resources(api, station_ih, station=name)
 
 
 ######################################################################
 #
-#       5. Binds Admin Resource to Flask App
+#       5. Binds Admin and Job Resources to Flask App
 #
 ######################################################################
 api.add_resource(
@@ -94,6 +112,19 @@ api.add_resource(
     '/api/admin',
     resource_class_kwargs={'password': config_data['admin_password']}
 )
+api.add_resource(
+    flask_resources.Job,
+    '/api/jobs/<int:job_id>',
+    resource_class_kwargs={'jobs': ih.jobs}
+)
+for name, station_ih in stations.items():
+    if name:
+        api.add_resource(
+            flask_resources.Job,
+            '/api/' + name + '/jobs/<int:job_id>',
+            endpoint='job_' + name,
+            resource_class_kwargs={'jobs': station_ih.jobs}
+        )
 
 
 ######################################################################
@@ -102,15 +133,35 @@ api.add_resource(
 #
 ######################################################################
 if config_data['web_ui']:
-    flask_resources.web_ui_adder(api)
+    flask_resources.web_ui_adder(api, reload=config_data['web_ui_reload'])
 
 
 ######################################################################
 #
-#       7. Runs the API
+#       7. Runs the API until interrupted or terminated
+#
+#       waitress:    waitress's pool of server_conf['threads'] threads
+#       development: Flask's development server
+#       Every mode serves from this process, the only owner of the AudioPlayers
 #
 ######################################################################
 print(ascii_splash)
-app.run(host=config_data['interface'], port=config_data['io_port'], debug=False)
-#   Safe exit to end processes correctly
-players_instance.nice_quit()
+#   SIGTERM (docker stop, supervisord) unwinds the server like Ctrl+C
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+server_conf = config_data['server']
+player_backend.startup_timer.mark('api bound')
+try:
+    if server_conf['mode'] == 'waitress':
+        from waitress import serve
+        serve(app, host=config_data['interface'], port=config_data['io_port'], threads=server_conf['threads'])
+    else:
+        app.run(host=config_data['interface'], port=config_data['io_port'], debug=False)
+except KeyboardInterrupt:
+    pass
+finally:
+    #   Safe exit to end processes correctly, fading out every station together
+    quits = [Thread(target=station_ih.audio_players.nice_quit) for station_ih in stations.values()]
+    for quit_thread in quits:
+        quit_thread.start()
+    for quit_thread in quits:
+        quit_thread.join()
@@ -0,0 +1,619 @@
+######################################################################
+#
+#   Media Library
+#
+#   1. Defines the on-disk index schema
+#   2. Defines MediaLibrary class
+#       SQLite index of audio files keyed by path (with mtime & size)
+#       Refreshed incrementally by comparing directory mtimes
+#       Answers directory queries with index range scans
+#   3. Defines Inotify class
+#       ctypes wrapper of the Linux inotify API
+#   4. Define LibraryWatcher Thread
+#       Keeps the MediaLibrary live with inotify, or polling otherwise
+#       Reports added and removed audio files to callbacks
+#   5. Define TagCache class
+#       Persistent artist/title/duration cache keyed by track id & mtime
+#       Files are parsed by libvlc in a worker pool
+#
+######################################################################
+import os
+import re
+import sys
+import errno
+import select
+import struct
+import sqlite3
+import ctypes
+import ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, RLock, Event
+from time import sleep
+from urllib.parse import unquote
+
+import vlc
+
+AUDIO_FILE_EXTENSIONS = {'mp3', 'wav', 'flac', 'ogg', 'oga', 'opus', 'm4a', 'aac'}
+
+
+######################################################################
+#
+#   1. Defines the on-disk index schema
+#
+######################################################################
+#   tracks rows are never deleted so a track's id stays stable.
+#   Files that disappear from disk are only marked as not indexed.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path    TEXT PRIMARY KEY,
+    parent  TEXT,
+    mtime   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS tracks (
+    id      INTEGER PRIMARY KEY,
+    path    TEXT NOT NULL UNIQUE,
+    dir     TEXT,
+    mtime   REAL,
+    size    INTEGER,
+    indexed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tracks_dir ON tracks (dir);
+CREATE TABLE IF NOT EXISTS tags (
+    track_id    INTEGER PRIMARY KEY,
+    mtime       REAL,
+    artist      TEXT,
+    title       TEXT,
+    url         TEXT,
+    duration    INTEGER,
+    renamed     INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key     TEXT PRIMARY KEY,
+    value   TEXT
+);
+'''
+
+
+######################################################################
+#
+#   2. Defines MediaLibrary class
+#
+######################################################################
+def audio_file_re(allowed_file_extensions):
+    '''Compiles a regular expression matching files with the allowed extensions'''
+    return re.compile(r'\.(?:' + '|'.join(sorted(allowed_file_extensions)) + r')$', re.IGNORECASE)
+
+def chunks(items, size=500):
+    '''Splits a list to stay below the SQLite host parameter limit'''
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def path_range(directory):
+    '''Returns the (low, high) bounds of every path below a directory
+    input: /fm/music
+    output: '/fm/music/', '/fm/music0' '''
+    directory = directory.rstrip(os.sep)
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)
+
+class MediaLibrary:
+    '''An on-disk index of the audio files below any directory it is asked about.
+    A directory is only listed again when its mtime changes. Otherwise its known
+    subdirectories are checked, so a refresh costs one stat per directory rather
+    than a listdir and stat per file.
+    Every directory is listed again when the allowed extensions change'''
+    def __init__(self, index_file, allowed_file_extensions=AUDIO_FILE_EXTENSIONS):
+        self.lock = RLock()
+        self.db = sqlite3.connect(index_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        if 'renamed' not in [column[1] for column in self.db.execute('PRAGMA table_info(tags)')]:
+            self.db.execute('ALTER TABLE tags ADD COLUMN renamed INTEGER')
+        self.re_audio_file = audio_file_re(allowed_file_extensions)
+        self.live_dirs = set()
+
+        extensions = ','.join(sorted(allowed_file_extensions))
+        with self.db:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'extensions'").fetchone()
+            if not row or row[0] != extensions:
+                self.db.execute('DELETE FROM dirs')
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('extensions', ?)", (extensions,))
+
+    def is_live(self, directory):
+        '''Checks if a directory is kept up to date by a LibraryWatcher'''
+        directory = os.path.abspath(directory)
+        return any(
+            directory == live_dir or directory.startswith(live_dir.rstrip(os.sep) + os.sep)
+            for live_dir in self.live_dirs
+        )
+
+    def refresh(self, directory, force=False, progress=None):
+        '''Brings the index of a directory tree up to date.
+        Skipped for live directories unless forced.
+        progress(message) is called every 100 directories scanned.
+        Directories are listed without the lock, and each is committed on its
+        own, so a first index of a large tree does not hold up other readers.
+        Returns the lists of added and removed audio files'''
+        directory = os.path.abspath(directory)
+        added, removed = [], []
+        if self.is_live(directory) and not force:
+            return added, removed
+
+        stack = [directory]
+        scanned = 0
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                removed += self.forget_dir(path)
+                continue
+
+            with self.lock:
+                row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?', (path,)).fetchone()
+                if row and row[0] == mtime:
+                    stack += [sub_dir for (sub_dir,) in self.db.execute(
+                        'SELECT path FROM dirs WHERE parent = ?', (path,)
+                    )]
+                    continue
+            stack += self.scan_dir(path, mtime, added, removed)
+            scanned += 1
+            if progress and scanned % 100 == 0:
+                progress(f'{scanned} directories indexed, {len(added)} files added')
+        return added, removed
+
+    def scan_dir(self, directory, mtime, added, removed):
+        '''Lists a single directory, then updates its index in one transaction.
+        Extends the added and removed lists. Returns its subdirectories'''
+        files = {}
+        sub_dirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            sub_dirs.append(entry.path)
+                        elif entry.is_file() and self.re_audio_file.search(entry.name):
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime, stat.st_size)
+                    except OSError:
+                        pass
+        except OSError:
+            removed += self.forget_dir(directory)
+            return []
+
+        with self.lock, self.db:
+            self.index_dir(directory, mtime, files, sub_dirs, added, removed)
+        return sub_dirs
+
+    def index_dir(self, directory, mtime, files, sub_dirs, added, removed):
+        '''Stores a listed directory's audio files {path: (mtime, size)} and subdirectories'''
+        known_files = {
+            path:(file_mtime, size) for path, file_mtime, size in self.db.execute(
+                'SELECT path, mtime, size FROM tracks WHERE dir = ? AND indexed = 1', (directory,)
+            )
+        }
+        self.db.executemany(
+            'INSERT INTO tracks (path, dir, mtime, size, indexed) VALUES (?, ?, ?, ?, 1) '
+            'ON CONFLICT(path) DO UPDATE SET dir = excluded.dir, mtime = excluded.mtime, '
+            'size = excluded.size, indexed = 1',
+            [
+                (path, directory, file_mtime, size)
+                for path, (file_mtime, size) in files.items()
+                if known_files.get(path) != (file_mtime, size)
+            ]
+        )
+        added += [path for path in files if path not in known_files]
+        gone = [path for path in known_files if path not in files]
+        self.db.executemany('UPDATE tracks SET indexed = 0 WHERE path = ?', [(path,) for path in gone])
+        removed += gone
+
+        for (sub_dir,) in self.db.execute('SELECT path FROM dirs WHERE parent = ?', (directory,)).fetchall():
+            if sub_dir not in sub_dirs:
+                removed += self.forget_dir(sub_dir)
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)',
+            (directory, os.path.dirname(directory), mtime)
+        )
+
+    def forget_dir(self, directory):
+        '''Removes a directory tree from the index.
+        Returns the removed audio files'''
+        low, high = path_range(directory)
+        with self.lock, self.db:
+            removed = [path for (path,) in self.db.execute(
+                'SELECT path FROM tracks WHERE indexed = 1 AND path >= ? AND path < ?',
+                (low, high)
+            )]
+            self.db.execute(
+                'DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+                (directory, low, high)
+            )
+            self.db.execute(
+                'UPDATE tracks SET indexed = 0 WHERE path >= ? AND path < ?',
+                (low, high)
+            )
+        return removed
+
+    def add_file(self, path):
+        '''Indexes a single audio file. Returns True if it was not indexed before'''
+        if not self.re_audio_file.search(path):
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        with self.lock, self.db:
+            row = self.db.execute('SELECT indexed FROM tracks WHERE path = ?', (path,)).fetchone()
+            self.db.execute(
+                'INSERT INTO tracks (path, dir, mtime, size, indexed) VALUES (?, ?, ?, ?, 1) '
+                'ON CONFLICT(path) DO UPDATE SET dir = excluded.dir, mtime = excluded.mtime, '
+                'size = excluded.size, indexed = 1',
+                (path, os.path.dirname(path), stat.st_mtime, stat.st_size)
+            )
+        return not (row and row[0])
+
+    def remove_file(self, path):
+        '''Removes a single audio file. Returns True if it was indexed'''
+        with self.lock, self.db:
+            return self.db.execute(
+                'UPDATE tracks SET indexed = 0 WHERE path = ? AND indexed = 1', (path,)
+            ).rowcount > 0
+
+    def audio_file_ids(self, directory):
+        '''Returns the ids of the indexed audio files below a directory, sorted by path'''
+        low, high = path_range(os.path.abspath(directory))
+        with self.lock:
+            return [track_id for (track_id,) in self.db.execute(
+                'SELECT id FROM tracks WHERE indexed = 1 AND path >= ? AND path < ? ORDER BY path',
+                (low, high)
+            )]
+
+    def track_ids(self, paths):
+        '''Returns the ids of a list of paths or MRLs, adding any not yet known'''
+        ids = {}
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO tracks (path) VALUES (?)', [(path,) for path in paths])
+            for chunk in chunks(list(set(paths))):
+                ids.update(self.db.execute(
+                    'SELECT path, id FROM tracks WHERE path IN (' + ','.join('?' * len(chunk)) + ')',
+                    chunk
+                ))
+        return [ids[path] for path in paths]
+
+    def paths(self, track_ids):
+        '''Returns a dictionary of track id: path'''
+        paths = {}
+        with self.lock:
+            for chunk in chunks(list(set(track_ids))):
+                paths.update(self.db.execute(
+                    'SELECT id, path FROM tracks WHERE id IN (' + ','.join('?' * len(chunk)) + ')',
+                    chunk
+                ))
+        return paths
+
+    def sub_dirs(self, directory):
+        '''Returns a directory and every indexed directory below it'''
+        directory = os.path.abspath(directory)
+        low, high = path_range(directory)
+        with self.lock:
+            return [directory] + [path for (path,) in self.db.execute(
+                'SELECT path FROM dirs WHERE path >= ? AND path < ?', (low, high)
+            )]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+######################################################################
+#
+#   3. Defines Inotify class
+#
+######################################################################
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+class Inotify:
+    '''Minimal inotify binding. Raises OSError where inotify is unavailable'''
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        '''Returns a watch descriptor'''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        '''Waits up to timeout seconds and returns a list of (wd, mask, cookie, name)'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        buffer = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = self.event_header.unpack_from(buffer, offset)
+            offset += self.event_header.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+######################################################################
+#
+#   4. Define LibraryWatcher Thread
+#
+######################################################################
+class LibraryWatcher(Thread):
+    '''Keeps the MediaLibrary index of some directories live.
+    inotify reports file changes as they happen. Where inotify is unavailable,
+    or runs out of watches, the directories are refreshed every poll_interval seconds.
+    Every batch of changes is passed to the callbacks as callback(added, removed)'''
+    def __init__(self, library, directories, poll_interval=60, debug=False):
+        super(LibraryWatcher, self).__init__()
+        self.daemon = True
+        self.library = library
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.poll_interval = poll_interval
+        self.debug = debug
+        self.callbacks = []
+        self.exit_program = False
+
+        self.inotify = None
+        self.watches = {}   # wd: directory
+
+    def eprint(self, *args):
+        if self.debug:
+            print(*args, file=sys.stderr)
+
+    def notify(self, added, removed):
+        if added or removed:
+            self.eprint(f'Library changed: {len(added)} added, {len(removed)} removed')
+            for callback in self.callbacks:
+                try:
+                    callback(added, removed)
+                except Exception as e:
+                    self.eprint(f'Library callback failed: {e}')
+
+    def watch_tree(self, directory):
+        '''Adds inotify watches to every indexed directory below directory'''
+        for path in self.library.sub_dirs(directory):
+            self.watches[self.inotify.add_watch(path)] = path
+
+    def unwatch_tree(self, directory):
+        prefix = directory.rstrip(os.sep) + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def start_inotify(self):
+        '''Returns True if every directory is now watched'''
+        try:
+            self.inotify = Inotify()
+            for directory in self.directories:
+                self.notify(*self.library.refresh(directory, force=True))
+                self.watch_tree(directory)
+                # catch changes made while the watches were being added
+                self.notify(*self.library.refresh(directory, force=True))
+                self.library.live_dirs.add(directory)
+            return True
+        except OSError as e:
+            self.eprint(f'Library watcher falling back to polling: {e}')
+            self.library.live_dirs.clear()
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+            return False
+
+    def handle_event(self, wd, mask, name, added, removed):
+        if mask & IN_Q_OVERFLOW:
+            for directory in self.directories:
+                a, r = self.library.refresh(directory, force=True)
+                added += a
+                removed += r
+            return
+        if wd not in self.watches:
+            return
+        if mask & (IN_IGNORED | IN_DELETE_SELF):
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+            return
+
+        path = os.path.join(self.watches[wd], name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                a, r = self.library.refresh(path, force=True)
+                added += a
+                removed += r
+                self.watch_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatch_tree(path)
+                removed += self.library.forget_dir(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            if self.library.add_file(path):
+                added.append(path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if self.library.remove_file(path):
+                removed.append(path)
+
+    def run_inotify(self):
+        while not self.exit_program:
+            added, removed = [], []
+            try:
+                for wd, mask, cookie, name in self.inotify.read_events(1):
+                    self.handle_event(wd, mask, name, added, removed)
+            except OSError as e:
+                # most likely out of watches for a new directory
+                self.eprint(f'Library watcher error: {e}')
+                self.library.live_dirs.clear()
+                self.inotify.close()
+                self.inotify = None
+                return
+            finally:
+                # a file removed then re-added within one batch is neither
+                added_set, removed_set = set(added), set(removed)
+                self.notify(
+                    [path for path in added if path not in removed_set],
+                    [path for path in removed if path not in added_set]
+                )
+
+    def run_polling(self):
+        while not self.exit_program:
+            for directory in self.directories:
+                self.notify(*self.library.refresh(directory, force=True))
+            for _ in range(int(self.poll_interval)):
+                if self.exit_program:
+                    return
+                sleep(1)
+
+    def run(self):
+        if self.start_inotify():
+            self.run_inotify()
+        self.run_polling()
+
+
+######################################################################
+#
+#   5. Define TagCache class
+#
+######################################################################
+def short_mrl(mrl):
+    '''Shortens file paths and file:// MRLs to their last directory and file name'''
+    if re.search('^file://', mrl):
+        return unquote('/'.join(mrl.split('/')[-2::]))
+    elif mrl.startswith(os.sep):
+        return '/'.join(mrl.split(os.sep)[-2::])
+    return mrl
+
+def song_name(artist, title, url, mrl):
+    '''returns as nice a string as possible for a track'''
+    if artist:
+        return artist + ' - ' + str(title)
+    elif url:
+        return url
+    else:
+        return short_mrl(mrl)
+
+class TagCache:
+    '''Artist, title, URL and duration of the tracks in a MediaLibrary, stored in its
+    index file. An entry is valid while the file's mtime is unchanged. Missing or stale
+    entries are parsed by libvlc in a pool of worker threads, and the file name is
+    used meanwhile. Tracks without an mtime (URLs, files outside the audio
+    directories) are parsed once.
+    A tag row's renamed is the generation at which a parse last changed the track's
+    nice string, so callers can tell if the tracks they were waiting on have changed.
+    generation carries on from the index file's, so it only goes up'''
+    def __init__(self, library, instance, workers=4, timeout=5):
+        self.library = library
+        self.instance = instance
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tags')
+        self.pending = set()
+        with library.lock:
+            self.generation = library.db.execute('SELECT MAX(renamed) FROM tags').fetchone()[0] or 0
+
+    def songs(self, track_ids, waiting=None):
+        '''Returns the nice strings of a list of track ids, queueing parses of any not cached.
+        The ids of tracks queued or being parsed are added to the set waiting, if given'''
+        rows = {}
+        with self.library.lock:
+            for chunk in chunks(list(set(track_ids))):
+                for row in self.library.db.execute(
+                    'SELECT tracks.id, tracks.path, tracks.mtime, tags.track_id, tags.mtime, artist, title, url '
+                    'FROM tracks LEFT JOIN tags ON tags.track_id = tracks.id '
+                    'WHERE tracks.id IN (' + ','.join('?' * len(chunk)) + ')',
+                    chunk
+                ):
+                    rows[row[0]] = row
+
+        for track_id, path, mtime, tagged, tag_mtime, artist, title, url in rows.values():
+            # a NULL mtime matches a NULL mtime, so files without one are parsed once
+            if path.startswith(os.sep) and (tagged is None or tag_mtime != mtime):
+                self.queue(track_id, path, mtime)
+                if waiting is not None:
+                    waiting.add(track_id)
+        return [
+            song_name(*rows[track_id][5:], rows[track_id][1]) if track_id in rows else str(track_id)
+            for track_id in track_ids
+        ]
+
+    def renamed_since(self, track_ids):
+        '''Returns the last generation any of track_ids changed its nice string at, or 0'''
+        renamed = 0
+        with self.library.lock:
+            for chunk in chunks(list(set(track_ids))):
+                renamed = max(renamed, self.library.db.execute(
+                    'SELECT MAX(renamed) FROM tags WHERE track_id IN (' + ','.join('?' * len(chunk)) + ')',
+                    chunk
+                ).fetchone()[0] or 0)
+        return renamed
+
+    def song(self, track_id):
+        return self.songs([track_id])[0]
+
+    def duration(self, track_id):
+        '''Returns the cached duration of a track in milliseconds, or None'''
+        with self.library.lock:
+            row = self.library.db.execute('SELECT duration FROM tags WHERE track_id = ?', (track_id,)).fetchone()
+        return row[0] if row else None
+
+    def queue(self, track_id, path, mtime):
+        if track_id not in self.pending:
+            self.pending.add(track_id)
+            self.pool.submit(self.parse, track_id, path, mtime)
+
+    def parse(self, track_id, path, mtime):
+        '''Parses a file with libvlc and stores its tags'''
+        try:
+            media = self.instance.media_new(path)
+            parsed = Event()
+            event_manager = media.event_manager()
+            event_manager.event_attach(vlc.EventType.MediaParsedChanged, lambda event: parsed.set())
+            if media.parse_with_options(vlc.MediaParseFlag.local, int(self.timeout * 1000)) == 0:
+                parsed.wait(self.timeout + 1)
+
+            duration = media.get_duration()
+            artist, title, url = media.get_meta(vlc.Meta.Artist), media.get_meta(vlc.Meta.Title), media.get_meta(vlc.Meta.URL)
+            with self.library.lock, self.library.db:
+                old = self.library.db.execute(
+                    'SELECT artist, title, url, renamed FROM tags WHERE track_id = ?', (track_id,)
+                ).fetchone() or (None, None, None, None)
+                renamed = old[3]
+                if song_name(artist, title, url, path) != song_name(*old[:3], path):
+                    self.generation += 1
+                    renamed = self.generation
+                self.library.db.execute(
+                    'INSERT OR REPLACE INTO tags (track_id, mtime, artist, title, url, duration, renamed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (track_id, mtime, artist, title, url, duration if duration > 0 else None, renamed)
+                )
+            media.release()
+        finally:
+            self.pending.discard(track_id)
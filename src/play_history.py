@@ -0,0 +1,143 @@
+######################################################################
+#
+#   Play History
+#
+#   1. Defines PlayHistory class
+#       A fixed size ring of the last tracks played per player
+#       Each entry: time started, library track id, track and seconds played
+#       Finished entries are appended to a JSON lines log, flushed
+#       every flush_interval seconds, and reloaded on start
+#
+######################################################################
+import os
+import json
+import datetime
+from collections import deque
+from threading import Lock, Timer
+from time import time
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+######################################################################
+#
+#   1. Defines PlayHistory class
+#
+######################################################################
+class PlayHistory:
+    '''The last size tracks played by each player, oldest first.
+    The current track's entry has played None until the next track starts.
+    log_file is append-only, and rewritten with just the kept entries on
+    start once it holds more than compact_factor times them.
+    version(player) changes whenever the player's entries do'''
+    def __init__(self, players, size=100, log_file='', flush_interval=10, compact_factor=10):
+        self.size = size
+        self.log_file = log_file
+        self.flush_interval = flush_interval
+        self.compact_factor = compact_factor
+        self.lock = Lock()
+        self.entries = {player:deque(maxlen=size) for player in players}
+        self.started = {player:None for player in players}     # time() the current entry started
+        self.changes = {player:0 for player in players}
+        self.epoch = int(time())    # versions of a restarted process differ
+        self.pending = []       # log lines not yet written
+        self.last_flush = time()
+        self.flush_timer = None
+        if self.log_file:
+            self.load()
+
+    def load(self):
+        '''Fills the rings from the log, compacting it if it has grown too long'''
+        if not os.path.isfile(self.log_file):
+            return
+        lines = 0
+        with open(self.log_file) as log:
+            for line in log:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('player') in self.entries:
+                    self.entries[entry.pop('player')].append(entry)
+        if lines > self.compact_factor * self.size * len(self.entries):
+            tmp_file = self.log_file + '.tmp'
+            with open(tmp_file, 'w') as log:
+                for player, entries in self.entries.items():
+                    for entry in entries:
+                        log.write(json.dumps(dict(entry, player=player)) + '\n')
+            os.replace(tmp_file, self.log_file)
+
+    def append(self, player, track_id, track):
+        '''Ends the player's current entry and starts one for a new track.
+        Returns the changed entries: the ended one, if any, then the new one'''
+        now = time()
+        changed = []
+        with self.lock:
+            entries = self.entries[player]
+            if entries and self.started[player] is not None:
+                entries[-1]['played'] = round(now - self.started[player], 1)
+                self.pending.append(json.dumps(dict(entries[-1], player=player)))
+                changed.append(dict(entries[-1]))
+            entry = {
+                'time'  :datetime.datetime.fromtimestamp(now).strftime(TIME_FORMAT),
+                'id'    :track_id,
+                'track' :track,
+                'played':None
+            }
+            entries.append(entry)
+            self.started[player] = now
+            self.changes[player] += 1
+            if now - self.last_flush >= self.flush_interval:
+                self.flush_locked()
+            elif self.pending and self.flush_timer is None:
+                self.flush_timer = Timer(self.flush_interval - (now - self.last_flush), self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+            return changed + [dict(entry)]
+
+    def version(self, player):
+        '''Returns a string which changes whenever the player's entries do'''
+        return f'{self.epoch}.{self.changes[player]}'
+
+    def page(self, player, offset=0, limit=0):
+        '''Returns (entries, total): limit entries (0 for all) ending offset entries before the newest, oldest first'''
+        with self.lock:
+            entries = list(self.entries[player])
+        end = len(entries) - offset
+        start = max(0, end - limit) if limit else 0
+        return [dict(entry) for entry in entries[start:max(0, end)]], len(entries)
+
+    def flush(self):
+        '''Writes the finished entries to the log'''
+        with self.lock:
+            self.flush_locked()
+
+    def close(self):
+        '''Ends the current entries and writes them all to the log'''
+        now = time()
+        with self.lock:
+            for player, entries in self.entries.items():
+                if entries and self.started[player] is not None:
+                    entries[-1]['played'] = round(now - self.started[player], 1)
+                    self.pending.append(json.dumps(dict(entries[-1], player=player)))
+                    self.started[player] = None
+                    self.changes[player] += 1
+            self.flush_locked()
+
+    def flush_locked(self):
+        self.last_flush = time()
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if not self.log_file or not self.pending:
+            self.pending.clear()
+            return
+        try:
+            with open(self.log_file, 'a') as log:
+                log.write('\n'.join(self.pending) + '\n')
+        except OSError:
+            # keep what the rings hold for the next try
+            del self.pending[:-self.size * len(self.entries)]
+            return
+        self.pending.clear()
@@ -4,16 +4,20 @@
 #
 #   1. Defines config.yaml loader & validation functions
 #   2. Define functions for VLC library classes
-#   3. Define nofication websockets server class
-#   4. Define AudioPlayers class
-#       4 VLC Instances
-#           1 Streams the pulse audio virtual sink
-#           3 Audio players that play to the virtual sink
+#   3. Define Playlist class
+#       Track order as an array of MediaLibrary ids
+#       Materialised into a vlc.MediaList once per change
+#   4. Define nofication websockets server class
+#   5. Define AudioPlayers class
+#       SharedMedia: the VLC instance, library and tag cache of all stations
+#       4 VLC players per station (AudioPlayers)
+#           1 Streams the station's pulse audio sink
+#           3 Audio players that play to the station's sink
 #               1. Music
 #               2. Ambience
 #               3. Clips
 #       1 ClipsThread
-#   5. Define ClipsThread Thread
+#   6. Define ClipsThread Thread
 #       Manages clip playing times
 #
 ######################################################################
@@ -21,33 +25,85 @@ from __future__ import print_function
 import os
 import re
 import sys
+import copy
 import datetime
 import socket
 import asyncio
-from threading import Thread
+import json
+import heapq
+from itertools import count
+from array import array
+from threading import Thread, RLock, Lock, Event, Condition
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
 from time import sleep, time
 from random import choice, normalvariate, shuffle
 from urllib.parse import unquote
 import yaml
 
 import websockets
-from websockets.protocol import State
 import vlc
+from media_library import MediaLibrary, LibraryWatcher, TagCache, AUDIO_FILE_EXTENSIONS, audio_file_re, song_name, short_mrl
+from play_history import PlayHistory
+from volume_scheduler import VolumeScheduler
+from clip_pool import ClipPool
+from stream_relay import StreamRelay
 #   "media list player is a layer of inconvenience that you're better off not using"
 #               - anon, #VideoLAN:matrix.org #videolan at freenode or irc.videolan.org
 
-os.environ['PULSE_SINK'] = 'virtual'
 Debug = True
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+class StartupTimer:
+    '''Records when each startup phase finished, in seconds since import
+    (process start), so time to first audio can be measured'''
+    def __init__(self):
+        self.start = time()
+        self.phases = {}    # phase: seconds, in the order they finished
+        self.lock = Lock()
+
+    def mark(self, phase):
+        '''Records a phase the first time it finishes'''
+        with self.lock:
+            if phase in self.phases:
+                return
+            self.phases[phase] = round(time() - self.start, 3)
+        if Debug:
+            eprint(f'Startup: {phase} after {self.phases[phase]:.2f}s')
+
+    def report(self):
+        with self.lock:
+            return dict(self.phases)
+
+startup_timer = StartupTimer()
+
 
 ######################################################################
 #
 #   1. Defines config.yaml loader & validation functions
 #
 ######################################################################
+def is_optional(validator_conf):
+    '''Checks if a config key, or every key of a config section, is optional'''
+    if 'validator' in validator_conf:
+        return validator_conf.get('optional', False)
+    return all(is_optional(validator_conf[subkey]) for subkey in validator_conf)
+
+def fill_optional(validator_conf, test_conf):
+    '''Sets missing optional config keys to their defaults'''
+    for key in validator_conf:
+        if key not in test_conf:
+            if not is_optional(validator_conf[key]):
+                continue
+            elif 'validator' in validator_conf[key]:
+                test_conf[key] = copy.deepcopy(validator_conf[key]['default'])
+            else:
+                test_conf[key] = {}
+        if 'validator' not in validator_conf[key] and type(test_conf[key]) == dict:
+            fill_optional(validator_conf[key], test_conf[key])
+
 def check_missing(key, validator_conf, test_conf):
     '''Checks for missing config keys'''
     if key not in test_conf:
@@ -113,34 +169,26 @@ def check_directory(directory):
         return True
     return False
 
-def check_mrl(mrl, max_time_to_wait=10):
-    # This will check if the MRL is playable
-    # It checks every quarter second if it plays, and if so, returns
-    test_instance = vlc.Instance()
-    player = test_instance.media_player_new()
-    player.audio_set_volume(0)
-
-    if os.path.isdir(mrl):
-        media = test_instance.media_new(audio_file_dir_walk(mrl, just_one=True))
-    else:
-        media = test_instance.media_new(mrl)
-
-    player.set_media(media)
-
-
-    player.play()
-
-    start_time = time()
-    played = False
-    while time() - start_time < max_time_to_wait:
-        if player.get_state() == vlc.State.Playing:
-            sleep(0.25)
-            played = player.get_state() == vlc.State.Playing
-            break
+def check_index_file(index_file):
+    '''Check the media library index can be created'''
+    if not os.path.isdir(os.path.dirname(index_file)):
+        eprint('Error: directory of library_index \'' + index_file + '\' does not exist')
+        return True
+    if not os.access(os.path.dirname(index_file), os.W_OK):
+        eprint('Error: directory of library_index \'' + index_file + '\' is not writeable')
+        return True
+    return False
 
-    player.stop()
+def check_history_log(log_file):
+    '''Check the history log can be written. An empty string disables it'''
+    if log_file and not os.access(os.path.dirname(log_file), os.W_OK):
+        eprint('Error: directory of history log_file \'' + log_file + '\' is not writeable')
+        return True
+    return False
 
-    return not played
+def check_mrl(mrl, max_time_to_wait=10):
+    '''Check if the MRL is playable. Results are cached by the shared MrlProber'''
+    return not MrlProber.shared().playable(mrl, timeout=max_time_to_wait)
 
 def check_clip_mean(mean_minutes):
     if mean_minutes < 1:
@@ -154,6 +202,147 @@ def check_clip_std_deviation(std_deviation_minutes):
         return True
     return False
 
+def check_clip_pools(pools):
+    '''Check each clip pool is a directory with a positive weight and hours [start, end]'''
+    for pool in pools:
+        if type(pool) != dict or type(pool.get('directory', '.')) != str:
+            eprint('Error: each clip pool needs a directory, relative to the clips directory. Got ' + str(pool))
+            return True
+        if type(pool.get('weight', 1)) not in [int, float] or pool.get('weight', 1) <= 0:
+            eprint('Error: clip pool weight must be > 0. Got ' + str(pool.get('weight')))
+            return True
+        hours = pool.get('hours', [0, 24])
+        if type(hours) != list or len(hours) != 2 or not all(type(hour) == int and 0 <= hour <= 24 for hour in hours):
+            eprint('Error: clip pool hours must be [start, end] hours 0-24. Got ' + str(hours))
+            return True
+    return False
+
+#   codec: (VLC acodec, mux, mime type, sample rates it can encode)
+STREAM_CODECS = {
+    'mp3'   :('mp3', 'mp3', 'audio/mpeg', [32000, 44100, 48000]),
+    'opus'  :('opus', 'ogg', 'audio/ogg', [48000]),
+    'vorbis':('vorb', 'ogg', 'audio/ogg', [22050, 32000, 44100, 48000])
+}
+
+def check_stream_outputs(outputs):
+    '''Check each stream output has a known codec, a bitrate and sample rate it
+    can encode, and its own mount path on the stream port'''
+    if type(outputs) != list or not outputs:
+        eprint('Error: stream_outputs needs at least one output')
+        return True
+    mounts = []
+    for output in outputs:
+        if type(output) != dict or output.get('codec') not in STREAM_CODECS:
+            eprint('Error: each stream output needs a codec of ' + ', '.join(STREAM_CODECS) + '. Got ' + str(output))
+            return True
+        if type(output.get('bitrate')) != int or not 8 <= output['bitrate'] <= 512:
+            eprint('Error: stream output bitrate must be kbps 8-512. Got ' + str(output.get('bitrate')))
+            return True
+        if output.get('samplerate') not in STREAM_CODECS[output['codec']][3]:
+            eprint('Error: ' + output['codec'] + ' stream output samplerate must be one of ' + str(STREAM_CODECS[output['codec']][3]) + '. Got ' + str(output.get('samplerate')))
+            return True
+        if type(output.get('mount')) != str or not re.search('^/[A-Za-z0-9_./-]*$', output['mount']):
+            eprint('Error: stream output mount must be a path starting with /. Got ' + str(output.get('mount')))
+            return True
+        if output['mount'] in mounts:
+            eprint('Error: stream output mount ' + output['mount'] + ' is used twice')
+            return True
+        mounts.append(output['mount'])
+    return False
+
+#   top level config keys a station may set for itself
+STATION_KEYS = ['sink', 'stream_port', 'stream_outputs', 'stream_relay', 'websocket', 'startup_players', 'audio_dirs', 'default_files', 'clip_timing', 'clip_pools', 'history']
+
+def check_stations(stations):
+    '''Check each station has a unique name (used in its API URLs) and only station keys'''
+    names = []
+    for station in stations:
+        if type(station) != dict or not re.search('^[a-z0-9_-]+$', str(station.get('name', ''))):
+            eprint('Error: each station needs a name of lower case letters, digits, - or _. Got ' + str(station))
+            return True
+        if station['name'] in names:
+            eprint('Error: station name ' + station['name'] + ' is used twice')
+            return True
+        names.append(station['name'])
+        unknown = [key for key in station if key != 'name' and key not in STATION_KEYS]
+        if unknown:
+            eprint('Error: station ' + station['name'] + ' has unknown keys ' + ', '.join(unknown) + '. Stations may set ' + ', '.join(STATION_KEYS))
+            return True
+        if type(station.get('sink', '')) != str:
+            eprint('Error: station ' + station['name'] + ' sink must be a PulseAudio sink name')
+            return True
+    return False
+
+def station_configs(config_data):
+    '''Returns the config of each station: the top level config updated by the
+    station's keys. Without stations the top level config is the only station.
+    A station's sink defaults to its name, its history log_file to one named after it'''
+    if not config_data['stations']:
+        return [dict(config_data, name='', sink='virtual')]
+    configs = []
+    for station in config_data['stations']:
+        station_conf = copy.deepcopy(config_data)
+        station_conf['sink'] = station['name']
+        for key, value in station.items():
+            if type(value) == dict and type(station_conf.get(key)) == dict:
+                station_conf[key].update(value)
+            else:
+                station_conf[key] = value
+        if station_conf['history']['log_file'] and 'log_file' not in station.get('history', {}):
+            root, ext = os.path.splitext(config_data['history']['log_file'])
+            station_conf['history']['log_file'] = root + '-' + station['name'] + ext
+        configs.append(station_conf)
+    return configs
+
+def check_poll_interval(seconds):
+    if seconds < 1:
+        eprint('Error: poll_interval must be > 0. Got ' + str(seconds))
+        return True
+    return False
+
+def check_playlist_window(window):
+    if window < 0:
+        eprint('Error: playlist_window must be >= 0. Got ' + str(window))
+        return True
+    return False
+
+def check_tag_workers(workers):
+    if workers < 1:
+        eprint('Error: tag_workers must be > 0. Got ' + str(workers))
+        return True
+    return False
+
+def check_busy_wait(seconds):
+    if seconds < 0:
+        eprint('Error: busy_wait must be >= 0. Got ' + str(seconds))
+        return True
+    return False
+
+def check_positive(number):
+    if number <= 0:
+        eprint('Error: must be > 0. Got ' + str(number))
+        return True
+    return False
+
+def check_server_mode(mode):
+    '''Check the HTTP server mode is known and its package is installed'''
+    if mode not in ['development', 'waitress']:
+        eprint('Error: server mode must be development or waitress. Got ' + str(mode))
+        return True
+    if mode == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            eprint('Error: server mode waitress requires the waitress package (pip install waitress)')
+            return True
+    return False
+
+def check_slow_clients(policy):
+    if policy not in ['drop', 'disconnect']:
+        eprint('Error: slow_clients must be drop or disconnect. Got ' + str(policy))
+        return True
+    return False
+
 def load_config(config_file='default-config.yaml'):
     '''loads config.yaml file
     checks and reports potential errors'''
@@ -213,11 +402,13 @@ def load_config(config_file='default-config.yaml'):
         {
             'music':{
                 'default'   :'/srv/music',
-                'validator' :check_mrl
+                'validator' :check_mrl,
+                'slow'      :True
             },
             'ambience':{
                 'default'   :'/srv/ambiece',
-                'validator' :check_mrl
+                'validator' :check_mrl,
+                'slow'      :True
             }
         },
         'clip_timing':
@@ -229,6 +420,166 @@ def load_config(config_file='default-config.yaml'):
             'clip_std_deviation':{
                 'default'   :15,
                 'validator' :check_clip_std_deviation
+            },
+            'duck_seconds':{
+                'default'   :2,
+                'validator' :check_positive,
+                'optional'  :True
+            },
+            'preroll_seconds':{
+                'default'   :10,
+                'validator' :check_positive,
+                'optional'  :True
+            }
+        },
+        'clip_pools':{
+            'default'   :[],
+            'validator' :check_clip_pools,
+            'optional'  :True
+        },
+        'stream_outputs':{
+            'default'   :[{'codec':'mp3', 'bitrate':320, 'samplerate':44100, 'mount':'/'}],
+            'validator' :check_stream_outputs,
+            'optional'  :True
+        },
+        'stations':{
+            'default'   :[],
+            'validator' :check_stations,
+            'optional'  :True
+        },
+        'busy_wait':{
+            'default'   :0,
+            'validator' :check_busy_wait,
+            'optional'  :True
+        },
+        'volume_tick_rate':{
+            'default'   :50,
+            'validator' :check_positive,
+            'optional'  :True
+        },
+        'job_workers':{
+            'default'   :2,
+            'validator' :check_positive,
+            'optional'  :True
+        },
+        'web_ui_reload':{
+            'default'   :False,
+            'validator' :None,
+            'optional'  :True
+        },
+        'library_index':{
+            'default'   :'library.sqlite3',
+            'validator' :check_index_file,
+            'optional'  :True
+        },
+        'playlist_window':{
+            'default'   :50,
+            'validator' :check_playlist_window,
+            'optional'  :True
+        },
+        'tag_workers':{
+            'default'   :4,
+            'validator' :check_tag_workers,
+            'optional'  :True
+        },
+        'history':
+        {
+            'size':{
+                'default'   :100,
+                'validator' :check_positive,
+                'optional'  :True
+            },
+            'log_file':{
+                'default'   :'history.jsonl',
+                'validator' :check_history_log,
+                'optional'  :True
+            },
+            'flush_interval':{
+                'default'   :10,
+                'validator' :check_positive,
+                'optional'  :True
+            }
+        },
+        'stream_relay':
+        {
+            'enabled':{
+                'default'   :True,
+                'validator' :None,
+                'optional'  :True
+            },
+            'upstream_port':{
+                'default'   :18138,
+                'validator' :check_port,
+                'optional'  :True
+            },
+            'max_listeners':{
+                'default'   :100,
+                'validator' :check_positive,
+                'optional'  :True
+            }
+        },
+        'library_watcher':
+        {
+            'enabled':{
+                'default'   :True,
+                'validator' :None,
+                'optional'  :True
+            },
+            'poll_interval':{
+                'default'   :60,
+                'validator' :check_poll_interval,
+                'optional'  :True
+            }
+        },
+        'websocket':
+        {
+            'interface':{
+                'default'   :'0.0.0.0',
+                'validator' :check_interface,
+                'optional'  :True
+            },
+            'port':{
+                'default'   :8140,
+                'validator' :check_port,
+                'optional'  :True
+            },
+            'max_clients':{
+                'default'   :1000,
+                'validator' :check_positive,
+                'optional'  :True
+            },
+            'queue_depth':{
+                'default'   :32,
+                'validator' :check_positive,
+                'optional'  :True
+            },
+            'ping_interval':{
+                'default'   :20,
+                'validator' :check_positive,
+                'optional'  :True
+            },
+            'ping_timeout':{
+                'default'   :20,
+                'validator' :check_positive,
+                'optional'  :True
+            },
+            'slow_clients':{
+                'default'   :'drop',
+                'validator' :check_slow_clients,
+                'optional'  :True
+            }
+        },
+        'server':
+        {
+            'mode':{
+                'default'   :'waitress',
+                'validator' :check_server_mode,
+                'optional'  :True
+            },
+            'threads':{
+                'default'   :8,
+                'validator' :check_positive,
+                'optional'  :True
             }
         }
     }
@@ -240,7 +591,27 @@ def load_config(config_file='default-config.yaml'):
             print('Bad Config: ' + str(exc))
             sys.exit(1)
 
-    def validate(key, validator_conf, test_conf):
+    fill_optional(validator_conf, instance_conf)
+    # relative paths are relative to the config file
+    if type(instance_conf['library_index']) == str:
+        instance_conf['library_index'] = os.path.join(
+            os.path.dirname(os.path.abspath(config_file)),
+            instance_conf['library_index']
+        )
+    for history in [instance_conf['history']] + [
+        station.get('history') for station in instance_conf['stations'] if type(instance_conf['stations']) == list and type(station) == dict
+    ]:
+        if type(history) == dict and type(history.get('log_file')) == str and history['log_file']:
+            history['log_file'] = os.path.join(
+                os.path.dirname(os.path.abspath(config_file)),
+                history['log_file']
+            )
+
+    # validators marked slow (they may wait seconds each) run concurrently
+    slow_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='config')
+    slow_checks = []    # (Future of a slow validator, its key path)
+
+    def validate(key, validator_conf, test_conf, parent_keys):
         '''Validate a specific key'''
         if check_missing(key, validator_conf, test_conf):
             return True
@@ -248,6 +619,10 @@ def load_config(config_file='default-config.yaml'):
             return True
 
         if 'validator' in validator_conf[key] and validator_conf[key]['validator']:
+            if validator_conf[key].get('slow'):
+                future = slow_pool.submit(validator_conf[key]['validator'], test_conf[key])
+                slow_checks.append((future, parent_keys + [key]))
+                return False
             return validator_conf[key]['validator'](test_conf[key])
         return False
 
@@ -255,7 +630,7 @@ def load_config(config_file='default-config.yaml'):
         '''Validate enire config'''
         error = False
         for key in validator_conf:
-            tmp_error = validate(key, validator_conf, instance_conf)
+            tmp_error = validate(key, validator_conf, instance_conf, parent_keys)
             error |= tmp_error
             if tmp_error:
                 eprint('\tFor key: ' +  ' => '.join(parent_keys + [key]))
@@ -267,11 +642,41 @@ def load_config(config_file='default-config.yaml'):
 
     error = validate_conf(validator_conf, instance_conf)
 
+    # a station's keys are validated like the top level ones
+    ports = [instance_conf.get('io_port')]
+    if not error and instance_conf['stations']:
+        for station_conf in station_configs(instance_conf):
+            station = next(station for station in instance_conf['stations'] if station['name'] == station_conf['name'])
+            error |= validate_conf(
+                {key:validator_conf[key] for key in station if key in validator_conf},
+                station_conf,
+                parent_keys=['stations', station_conf['name']]
+            )
+            ports += [station_conf['stream_port'], station_conf['websocket']['port']]
+            if station_conf['stream_relay']['enabled']:
+                ports.append(station_conf['stream_relay']['upstream_port'])
+        if len(set(ports)) < len(ports):
+            eprint('Error: every station needs its own stream_port, stream_relay upstream_port and websocket port, apart from io_port. Got ' + str(ports))
+            error = True
+
+    for future, keys in slow_checks:
+        if future.result():
+            eprint('\tFor key: ' + ' => '.join(keys))
+            error = True
+    slow_pool.shutdown()
+
     # hacky port checkin'
     if 'stream_port' in instance_conf and 'io_port' in instance_conf:
         if instance_conf['stream_port'] == instance_conf['io_port']:
             eprint('Error: stream_port and io_port are both ' + str(instance_conf['stream_port']))
             error |= error
+        if type(instance_conf['websocket']) == dict and instance_conf['websocket'].get('port') in [instance_conf['stream_port'], instance_conf['io_port']]:
+            eprint('Error: websocket port ' + str(instance_conf['websocket']['port']) + ' is also the stream_port or io_port')
+            error = True
+        relay = instance_conf.get('stream_relay')
+        if type(relay) == dict and relay.get('enabled') and relay.get('upstream_port') in [instance_conf['stream_port'], instance_conf['io_port']]:
+            eprint('Error: stream_relay upstream_port ' + str(relay['upstream_port']) + ' is also the stream_port or io_port')
+            error = True
 
     if error:
         eprint('Bad Config: See above errors')
@@ -285,132 +690,131 @@ def load_config(config_file='default-config.yaml'):
 #   2. Define functions for VLC library classes
 #
 ######################################################################
-def fade_volume_players(players, new_vs, time=2):
-    '''fades volume of a list of vlc.MediaPlayer instances
-    sample input: [vlc.MediaPlayer(), vlc.MediaPlayer()], [50, 25], time = 3]
-    Changes player one to 50% volume and player two to 25% over 3 seconds'''
-    old_vs = [mp.audio_get_volume() for mp in players]
-
-    for j in range(int(20 * time)):
-        for i in range(len(players)):
-            if new_vs[i] == old_vs[i]:
-                pass
-            elif new_vs[i] > old_vs[i]:
-                players[i].audio_set_volume(int(
-                    old_vs[i] + (new_vs[i] - old_vs[i])*(j/float(time*20 - 1))
-                ))
-            else:
-                players[i].audio_set_volume(int(
-                    old_vs[i] - (old_vs[i] - new_vs[i])*(j/float(time*20 - 1))
-                ))
-        sleep(0.05)
-
-def media_get_song(media):
-    '''returns as nice a string as possible for the current media'''
-    def short_mrl(mrl_string):
-        if re.search('^file://', mrl_string):
-            return unquote('/'.join(mrl_string.split('/')[-2::]))
+def stream_sout(outputs, interface, port):
+    '''Returns the sout chain streaming one capture to every output, each at
+    http://interface:port<mount>. Outputs with the same codec, bitrate and
+    sample rate share one encode, duplicated to their mounts'''
+    encodes = {}    # (codec, bitrate, samplerate): [mounts]
+    for output in outputs:
+        encodes.setdefault((output['codec'], output['bitrate'], output['samplerate']), []).append(output['mount'])
+
+    chains = []
+    for (codec, bitrate, samplerate), mounts in encodes.items():
+        acodec, mux, mime, samplerates = STREAM_CODECS[codec]
+        transcode = 'transcode{vcodec=none,acodec=' + acodec + ',ab=' + str(bitrate) + ',channels=2,samplerate=' + str(samplerate) + '}'
+        https = [
+            'http{mux=' + mux + ',mime=' + mime + ',dst=' + str(interface) + ':' + str(port) + mount + '}'
+            for mount in mounts
+        ]
+        if len(https) == 1:
+            chains.append(transcode + ':' + https[0])
         else:
-            return mrl_string
+            chains.append(transcode + ':duplicate{' + ','.join('dst=' + http for http in https) + '}')
+
+    if len(chains) == 1:
+        return 'sout=#' + chains[0]
+    return 'sout=#duplicate{' + ','.join('dst="' + chain + '"' for chain in chains) + '}'
+
+class MrlProber:
+    '''Checks if VLC can play MRLs, on one shared vlc.Instance.
+    A probe plays the media muted until a Playing, EncounteredError or
+    EndReached event, or the timeout. Probes run concurrently in a pool, one
+    per MRL at a time, and results are cached for ttl seconds (playable)
+    or negative_ttl seconds (not playable)'''
+    shared_prober = None
+    shared_lock = Lock()
+
+    def __init__(self, workers=4, ttl=600, negative_ttl=30):
+        self.instance = vlc.Instance('--quiet --no-video')
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='probe')
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = Lock()
+        self.cache = {}     # mrl: (playable, expiry time)
+        self.probes = {}    # mrl: Future of a running probe
+
+    @classmethod
+    def shared(cls):
+        '''Returns the MrlProber of the process, creating it on first use'''
+        with cls.shared_lock:
+            if cls.shared_prober is None:
+                cls.shared_prober = cls()
+            return cls.shared_prober
+
+    def playable(self, mrl, timeout=10):
+        '''Returns True if VLC can play the MRL'''
+        with self.lock:
+            if mrl in self.cache and self.cache[mrl][1] > time():
+                return self.cache[mrl][0]
+            if mrl not in self.probes:
+                self.probes[mrl] = self.pool.submit(self.probe, mrl, timeout)
+            future = self.probes[mrl]
+        try:
+            return future.result(timeout + 5)
+        except Exception:
+            return False
 
-    meta_data = {
-        'artist':   media.get_meta(vlc.Meta.Artist),
-        'title':    media.get_meta(vlc.Meta.Title),
-        'url':      media.get_meta(vlc.Meta.URL),
-        'mrl':      short_mrl(media.get_mrl())
-    }
+    def probe(self, mrl, timeout):
+        played = False
+        try:
+            # a directory is playable if one of its files is
+            media_mrl = audio_file_dir_walk(mrl, just_one=True) if os.path.isdir(mrl) else mrl
+            if media_mrl:
+                played = self.play(media_mrl, timeout)
+        finally:
+            with self.lock:
+                self.cache[mrl] = (played, time() + (self.ttl if played else self.negative_ttl))
+                self.probes.pop(mrl, None)
+        return played
+
+    def play(self, mrl, timeout):
+        '''Plays an MRL muted and waits for its events'''
+        playing, failed = Event(), Event()
+        player = self.instance.media_player_new()
+        player.audio_set_volume(0)
+        event_manager = player.event_manager()
+        event_manager.event_attach(vlc.EventType.MediaPlayerPlaying, lambda event: playing.set())
+        event_manager.event_attach(vlc.EventType.MediaPlayerEncounteredError, lambda event: (failed.set(), playing.set()))
+        event_manager.event_attach(vlc.EventType.MediaPlayerEndReached, lambda event: (failed.set(), playing.set()))
+        player.set_media(self.instance.media_new(mrl))
+        player.play()
+
+        # a stream which fails just after starting is not playable either
+        played = playing.wait(timeout) and not failed.wait(0.25)
+
+        player.stop()
+        player.release()
+        return played
 
-    if meta_data['artist']:
-        return meta_data['artist'] + ' - ' + meta_data['title']
-    elif meta_data['url']:
-        return meta_data['url']
-    else:
-        return meta_data['mrl']
+def media_get_song(media):
+    '''returns as nice a string as possible for the current media'''
+    return song_name(
+        media.get_meta(vlc.Meta.Artist),
+        media.get_meta(vlc.Meta.Title),
+        media.get_meta(vlc.Meta.URL),
+        media.get_mrl()
+    )
+
+def mrl_to_path(mrl):
+    '''Converts a file:// MRL to a filesystem path. Other MRLs are unchanged'''
+    if re.search('^file://', mrl):
+        # Properly decode URL-encoded paths (e.g., %20 -> space)
+        return unquote(mrl[len('file://')::])
+    return mrl
 
 def media_list_player_get_song(media_list_player):
     '''Return a nice string of current track information'''
     return media_get_song(media_list_player.get_media_player().get_media())
 
-def media_list_clear(media_list):
-    '''Removes all vlc.Media from a vlc.MediaList'''
-    while media_list.count() > 0:
-        media_list.remove_index(0)
-
-def media_list_flatten(media_list):
-    '''Opening a directoy with Media can lead to:
-    MediaList -> Media -> MediaList
-    This breaks total MediaList.count() and makes shuffling hard
-    Flattening ensurces a MediaList is full of single-file Media'''
-    list_of_media = []
-    for media in media_list:
-        if not media.is_parsed():
-            media.parse()
-        if media.subitems().count() > 0:
-            for sub_media in media.subitems():
-                list_of_media.append(sub_media)
-        else:
-            list_of_media.append(media)
-
-    media_list_clear(media_list)
-    for media in list_of_media:
-        media_list.add_media(media)
-
-def media_list_shuffle(media_list):
-    '''Shuffles a vlc.MediaList'''
-    media_list_flatten(media_list)
-    shuffled_list = []
-
-    shuffled_indexes = list(range(media_list.count()))
-    shuffle(shuffled_indexes)
-    for i in range(media_list.count()):
-        shuffled_list.append(media_list[shuffled_indexes[i]])
-
-    media_list_clear(media_list)
-    for media in shuffled_list:
-        media_list.add_media(media)
-
-def modify_media_list(mrl, media_list, media_player, shuffle=True, append=False, switch_current=False):
-    '''For setting a new playlist to a vlc.MediaList, or appending to it.
-    Shuffle is enabled by default.'''
-    if not append:
-        media_list_clear(media_list)
-
-    if os.path.isdir(mrl):
-        if switch_current:
-            # this is placed here as if the dir walk takes time, the time to change can feel long
-            first_track = vlc.Media(audio_file_dir_walk(mrl, just_one=True))
-            media_list.add_media(first_track)
-            media_list_flatten(media_list)
-            media_player.play_item(first_track)
-
-        list_of_media = [vlc.Media(audio_file) for audio_file in audio_file_dir_walk(mrl)]
-    else:
-        list_of_media = [vlc.Media(mrl)]
-
-    for media in list_of_media:
-        media_list.add_media(media)
-    media_list_flatten(media_list)
-
-    if shuffle:
-        media_list_shuffle(media_list)
-
-    if switch_current and not os.path.isdir(mrl):
-        media_player.play_item(choice(list_of_media))
-        if '.m3u' in mrl:
-            # playlists need to be told to play the next track
-            media_player.next()
-
-def audio_file_dir_walk(directory, allowed_file_extensions={'mp3', 'wav', 'flac'}, just_one=False):
+def audio_file_dir_walk(directory, allowed_file_extensions=AUDIO_FILE_EXTENSIONS, just_one=False, re_exp=None):
     '''VLC 3  does not auto-expand directories in media isntances.
     This function walks recursively through directories to obtain all allowed
-    audio files and creates a list of file locations'''
+    audio files and creates a list of file locations.
+    Prefer MediaLibrary.audio_file_ids for large directories'''
     # VLC doesn't auto-expand directories with Media instances.
     # Outputs list of files
-    re_exp = r'(?:\.'
-    for ext in allowed_file_extensions:
-        re_exp += ext + '|'
-    re_exp = re_exp[:-1:]
-    re_exp += ')$'
+    if re_exp is None:
+        re_exp = audio_file_re(allowed_file_extensions)
 
     music_file_list = []
     dir_list = os.listdir(directory)
@@ -420,10 +824,10 @@ def audio_file_dir_walk(directory, allowed_file_extensions={'mp3', 'wav', 'flac'
     for file_or_directory in dir_list:
         i_path = os.path.join(directory, file_or_directory)
         if os.path.isfile(i_path):
-            if re.search(re_exp, file_or_directory, re.IGNORECASE):
+            if re_exp.search(file_or_directory):
                 music_file_list.append(i_path)
         elif os.path.isdir(i_path):
-            music_file_list += audio_file_dir_walk(i_path)
+            music_file_list += audio_file_dir_walk(i_path, re_exp=re_exp)
         if just_one and music_file_list:
             return choice(music_file_list)
 
@@ -432,54 +836,412 @@ def audio_file_dir_walk(directory, allowed_file_extensions={'mp3', 'wav', 'flac'
 
 ######################################################################
 #
-#   3. Define nofication websockets server class
+#   3. Define Playlist class
+#
+######################################################################
+class Playlist:
+    '''The track order of a vlc.MediaListPlayer, kept as MediaLibrary ids in an array.
+    Changes are made to the array, then materialise() builds a fresh vlc.MediaList
+    once and swaps it into the player. Editing a MediaList in place costs a libvlc
+    call per item, and removing from its front is quadratic.
+
+    Queues longer than window tracks are a "virtual queue": the MediaList is a ring
+    of window vlc.Media around the current track. When the player moves on, the
+    slots it has left are refilled with the tracks window positions ahead, so
+    memory and enqueue time do not grow with the queue length'''
+    def __init__(self, instance, media_list_player, library, tags=None, window=50):
+        self.instance = instance
+        self.mp = media_list_player
+        self.library = library
+        self.tags = tags
+        self.window = window
+        self.lock = RLock()
+
+        self.order = array('q')
+        self.position = 0       # order index of the current track
+        self.slot = 0           # MediaList index of the current track
+        self.windowed = False
+        self.slot_ids = []      # track id of each MediaList index
+        self.slot_media = []    # vlc.Media of each MediaList index
+        self.sources = set()    # directories the playlist was built from
+        self.version = 0        # changes with the track order
+        self.waiting = set()    # track ids whose tags were being parsed at the last songs()
+        self.tag_version = 0    # renames of tracks no longer waiting, so versions never go back
+        self.waiting_renamed = 0        # renamed_since(waiting), as of generation waiting_checked
+        self.waiting_checked = None
+        self.cache = (None, ())
+        self.media_list = instance.media_list_new()
+        self.mp.set_media_list(self.media_list)
+
+    def __len__(self):
+        return len(self.order)
+
+    def expand(self, mrl, progress=None):
+        '''Returns the track ids of a directory, playlist file, audio file or URL'''
+        if os.path.isdir(mrl):
+            self.library.refresh(mrl, progress=progress)
+            return self.library.audio_file_ids(mrl)
+        elif os.path.isfile(mrl) and not self.library.re_audio_file.search(mrl):
+            # playlist files (e.g. .m3u) are parsed for their items
+            media = self.instance.media_new(mrl)
+            media.parse()
+            sub_mrls = [mrl_to_path(sub_media.get_mrl()) for sub_media in media.subitems()]
+            if sub_mrls:
+                return self.library.track_ids(sub_mrls)
+        elif os.path.isfile(mrl):
+            mrl = os.path.abspath(mrl)
+        return self.library.track_ids([mrl])
+
+    def paths(self):
+        '''Returns the paths or MRLs of the playlist in order'''
+        with self.lock:
+            paths = self.library.paths(self.order)
+            return [paths[track_id] for track_id in self.order]
+
+    def index_of(self, media):
+        '''Returns the MediaList index of a vlc.Media, or -1. libvlc needs the list locked for it'''
+        self.media_list.lock()
+        try:
+            return self.media_list.index_of_item(media)
+        finally:
+            self.media_list.unlock()
+
+    def current_index(self):
+        '''Returns the MediaList index of the current track, or -1'''
+        media = self.mp.get_media_player().get_media()
+        if media is None:
+            return -1
+        return self.index_of(media)
+
+    def current_id(self):
+        '''Returns the library id of the current track, or None'''
+        index = self.current_index()
+        return self.slot_ids[index] if 0 <= index < len(self.slot_ids) else None
+
+    def current_song(self):
+        '''Return a nice string of current track information.
+        Files come from the tag cache, streams from their live metadata'''
+        media = self.mp.get_media_player().get_media()
+        index = self.index_of(media) if media is not None else -1
+        if self.tags and 0 <= index < len(self.slot_ids) and mrl_to_path(media.get_mrl()).startswith(os.sep):
+            return self.tags.song(self.slot_ids[index])
+        return media_get_song(media)
+
+    def songs(self):
+        '''Returns nice strings of the playlist's tracks in order'''
+        with self.lock:
+            order = self.order.tolist()
+        if self.tags:
+            waiting = set()
+            songs = self.tags.songs(order, waiting=waiting)
+            self.tag_version = max(self.tag_version, self.tags.renamed_since(list(self.waiting)))
+            self.waiting = waiting
+            self.waiting_checked = None
+            return songs
+        return [short_mrl(path) for path in self.paths()]
+
+    def snapshot_version(self):
+        '''Returns a string which changes whenever songs() would: with the track
+        order, or when a track that was waiting on its tags changes name'''
+        if not self.tags:
+            return f'{self.version}.0'
+        # the waiting tracks can only have been renamed if the generation has moved
+        generation = self.tags.generation
+        if self.waiting_checked != generation:
+            self.waiting_renamed = self.tags.renamed_since(list(self.waiting))
+            self.waiting_checked = generation
+        return f'{self.version}.{max(self.tag_version, self.waiting_renamed)}'
+
+    def snapshot(self):
+        '''Returns (version, songs) of the playlist, only rebuilding the songs
+        when the track order or the tag cache has changed'''
+        with self.lock:
+            version = self.snapshot_version()
+            if self.cache[0] != version:
+                self.cache = (version, tuple(self.songs()))
+            return self.cache
+
+    def sync_position(self):
+        '''Updates position and slot to the track the player is on'''
+        index = self.current_index()
+        if index < 0 or not self.order:
+            return
+        steps = (index - self.slot) % len(self.slot_ids)
+        self.position = (self.position + steps) % len(self.order)
+        self.slot = index
+
+    def media_changed(self):
+        '''Tops up the window when the player changes track. It calls libvlc,
+        so it must not run on libvlc's event thread: see AudioPlayers.run_events'''
+        if self.windowed:
+            self.advance()
+
+    def advance(self):
+        '''Refills the MediaList slots the player has moved past'''
+        with self.lock:
+            old_slot = self.slot
+            self.sync_position()
+            if not self.windowed:
+                return
+            size = len(self.slot_ids)
+            steps = (self.slot - old_slot) % size
+            if steps == 0:
+                return
+            if steps >= size - 1:
+                self.materialise()
+                return
+
+            refill = {}
+            for j in range(steps):
+                slot = (self.slot - 1 - j) % size
+                refill[slot] = self.order[(self.position + size - 1 - j) % len(self.order)]
+            paths = self.library.paths(refill.values())
+
+            self.media_list.lock()
+            for slot, track_id in refill.items():
+                media = self.instance.media_new(paths[track_id])
+                self.media_list.remove_index(slot)
+                self.media_list.insert_media(media, slot)
+                self.slot_ids[slot] = track_id
+                self.slot_media[slot] = media
+            self.media_list.unlock()
+
+    def play(self, position):
+        '''Plays the track at an order index'''
+        with self.lock:
+            self.position = position
+            self.slot = 0
+            self.materialise()
+            self.mp.play_item_at_index(self.slot)
+
+    def shuffle(self, keep_current=True, materialise=True):
+        '''Shuffles the track order, keeping the current track at its position'''
+        with self.lock:
+            self.sync_position()
+            current_id = None
+            if keep_current and self.current_index() >= 0 and self.position < len(self.order):
+                current_id = self.order[self.position]
+
+            order = self.order.tolist()
+            shuffle(order)
+            if current_id is not None:
+                i = order.index(current_id)
+                order[i], order[self.position] = order[self.position], order[i]
+            self.order = array('q', order)
+
+            if materialise:
+                self.materialise()
+
+    def remove_ids(self, track_ids):
+        '''Removes every occurrence of some track ids. Returns the number removed'''
+        track_ids = set(track_ids)
+        with self.lock:
+            self.sync_position()
+            order = array('q', [track_id for track_id in self.order if track_id not in track_ids])
+            removed = len(self.order) - len(order)
+            if removed:
+                self.position -= sum(1 for track_id in self.order[:self.position] if track_id in track_ids)
+                if self.position >= len(order):
+                    self.position = 0
+                self.order = order
+                self.materialise()
+            return removed
+
+    def extend(self, track_ids):
+        '''Appends track ids to the end of the playlist'''
+        with self.lock:
+            self.sync_position()
+            self.order.extend(track_ids)
+            self.materialise()
+
+    def remove_paths(self, paths):
+        return self.remove_ids(self.library.track_ids(list(paths)))
+
+    def materialise(self):
+        '''Builds a vlc.MediaList of the track order, or of the window around
+        the current track, and swaps it into the player.
+        The vlc.MediaListPlayer keeps the index it is playing across MediaLists,
+        so the list is the order rotated to keep the current track at its slot.
+        Removing tracks before it then does not make the player skip'''
+        with self.lock:
+            size = max(self.window, self.slot + 1)
+            self.windowed = bool(self.window) and len(self.order) > size
+            resync = False
+            if not self.windowed:
+                size = len(self.order)
+                if self.slot >= size:
+                    # the list is now shorter than the player's index
+                    self.slot = self.position
+                    resync = True
+            slot_positions = [
+                (self.position + (slot - self.slot) % size) % len(self.order)
+                for slot in range(size)
+            ]
+
+            # reuse vlc.Media so the playing track is found in the new MediaList
+            old_media = dict(zip(self.slot_ids, self.slot_media))
+            slot_ids = [self.order[position] for position in slot_positions]
+            if self.windowed:
+                paths = self.library.paths(slot_ids)
+            else:
+                paths = self.library.paths([track_id for track_id in set(slot_ids) if track_id not in old_media])
+
+            slot_media = []
+            media_list = self.instance.media_list_new()
+            media_list.lock()
+            for track_id in slot_ids:
+                media = old_media.get(track_id) or self.instance.media_new(paths[track_id])
+                if self.windowed:
+                    # a track queued twice in one window needs distinct vlc.Media to find its slot
+                    old_media.pop(track_id, None)
+                slot_media.append(media)
+                media_list.add_media(media)
+            media_list.unlock()
+
+            self.slot_ids = slot_ids
+            self.slot_media = slot_media
+            self.media_list = media_list
+            self.mp.set_media_list(media_list)
+            self.version += 1
+            if resync and self.order and self.mp.is_playing():
+                self.mp.play_item_at_index(self.slot)
+
+def modify_media_list(mrl, playlist, shuffle=True, append=False, switch_current=False, progress=None):
+    '''For setting a new playlist to a Playlist, or appending to it.
+    Shuffle is enabled by default. progress(message) reports on large directories'''
+    track_ids = playlist.expand(mrl, progress=progress)
+    if progress:
+        progress(f'adding {len(track_ids)} tracks')
+    with playlist.lock:
+        playlist.sync_position()
+        if not append:
+            playlist.order = array('q')
+            playlist.position = 0
+            playlist.sources.clear()
+        if os.path.isdir(mrl):
+            playlist.sources.add(os.path.abspath(mrl))
+
+        first_index = len(playlist.order)
+        playlist.order.extend(track_ids)
+
+        if shuffle:
+            playlist.shuffle(keep_current=not switch_current, materialise=False)
+
+        if switch_current and playlist.order:
+            playlist.play(first_index)
+        else:
+            playlist.materialise()
+
+
+######################################################################
+#
+#   4. Define nofication websockets server class
 #
 ######################################################################
 class NotificationWebsocketsServer:
     '''Creates a websocket server for clients to connect to and receive
-    updates about media list changes. Allows not to have to poll for updates'''
-    users = set()
-    music_change = False
-    music_paused = False
-    ambience_change = False
-    ambience_paused = False
-
-    def __init__(self):
+    updates about media list changes. Allows not to have to poll for updates.
+    VLC event callbacks publish() messages into an asyncio queue, from which a
+    single broadcaster task copies them into a bounded queue per client.
+    A client whose queue is full has its queued messages replaced by a fresh
+    snapshot (drop), or is disconnected, so a stalled client never delays the
+    others. Messages carry history deltas and job events, so they are never
+    dropped one by one.
+    New clients are sent the result of snapshot() instead of welcome'''
+    RESYNC = object()   # queued in place of a full client's messages
+    def __init__(self, config, snapshot=None):
+        self.config = config
+        self.snapshot = snapshot
+        self.users = {}     # websocket: its asyncio.Queue of messages
+        self.stats = {'sent':0, 'dropped':0, 'disconnected':0, 'rejected':0}
+        self.loop = None
+        self.queue = None
         t = Thread(target=self.start_loop)
         t.daemon = True
         t.start()
 
-    async def register(self, websocket):
-        self.users.add(websocket)
-
-    async def unregister(self, websocket):
-        self.users.remove(websocket)
+    def publish(self, message):
+        '''Queues a message (JSON serialisable) for all clients. Safe to call from any thread'''
+        if self.loop is not None and self.users:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, json.dumps(message))
 
     async def handler(self, websocket):
-        await self.register(websocket)
-        await websocket.send('welcome')
+        if len(self.users) >= self.config['max_clients']:
+            self.stats['rejected'] += 1
+            await websocket.close(1013, 'too many clients')
+            return
+
+        queue = asyncio.Queue(maxsize=self.config['queue_depth'])
+        self.users[websocket] = queue
         try:
-            while websocket.state == State.OPEN:
-                await asyncio.sleep(1)
-                if self.music_change:
-                    self.music_change = False
-                    await self.change_notify('music', 'changed')
-                if self.ambience_change:
-                    self.ambience_change = False
-                    await self.change_notify('ambience', 'changed')
-                if self.music_paused:
-                    self.music_paused = False
-                    await self.change_notify('music', 'paused')
-                if self.ambience_paused:
-                    self.ambience_paused = False
-                    await self.change_notify('ambience', 'paused')
+            if self.snapshot:
+                # snapshot() calls libvlc and the library, keep them off the event loop
+                snapshot = await self.loop.run_in_executor(None, self.snapshot)
+                await websocket.send(json.dumps(snapshot))
+            else:
+                await websocket.send('welcome')
+
+            sender = asyncio.create_task(self.sender(websocket, queue))
+            closed = asyncio.create_task(websocket.wait_closed())
+            await asyncio.wait([sender, closed], return_when=asyncio.FIRST_COMPLETED)
+            sender.cancel()
+            closed.cancel()
+        except websockets.ConnectionClosed:
+            pass
         finally:
-            await websocket.close()
-            await self.unregister(websocket)
+            self.users.pop(websocket, None)
+
+    async def sender(self, websocket, queue):
+        '''Sends a client its queued messages, at whatever pace it reads them'''
+        while True:
+            message = await queue.get()
+            if message is self.RESYNC:
+                snapshot = await self.loop.run_in_executor(None, self.snapshot)
+                # player messages queued meanwhile are in the snapshot already
+                for _ in range(queue.qsize()):
+                    queued = queue.get_nowait()
+                    if queued is self.RESYNC or json.loads(queued).get('event') in ['changed', 'playing', 'paused']:
+                        self.stats['dropped'] += 1
+                    else:
+                        queue.put_nowait(queued)
+                message = json.dumps(snapshot)
+            await websocket.send(message)
+            self.stats['sent'] += 1
+
+    async def broadcaster(self):
+        while True:
+            message = await self.queue.get()
+            for websocket, queue in list(self.users.items()):
+                if not queue.full():
+                    queue.put_nowait(message)
+                elif self.config['slow_clients'] == 'disconnect':
+                    self.stats['disconnected'] += 1
+                    self.users.pop(websocket, None)
+                    asyncio.create_task(websocket.close(1008, 'too slow'))
+                elif self.snapshot:
+                    # a fresh snapshot holds the state and history the queued messages would have
+                    self.stats['dropped'] += 1
+                    while not queue.empty():
+                        if queue.get_nowait() is not self.RESYNC:
+                            self.stats['dropped'] += 1
+                    queue.put_nowait(self.RESYNC)
+                else:
+                    queue.get_nowait()
+                    queue.put_nowait(message)
+                    self.stats['dropped'] += 1
 
     def start_loop(self):
         async def run_server():
-            async with websockets.serve(self.handler, '0.0.0.0', 8140):
+            self.queue = asyncio.Queue()
+            self.loop = asyncio.get_running_loop()
+            broadcaster = asyncio.create_task(self.broadcaster())
+            async with websockets.serve(
+                self.handler,
+                self.config['interface'],
+                self.config['port'],
+                ping_interval=self.config['ping_interval'],
+                ping_timeout=self.config['ping_timeout']
+            ):
                 await asyncio.Future()  # run forever
         
         loop = asyncio.new_event_loop()
@@ -489,65 +1251,121 @@ class NotificationWebsocketsServer:
         finally:
             loop.close()
 
-    async def change_notify(self, music_or_ambience, change_type):
-        if self.users:
-            for user in self.users:
-                await user.send(f'{music_or_ambience}_{change_type}')
-
 
 ######################################################################
 #
-#   4. Define AudioPlayers Class
+#   5. Define AudioPlayers Class
 #
 ######################################################################
+class SharedMedia:
+    '''The VLC instance, media library, tag cache and library watcher shared
+    by the stations (AudioPlayers) of a process. The watcher covers the
+    audio directories of every station'''
+    def __init__(self, config_data, station_configs=None):
+        self.instance = vlc.Instance('--quiet --no-video --sout-http-mime=audio/mpeg --no-http-forward-cookies')
+        self.library = MediaLibrary(config_data['library_index'])
+        self.tags = TagCache(self.library, self.instance, workers=config_data['tag_workers'])
+        self.library_watcher = None
+        if config_data['library_watcher']['enabled']:
+            directories = []
+            for station_conf in station_configs or [config_data]:
+                for music_ambience_or_clips in ['music', 'ambience', 'clips']:
+                    if station_conf['audio_dirs'][music_ambience_or_clips] not in directories:
+                        directories.append(station_conf['audio_dirs'][music_ambience_or_clips])
+            self.library_watcher = LibraryWatcher(
+                self.library,
+                directories,
+                poll_interval=config_data['library_watcher']['poll_interval'],
+                debug=Debug
+            )
+
+    def start_watcher(self):
+        '''Starts the library watcher once, if enabled'''
+        if self.library_watcher and not self.library_watcher.is_alive() and not self.library_watcher.ident:
+            self.library_watcher.start()
+
 class AudioPlayers:
-    '''A class of 4 audio players, their playlists
-    1: Stream of virtual audio to 127.0.0.1:[streamport]
-    2. Music stream to virtual audio
-    3. Ambience stream to virtual audio
-    4. Clips stream to virtual audio
-    Clips are handled by a Clips thread instance.'''
-    def __init__(self, config_data):
+    '''A station: a class of 4 audio players, their playlists
+    1: Stream of the station's sink to 127.0.0.1:[streamport]
+    2. Music stream to the sink
+    3. Ambience stream to the sink
+    4. Clips stream to the sink
+    Clips are handled by a Clips thread instance.
+    The VLC instance, media library and tag cache come from a SharedMedia,
+    which may be shared with other stations'''
+    def __init__(self, config_data, shared=None):
         # 0. Parameters
         self.config_data = config_data
+        self.name = config_data.get('name', '')
+        self.sink = config_data.get('sink', 'virtual')
+        self.label = self.name + ': ' if self.name else ''    # for startup timings
+        self.shared = shared or SharedMedia(config_data)
 
-        # 1. VLC instance and its players
-        self.i = vlc.Instance('--quiet --no-video --sout-http-mime=audio/mpeg --no-http-forward-cookies')
+        # 1. VLC instance and its players, playing to the station's sink
+        self.i = self.shared.instance
         self.mp_vaudio = self.i.media_player_new()
         self.mp_music = self.i.media_list_player_new()
         self.mp_ambience = self.i.media_list_player_new()
         self.mp_clips = self.i.media_player_new()
+        for mp in [self.mp_music.get_media_player(), self.mp_ambience.get_media_player(), self.mp_clips]:
+            mp.audio_output_device_set(None, self.sink)
 
-        ## 1.1 VLC player metadata (limitation to pythonb-vlc makes this required)
+        ## 1.1 Volume fades of the players, from one thread
+        self.volume = VolumeScheduler(tick_rate=self.config_data['volume_tick_rate'])
+        self.volume.register('music', self.mp_music.get_media_player())
+        self.volume.register('ambience', self.mp_ambience.get_media_player())
+        self.volume.register('clips', self.mp_clips)
+        self.volume.start()
+
+        ## 1.2 VLC player metadata (limitation to pythonb-vlc makes this required)
         self.music_repeat = False
         self.ambience_repeat = False
-
-        # 2. Playlists (MediaLists)
-        self.ml_music = self.i.media_list_new()
-        self.ml_ambience = self.i.media_list_new()
-        self.mp_music.set_media_list(self.ml_music)
-        self.mp_ambience.set_media_list(self.ml_ambience)
-
-        # 3. Event managers (Song history & websocket notifications)
-        self.notification_server = NotificationWebsocketsServer()
+        self.music_playing = False      # kept by events, so reading it never waits on libvlc
+        self.ambience_playing = False
+
+        # 2. Playlists (MediaLists built from the media library index)
+        self.library = self.shared.library
+        self.tags = self.shared.tags
+        self.pl_music = Playlist(self.i, self.mp_music, self.library, tags=self.tags, window=self.config_data['playlist_window'])
+        self.pl_ambience = Playlist(self.i, self.mp_ambience, self.library, tags=self.tags, window=self.config_data['playlist_window'])
+
+        # 3. Event managers (Song history & websocket notifications) and the stream listener relay
+        self.notification_server = NotificationWebsocketsServer(self.config_data['websocket'], snapshot=self.notification_snapshot)
+        self.stream_relay = None
+        if self.config_data['stream_relay']['enabled']:
+            self.stream_relay = StreamRelay(
+                self.config_data['interface'],
+                self.config_data['stream_port'],
+                self.config_data['stream_relay']['upstream_port'],
+                {output['mount']:STREAM_CODECS[output['codec']][2] for output in self.config_data['stream_outputs']},
+                max_listeners=self.config_data['stream_relay']['max_listeners']
+            )
         self.em_music = self.mp_music.get_media_player().event_manager()
-        self.history_music = []
         self.em_ambience = self.mp_ambience.get_media_player().event_manager()
-        self.history_ambience = []
+        self.history = PlayHistory(
+            ['music', 'ambience'],
+            size=self.config_data['history']['size'],
+            log_file=self.config_data['history']['log_file'],
+            flush_interval=self.config_data['history']['flush_interval']
+        )
 
-        def media_changed_event(event, self, music_or_ambience):
-            '''callback function for event managers to store track history and notify websockets clients of track changes'''
-            # update history
-            mp = getattr(self, 'mp_' + music_or_ambience)
-            history = getattr(self, 'history_' + music_or_ambience)
-            if len(history) == 101:
-                history = history[1::]
-            history.append(media_list_player_get_song(mp))
-            setattr(self, 'history_' + music_or_ambience, history)
+        # libvlc must not be called from its own event thread, so the callbacks
+        # below hand their work to the event worker, which runs it in order
+        self.events = SimpleQueue()
+        Thread(target=self.run_events, daemon=True, name='player events').start()
+
+        def track_changed(music_or_ambience):
+            '''Tops up the playlist window, stores the track in the history and notifies websockets clients'''
+            playlist = getattr(self, 'pl_' + music_or_ambience)
+            playlist.media_changed()
+            entries = self.history.append(music_or_ambience, playlist.current_id(), playlist.current_song())
 
-            # set notification server thread to notify
-            if self.notification_server.users:
-                setattr(self.notification_server, music_or_ambience + '_change', True)
+            # A MediaListPlayer only changes media to play it
+            self.notify_clients(music_or_ambience, 'changed', is_playing=True, history=entries)
+
+        def media_changed_event(event, self, music_or_ambience):
+            '''callback function for event managers on track changes'''
+            self.events.put((track_changed, music_or_ambience))
 
         self.em_music.event_attach(vlc.EventType.MediaPlayerMediaChanged, media_changed_event, self, 'music')
         self.em_ambience.event_attach(vlc.EventType.MediaPlayerMediaChanged, media_changed_event, self, 'ambience')
@@ -556,65 +1374,44 @@ class AudioPlayers:
             '''Remove broken/missing files from playlist and restart playback.
             Called when a player gets stuck on a deleted or corrupted file.'''
             mp = getattr(self, 'mp_' + music_or_ambience)
-            ml = getattr(self, 'ml_' + music_or_ambience)
+            playlist = getattr(self, 'pl_' + music_or_ambience)
             
             try:
                 if Debug:
-                    eprint(f'Cleaning up broken files from {music_or_ambience} playlist (count: {ml.count()})')
+                    eprint(f'Cleaning up broken files from {music_or_ambience} playlist (count: {len(playlist)})')
                 
-                # Find all valid files in the current playlist
-                valid_files = []
-                broken_count = 0
-                for i in range(ml.count()):
-                    item = ml.item_at_index(i)
-                    item_mrl = item.get_mrl()
-                    # Properly decode URL-encoded paths (e.g., %20 -> space)
-                    item_path = unquote(item_mrl.replace('file://', ''))
-                    if os.path.exists(item_path):
-                        valid_files.append(item_path)
-                    else:
-                        broken_count += 1
-                        if Debug:
-                            eprint(f'  Removing broken file: {os.path.basename(item_path)}')
+                # Find all missing files in the current playlist
+                paths = playlist.paths()
+                broken_files = [path for path in paths if os.path.isabs(path) and not os.path.exists(path)]
+                if Debug:
+                    for path in broken_files:
+                        eprint(f'  Removing broken file: {os.path.basename(path)}')
                 
-                if broken_count == 0:
+                if not broken_files:
                     if Debug:
                         eprint(f'  No broken files found, attempting next() anyway')
                     mp.next()
                     return
                 
-                if len(valid_files) == 0:
+                if len(broken_files) == len(paths):
                     if Debug:
                         eprint(f'  All files in {music_or_ambience} playlist are broken!')
                     return
                 
-                # Rebuild playlist with only valid files
-                new_list = self.i.media_list_new()
-                for file_path in valid_files:
-                    new_media = self.i.media_new(file_path)
-                    new_list.add_media(new_media)
-                
-                if Debug:
-                    eprint(f'  Rebuilt playlist with {new_list.count()} valid files (removed {broken_count})')
-                
-                # Stop, swap playlist, restart
+                # Stop, rebuild playlist with only valid files, restart
                 try:
                     mp.stop()
                     sleep(0.2)
                 except:
                     pass
                 
-                mp.set_media_list(new_list)
+                removed = playlist.remove_paths(broken_files)
+                if Debug:
+                    eprint(f'  Rebuilt playlist with {len(playlist)} valid files (removed {removed})')
                 
                 # Restore volume
-                volume = mp.get_media_player().audio_get_volume()
-                mp.get_media_player().audio_set_volume(volume if volume > 0 else 100)
-                
-                # Update our reference
-                if music_or_ambience == 'music':
-                    self.ml_music = new_list
-                else:
-                    self.ml_ambience = new_list
+                volume = self.volume.current_volume(music_or_ambience)
+                self.volume.set_volume(music_or_ambience, volume if volume > 0 else 100)
                 
                 # Restart playback
                 mp.play()
@@ -627,44 +1424,67 @@ class AudioPlayers:
                 if Debug:
                     eprint(f'  Error during cleanup: {e}')
 
+        def media_playing_event(event, self, music_or_ambience):
+            '''Callback function for event managers to track the play state'''
+            is_playing = event.type == vlc.EventType.MediaPlayerPlaying
+            setattr(self, music_or_ambience + '_playing', is_playing)
+            if is_playing:
+                startup_timer.mark(self.label + 'first audio (' + music_or_ambience + ')')
+            self.events.put((self.notify_clients, music_or_ambience, 'playing' if is_playing else 'paused', is_playing))
+
+        self.em_music.event_attach(vlc.EventType.MediaPlayerPlaying, media_playing_event, self, 'music')
+        self.em_ambience.event_attach(vlc.EventType.MediaPlayerPlaying, media_playing_event, self, 'ambience')
+        self.em_music.event_attach(vlc.EventType.MediaPlayerPaused, media_playing_event, self, 'music')
+        self.em_ambience.event_attach(vlc.EventType.MediaPlayerPaused, media_playing_event, self, 'ambience')
+
         def media_paused_event(event, self, music_or_ambience):
             '''Callback function for event managers to notify websockets clients of track pauses'''
-            # set notification server thread to notify
-            if self.notification_server.users:
-                setattr(self.notification_server, music_or_ambience + '_paused', True)
+            setattr(self, music_or_ambience + '_playing', False)
+
+            # notify websockets clients
+            self.events.put((self.notify_clients, music_or_ambience, 'paused', False))
 
         self.em_music.event_attach(vlc.EventType.MediaPlayerStopped, media_paused_event, self, 'music')
         self.em_ambience.event_attach(vlc.EventType.MediaPlayerStopped, media_paused_event, self, 'ambience')
 
-        def media_error_event(event, self, music_or_ambience):
-            '''Callback function for media errors - spawn recovery thread.
-            Don't block the callback by doing recovery directly here.'''
+        def recover(music_or_ambience):
+            '''Spawns a recovery thread if a player stopped on an error'''
             mp = getattr(self, 'mp_' + music_or_ambience)
             state = mp.get_media_player().get_state()
             
             if state in [vlc.State.Error, vlc.State.Stopped, vlc.State.NothingSpecial]:
                 if Debug:
                     eprint(f'Media error in {music_or_ambience} (state: {state}), spawning recovery thread')
-                # Spawn a thread to handle recovery without blocking callback
+                # Spawn a thread to handle recovery without blocking the event worker
                 recovery_thread = Thread(target=cleanup_broken_files, args=(self, music_or_ambience))
                 recovery_thread.daemon = True
                 recovery_thread.start()
             elif Debug:
                 eprint(f'Media error in {music_or_ambience} but player already playing (state: {state})')
 
-        def media_end_reached_event(event, self, music_or_ambience):
-            '''Callback function when media ends - spawn recovery thread if stuck.'''
+        def media_error_event(event, self, music_or_ambience):
+            '''Callback function for media errors. Don't block the callback by recovering here'''
+            setattr(self, music_or_ambience + '_playing', False)
+            self.events.put((recover, music_or_ambience))
+
+        def recover_if_stuck(music_or_ambience):
+            '''Spawns a recovery thread if a player stopped at the end of a track'''
             mp = getattr(self, 'mp_' + music_or_ambience)
             state = mp.get_media_player().get_state()
             
             if state in [vlc.State.Stopped, vlc.State.Error, vlc.State.NothingSpecial]:
                 if Debug:
                     eprint(f'Media ended but {music_or_ambience} stuck (state: {state}), spawning recovery thread')
-                # Spawn a thread to handle recovery without blocking callback
+                # Spawn a thread to handle recovery without blocking the event worker
                 recovery_thread = Thread(target=cleanup_broken_files, args=(self, music_or_ambience))
                 recovery_thread.daemon = True
                 recovery_thread.start()
 
+        def media_end_reached_event(event, self, music_or_ambience):
+            '''Callback function when media ends'''
+            setattr(self, music_or_ambience + '_playing', False)
+            self.events.put((recover_if_stuck, music_or_ambience))
+
         self.em_music.event_attach(vlc.EventType.MediaPlayerEncounteredError, media_error_event, self, 'music')
         self.em_ambience.event_attach(vlc.EventType.MediaPlayerEncounteredError, media_error_event, self, 'ambience')
         self.em_music.event_attach(vlc.EventType.MediaPlayerEndReached, media_end_reached_event, self, 'music')
@@ -674,14 +1494,62 @@ class AudioPlayers:
         self.clips_thread = Clips(self)
         self.clips_thread.start()
 
-        # 5. Initialise and start the players
+        # 5. Initialise and start the players. The stream starts at once,
+        #    the default playlists are loaded in the background
+        self.playlists_loaded = Event()
         self.initialise_players()
         self.start_players()
+        Thread(target=self.load_default_playlists, daemon=True).start()
+
+        # 6. Keep the library and playlists in sync with the audio directories
+        if self.shared.library_watcher:
+            self.shared.library_watcher.callbacks.append(self.library_changed)
+            self.shared.start_watcher()
+
+    def player_state(self, music_or_ambience, is_playing=None):
+        '''Returns the state of a player sent to websockets clients'''
+        mp = getattr(self, 'mp_' + music_or_ambience)
+        playlist = getattr(self, 'pl_' + music_or_ambience)
+        return {
+            'track'         :playlist.current_song(),
+            'is_playing'    :bool(mp.is_playing()) if is_playing is None else is_playing,
+            'volume'        :mp.get_media_player().audio_get_volume(),
+            'queue_version' :playlist.snapshot_version()
+        }
+
+    def run_events(self):
+        '''Runs the work handed over by the VLC event callbacks, off libvlc's event thread'''
+        while True:
+            func, *args = self.events.get()
+            try:
+                func(*args)
+            except Exception as e:
+                eprint('Error handling a player event: ' + repr(e))
+
+    def notify_clients(self, music_or_ambience, event, is_playing=None, history=None):
+        '''Pushes a player's state to websockets clients, with the history entries added or ended'''
+        if self.notification_server.users:
+            message = self.player_state(music_or_ambience, is_playing)
+            message.update(event=event, player=music_or_ambience, history=history or [])
+            self.notification_server.publish(message)
+
+    def notification_snapshot(self):
+        '''The state of both players and their histories, sent to new websockets clients'''
+        snapshot = {'event':'snapshot'}
+        for music_or_ambience in ['music', 'ambience']:
+            snapshot[music_or_ambience] = self.player_state(music_or_ambience)
+            snapshot[music_or_ambience]['history'] = self.history.page(music_or_ambience)[0]
+        if self.stream_relay:
+            snapshot['listeners'] = self.stream_relay.snapshot()
+        return snapshot
 
     def initialise_players(self):
         # vaudio
-        transcode_cmd = 'sout=#transcode{vcodec=none,acodec=mp3,ab=320,channels=2,samplerate=44100}:'
-        transcode_cmd += 'http{mux=mp3,dst=' + str(self.config_data['interface']) + ':' + str(self.config_data['stream_port']) + '}'
+        if self.stream_relay:
+            # VLC serves the relay only, which serves the listeners on stream_port
+            transcode_cmd = stream_sout(self.config_data['stream_outputs'], '127.0.0.1', self.config_data['stream_relay']['upstream_port'])
+        else:
+            transcode_cmd = stream_sout(self.config_data['stream_outputs'], self.config_data['interface'], self.config_data['stream_port'])
 
         full_cmd = [
             transcode_cmd,
@@ -689,143 +1557,267 @@ class AudioPlayers:
             'file-caching=1000'
         ]
 
-        m_vaudio = self.i.media_new('pulse://virtual.monitor', *full_cmd)
+        m_vaudio = self.i.media_new('pulse://' + self.sink + '.monitor', *full_cmd)
         self.mp_vaudio.set_media(m_vaudio)
         self.mp_vaudio.audio_set_volume(100)
 
         # music
-        if self.config_data['default_files']['music']:
-            modify_media_list(self.config_data['default_files']['music'], self.ml_music, self.mp_music)
-        else:
-            modify_media_list(self.config_data['audio_dirs']['music'], self.ml_music, self.mp_music)
         #there is no get_playback_mode or equiv for later
         self.mp_music.set_playback_mode(vlc.PlaybackMode.loop) 
         self.mp_music.playback_mode_meta = vlc.PlaybackMode.loop
-        self.mp_music.get_media_player().audio_set_volume(100)
+        self.volume.set_volume('music', 100)
 
         # ambience
-        if self.config_data['default_files']['ambience']:
-            modify_media_list(self.config_data['default_files']['ambience'], self.ml_ambience, self.mp_ambience)
-        else:
-            modify_media_list(self.config_data['audio_dirs']['ambience'], self.ml_ambience, self.mp_ambience)
         self.mp_ambience.set_playback_mode(vlc.PlaybackMode.loop)
-        self.mp_ambience.get_media_player().audio_set_volume(75)
+        self.volume.set_volume('ambience', 75)
+
+    def load_default_playlists(self):
+        '''Loads (walks and shuffles) the default music and ambience playlists
+        concurrently, then starts the startup players. A playlist already set
+        by a command in the meantime is kept'''
+        def load(music_or_ambience):
+            playlist = getattr(self, 'pl_' + music_or_ambience)
+            mrl = self.config_data['default_files'][music_or_ambience] or self.config_data['audio_dirs'][music_or_ambience]
+            if len(playlist) == 0:
+                modify_media_list(mrl, playlist)
+            startup_timer.mark(self.label + music_or_ambience + ' playlist loaded')
+            if self.config_data['startup_players'][music_or_ambience] and not getattr(self, music_or_ambience + '_playing'):
+                getattr(self, 'mp_' + music_or_ambience).play()
+
+        loaders = [Thread(target=load, args=(music_or_ambience,)) for music_or_ambience in ['music', 'ambience']]
+        for loader in loaders:
+            loader.start()
+        for loader in loaders:
+            loader.join()
+        self.playlists_loaded.set()
+
+    def library_changed(self, added, removed):
+        '''LibraryWatcher callback. Prunes removed files from the playlists
+        and appends added files to playlists built from their directory.
+        Changes to the clips directory are picked up by the next clip'''
+        clips_dir = os.path.abspath(self.config_data['audio_dirs']['clips'])
+        if any(path.startswith(clips_dir + os.sep) for path in added + removed):
+            self.clips_thread.pool.invalidate()
+        for playlist in [self.pl_music, self.pl_ambience]:
+            new_files = [
+                path for path in added
+                if any(path.startswith(source + os.sep) for source in playlist.sources)
+            ]
+            with playlist.lock:
+                if removed:
+                    playlist.remove_paths(removed)
+                if new_files:
+                    playlist.extend(self.library.track_ids(new_files))
 
     def start_players(self):
+        '''Starts the stream and clips. Music and ambience start once their
+        playlists are loaded, see load_default_playlists'''
         self.mp_vaudio.play()
-        if self.config_data['startup_players']['music']:
-            self.mp_music.play()
-        if self.config_data['startup_players']['ambience']:
-            self.mp_ambience.play()
+        startup_timer.mark(self.label + 'stream started')
         if self.config_data['startup_players']['clips']:
             self.toggle_clips()
 
     def toggle_clips(self, force_on=False, force_off=False):
         if force_on:
-            self.clips_thread.clips_on = True
+            self.clips_thread.set_clips_on(True)
         elif force_off:
-            self.clips_thread.clips_on = False
+            self.clips_thread.set_clips_on(False)
         else:
-            self.clips_thread.clips_on = not self.clips_thread.clips_on
+            self.clips_thread.set_clips_on(not self.clips_thread.clips_on)
 
     def nice_quit(self):
         '''Exits threads safely. Fades out volume. Waits if a clip is currently playing.'''
         print('Quitting... Please wait')
-        self.clips_thread.exit_program = True
+        self.clips_thread.stop()
 
         if self.clips_thread.clip_playing:
             print('waiting for clip to finish')
-            while self.clips_thread.clip_playing:
-                sleep(1)
+            self.clips_thread.idle.wait()
 
-        fade_volume_players(
-            [self.mp_music.get_media_player(), self.mp_ambience.get_media_player()],
-            [0, 0]
-        )
+        for faded in self.volume.fade_all({'music':0, 'ambience':0}):
+            faded.wait(5)
         self.mp_vaudio.stop()
-        self.mp_music.get_media_player().audio_set_volume(100)
+        self.volume.set_volume('music', 100)
+        self.volume.stop()
+        self.history.close()
 
 
 ######################################################################
 #
-#   5. Define ClipsThread Thread
+#   6. Define ClipsThread Thread
 #       Manages clip playing times
 #
 ######################################################################
 class Clips(Thread):
     '''Handles the intermittment playing of sound clips
-    Fades down other players for 2 seconds, plays a randomly-selected clip, then fades
-    the other plays back to their initial volume. If there is more than one clip
-    available, then no clip will be repeated twice in a row'''
-    # Handles the intermittent playing of sound clips
+    Fades down other players, plays a clip from the ClipPool, then fades
+    the other plays back to their initial volume. No clip of a pool repeats until
+    all of them have played.
+    Timers are kept in a heap of (time, seq, action). The thread sleeps on a
+    Condition until the first is due or a command (toggle, clips/now, quit)
+    changes them, and clips end on their player's events.
+    A clip scheduled at clip_schedule is preloaded into the clips player
+    preroll_seconds before its duck fade, which starts duck_seconds before
+    clip_schedule so the clip starts as the fade ends. The restore fade starts
+    from the clip's EndReached event, or once the clip's cached duration has
+    passed if that event is missed'''
+    duck_volumes = {'music':65, 'ambience':45}
+    restore_volumes = {'music':100, 'ambience':75}
+
     def __init__(self, parent):
-        super(Clips, self).__init__()
+        super(Clips, self).__init__(name='clips')
         self.mp_clips = parent.mp_clips
         self.mp_music = parent.mp_music
         self.mp_ambience = parent.mp_ambience
+        self.volume = parent.volume
         self.clip_timing = parent.config_data['clip_timing']
         self.clips_dir = parent.config_data['audio_dirs']['clips']
+        self.pool = ClipPool(parent.library, parent.tags, self.clips_dir, pools=parent.config_data['clip_pools'])
 
         self.clips_on = False
         self.clip_schedule = None       # or Datetime object
-        self.last_played_clip = None    # prevent same clip twice in a row, if > 1
+        self.last_played_clip = None
+        self.preloaded = None           # (path, vlc.Media, seconds or None) set on the clips player
         self.exit_program = False
         self.clip_playing = False
 
+        self.condition = Condition()
+        self.timers = []                # heap of (time(), seq, action name)
+        self.timer_seq = count()
+        self.idle = Event()             # set while no clip is playing
+        self.idle.set()
+        self.clip_ended = Event()
+
+        def clip_end_event(event):
+            '''Restores the other players straight away, then wakes play_clip'''
+            if self.clip_playing and not self.clip_ended.is_set():
+                self.volume.fade_all(self.restore_volumes, duration=self.clip_timing['duck_seconds'])
+            self.clip_ended.set()
+
+        em_clips = self.mp_clips.event_manager()
+        for event_type in [vlc.EventType.MediaPlayerEndReached, vlc.EventType.MediaPlayerEncounteredError]:
+            em_clips.event_attach(event_type, clip_end_event)
+
+    def add_timer(self, when, action):
+        '''Schedules action (a method name) at time() when. Call with condition held'''
+        heapq.heappush(self.timers, (when, next(self.timer_seq), action))
+        self.condition.notify()
+
+    def remove_timers(self, *actions):
+        '''Call with condition held'''
+        self.timers = [timer for timer in self.timers if timer[2] not in actions]
+        heapq.heapify(self.timers)
+        self.condition.notify()
+
+    def set_clips_on(self, clips_on):
+        '''Turns clips on (scheduling the next) or off (cancelling it)'''
+        with self.condition:
+            self.clips_on = clips_on
+            if not clips_on:
+                self.remove_timers('preload_clip', 'play_clip')
+                self.clip_schedule = None
+            elif not self.clip_schedule and not self.clip_playing:
+                self.schedule_clip()
+
+    def play_now(self):
+        '''Replaces the scheduled clip with one now, after the duck fade. Returns when it starts'''
+        with self.condition:
+            self.remove_timers('preload_clip', 'play_clip')
+            now = time()
+            self.clip_schedule = datetime.datetime.fromtimestamp(now + self.clip_timing['duck_seconds'])
+            self.add_timer(now, 'play_clip')
+            return self.clip_schedule
+
+    def stop(self):
+        with self.condition:
+            self.exit_program = True
+            self.condition.notify()
+
     def schedule_clip(self):
+        '''Call with condition held'''
         offset = datetime.timedelta(minutes=int(normalvariate(
             self.clip_timing['clip_mean'],
             self.clip_timing['clip_std_deviation']
         )))
         self.clip_schedule = datetime.datetime.today() + offset
+        duck_at = self.clip_schedule.timestamp() - self.clip_timing['duck_seconds']
+        self.add_timer(duck_at - self.clip_timing['preroll_seconds'], 'preload_clip')
+        self.add_timer(duck_at, 'play_clip')
         if Debug:
             print('Clip scheduled: ' + str(self.clip_schedule))
 
-    def play_clip(self):
-        # 0. Select random clip
-        # Make sure it is not last played clip if there is more than one
-        self.clip_playing = True
-        clips = os.listdir(self.clips_dir)
-        if len(clips) > 1 and self.last_played_clip:
-            clips.remove(self.last_played_clip)
+    def preload_clip(self):
+        '''Sets the next clip of the pool on the clips player and parses it, so it starts at once'''
+        clip = self.pool.choose()
+        if clip is None:
+            self.preloaded = None
+            return
+        media = self.mp_clips.get_instance().media_new(clip[1])
+        media.parse_with_options(vlc.MediaParseFlag.local, int(self.clip_timing['preroll_seconds'] * 1000))
+        self.mp_clips.set_media(media)
+        self.volume.set_volume('clips', 100)
+        self.preloaded = (clip[1], media, self.pool.duration(clip[0]))
 
-        random_clip = choice(clips)
-        self.last_played_clip = random_clip
+    def play_clip(self):
+        # 0. The clip preloaded before the duck, or the pool's next one
+        if self.preloaded is None:
+            self.preload_clip()
+        if self.preloaded is None:
+            if Debug:
+                eprint('Clips: no clips to play in ' + self.clips_dir + ' at this hour')
+            return
+        self.last_played_clip, media, duration = self.preloaded
+        self.preloaded = None
 
         # 1. Lower main players volume
-        fade_volume_players(
-            [self.mp_music.get_media_player(), self.mp_ambience.get_media_player()],
-            [65, 45]
-        )
+        # The ramps are clock driven, so the clip starts as they end
+        duck_end = time() + self.clip_timing['duck_seconds']
+        self.volume.fade_all(self.duck_volumes, duration=self.clip_timing['duck_seconds'])
+        with self.condition:
+            while not self.exit_program and time() < duck_end:
+                self.condition.wait(duck_end - time())
+            if self.exit_program:
+                media.release()
+                return
 
         # 2. Play voiceclip
-        # Wait for it to finish
-        clip = self.mp_clips.get_instance().media_new(os.path.join(self.clips_dir, random_clip))
-        self.mp_clips.set_media(clip)
-        self.mp_clips.audio_set_volume(100)
+        # Wait for its end (or error) event, which starts the restore fade
+        self.clip_ended.clear()
         self.mp_clips.play()
+        if Debug:
+            print('Clip: ' + self.last_played_clip + (f' ({duration:.1f}s)' if duration else ''))
+        # a missed event costs a second past the clip's duration, or a check a minute
+        timeout = duration + 1 if duration else 60
+        while not self.clip_ended.wait(timeout) and self.mp_clips.is_playing():
+            timeout = 60
 
-        sleep(0.5)
-        while self.mp_clips.is_playing():
-            sleep(0.5)
-
-        # 3. Return main players volume
-        fade_volume_players(
-            [self.mp_music.get_media_player(), self.mp_ambience.get_media_player()],
-            [100, 75]
-        )
-        self.clip_schedule = None
-        self.clip_playing = False
+        # 3. Return main players volume, if the event did not
+        if not self.clip_ended.is_set():
+            self.volume.fade_all(self.restore_volumes, duration=self.clip_timing['duck_seconds'])
+        media.release()
 
     def run(self):
         while True:
-            if self.exit_program:
-                return
-            elif self.clips_on:
-                if not self.clip_schedule:
-                    self.schedule_clip()
-                elif datetime.datetime.today() > self.clip_schedule:
-                    self.play_clip()
-            elif self.clip_schedule:
-                self.clip_schedule = None
-            sleep(1)
+            with self.condition:
+                while not self.exit_program and (not self.timers or self.timers[0][0] > time()):
+                    self.condition.wait(self.timers[0][0] - time() if self.timers else None)
+                if self.exit_program:
+                    return
+                action = heapq.heappop(self.timers)[2]
+                if action == 'play_clip':
+                    self.clip_schedule = None
+                    self.clip_playing = True
+                    self.idle.clear()
+
+            try:
+                getattr(self, action)()
+            except Exception as e:
+                if Debug:
+                    eprint(f'Clips: {action} failed: {e}')
+            finally:
+                if action == 'play_clip':
+                    with self.condition:
+                        self.clip_playing = False
+                        self.idle.set()
+                        if self.clips_on and not self.clip_schedule:
+                            self.schedule_clip()
@@ -0,0 +1,162 @@
+######################################################################
+#
+#   Stream Relay
+#
+#   1. Defines StreamRelay class
+#       Serves the audio stream to listeners on the stream port
+#       Each listener is relayed from VLC's http output on a loopback port
+#       Counts listeners, bytes sent and how long each has listened
+#       Refuses listeners over max_listeners with 503
+#
+######################################################################
+import asyncio
+from itertools import count
+from threading import Thread
+from time import time
+
+
+######################################################################
+#
+#   1. Defines StreamRelay class
+#
+######################################################################
+class StreamRelay:
+    '''Relays the mounts of VLC's http output on 127.0.0.1:upstream_port to
+    listeners on interface:port, from an asyncio loop in a daemon thread.
+    Every listener has its own upstream connection, so VLC still sends new
+    listeners the stream headers (e.g. Ogg's) they need.
+    A listener's slot is taken before its upstream connection is opened, so
+    listeners connecting together cannot pass max_listeners. HEAD requests are
+    answered by the relay and do not count as listeners.
+    mounts is {mount: Content-Type}. Listeners are not identified, snapshot() is public'''
+    def __init__(self, interface, port, upstream_port, mounts, max_listeners=100, header_timeout=10):
+        self.interface = interface
+        self.port = port
+        self.upstream_port = upstream_port
+        self.mounts = dict(mounts)
+        self.max_listeners = max_listeners
+        self.header_timeout = header_timeout
+        self.listeners = {}     # id: {mount, connected (time()), bytes}
+        self.ids = count(1)
+        self.stats = {'bytes_sent':0, 'listeners_total':0, 'peak':0, 'rejected':0, 'upstream_errors':0}
+        self.loop = None
+        t = Thread(target=self.start_loop, name='stream relay')
+        t.daemon = True
+        t.start()
+
+    def snapshot(self):
+        '''Returns the listener counts, bytes sent and each listener's mount, seconds and bytes'''
+        now = time()
+        listeners = [dict(listener) for listener in list(self.listeners.values())]
+        mounts = {mount:0 for mount in self.mounts}
+        for listener in listeners:
+            mounts[listener['mount']] += 1
+        return dict(
+            self.stats,
+            listeners=len(listeners),
+            max_listeners=self.max_listeners,
+            bytes_sent=self.stats['bytes_sent'] + sum(listener['bytes'] for listener in listeners),
+            mounts=mounts,
+            connections=[
+                {
+                    'mount'  :listener['mount'],
+                    'seconds':round(now - listener['connected'], 1),
+                    'bytes'  :listener['bytes']
+                }
+                for listener in listeners
+            ]
+        )
+
+    async def respond(self, writer, status, body='', content_type='text/plain'):
+        writer.write(('HTTP/1.0 ' + status + '\r\nContent-Type: ' + content_type + '\r\nConnection: close\r\n'
+                      + ('Retry-After: 30\r\n' if status.startswith('503') else '')
+                      + '\r\n' + body).encode())
+        await writer.drain()
+
+    async def handler(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.header_timeout)
+                method, path = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')[:2]
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                return
+            mount = path.split('?', 1)[0]
+            if mount not in self.mounts:
+                await self.respond(writer, '404 Not Found', 'no stream at ' + mount + '\n')
+                return
+            if method == 'HEAD':
+                await self.respond(writer, '200 OK', content_type=self.mounts[mount])
+                return
+            if method != 'GET':
+                await self.respond(writer, '405 Method Not Allowed', 'streams are GET only\n')
+                return
+            if len(self.listeners) >= self.max_listeners:
+                self.stats['rejected'] += 1
+                await self.respond(writer, '503 Service Unavailable', 'too many listeners\n')
+                return
+
+            # take the slot before the next await, so the check above stays true
+            listener_id = next(self.ids)
+            listener = {'mount':mount, 'connected':time(), 'bytes':0}
+            self.listeners[listener_id] = listener
+            self.stats['listeners_total'] += 1
+            self.stats['peak'] = max(self.stats['peak'], len(self.listeners))
+            try:
+                try:
+                    upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', self.upstream_port)
+                except OSError:
+                    self.stats['upstream_errors'] += 1
+                    await self.respond(writer, '502 Bad Gateway', 'stream not started\n')
+                    return
+                await self.relay(head, listener, reader, writer, upstream_reader, upstream_writer)
+            finally:
+                del self.listeners[listener_id]
+                self.stats['bytes_sent'] += listener['bytes']
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def relay(self, head, listener, reader, writer, upstream_reader, upstream_writer):
+        '''Sends the listener's request upstream and copies the stream back until either side closes'''
+        try:
+            upstream_writer.write(head)
+            await upstream_writer.drain()
+            copy = asyncio.create_task(self.copy(upstream_reader, writer, listener))
+            hung_up = asyncio.create_task(self.wait_hang_up(reader))
+            await asyncio.wait([copy, hung_up], return_when=asyncio.FIRST_COMPLETED)
+            copy.cancel()
+            hung_up.cancel()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            upstream_writer.close()
+
+    async def copy(self, upstream_reader, writer, listener):
+        '''Copies the stream to the listener, at whatever pace it reads it'''
+        while True:
+            chunk = await upstream_reader.read(65536)
+            if not chunk:
+                return
+            writer.write(chunk)
+            await writer.drain()
+            listener['bytes'] += len(chunk)
+
+    async def wait_hang_up(self, reader):
+        '''Returns when the listener hangs up: it sends nothing after its request'''
+        while await reader.read(1024):
+            pass
+
+    def start_loop(self):
+        async def run_server():
+            self.loop = asyncio.get_running_loop()
+            server = await asyncio.start_server(self.handler, self.interface, self.port)
+            async with server:
+                await server.serve_forever()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(run_server())
+        finally:
+            loop.close()
@@ -0,0 +1,157 @@
+######################################################################
+#
+#   Volume Scheduler
+#
+#   1. Defines ramp curves
+#   2. Defines Ramp class
+#       A fade of one player from a volume to another over a duration
+#   3. Defines VolumeScheduler Thread
+#       Owns the volume of every registered player
+#       Fades are non-blocking commands, returning an Event set when done
+#       A new fade of a player replaces its ramp, starting from where it was
+#       Ramps are computed from the clock each tick, so they never drift
+#
+######################################################################
+import math
+from threading import Thread, Condition, Event
+from time import monotonic
+
+
+######################################################################
+#
+#   1. Defines ramp curves
+#       Map progress (0-1) through a ramp to progress of the volume change
+#
+######################################################################
+def linear(progress):
+    return progress
+
+def log(progress):
+    '''Most of the change early, like a fader moved on a decibel scale'''
+    return math.log10(1 + 9 * progress)
+
+curves = {'linear':linear, 'log':log}
+
+
+######################################################################
+#
+#   2. Defines Ramp class
+#
+######################################################################
+class Ramp:
+    '''A fade from start_volume to target over duration seconds from start'''
+    def __init__(self, start, duration, start_volume, target, curve):
+        self.start = start
+        self.duration = duration
+        self.start_volume = start_volume
+        self.target = target
+        self.curve = curves[curve]
+        self.done = Event()
+
+    def volume(self, now):
+        '''Returns (volume, finished) at time now'''
+        if self.duration <= 0 or now >= self.start + self.duration:
+            return self.target, True
+        progress = max(0.0, (now - self.start) / self.duration)
+        return self.start_volume + (self.target - self.start_volume) * self.curve(progress), False
+
+
+######################################################################
+#
+#   3. Defines VolumeScheduler Thread
+#
+######################################################################
+class VolumeScheduler(Thread):
+    '''Fades the volume of players (anything with audio_get_volume and
+    audio_set_volume, e.g. vlc.MediaPlayer) from one thread, tick_rate
+    times a second while any ramp is running.
+    clock is injectable so ramps can be checked without waiting: call
+    tick(now) directly instead of start()ing the thread'''
+    def __init__(self, tick_rate=50, clock=monotonic):
+        super(VolumeScheduler, self).__init__(daemon=True, name='volume')
+        self.tick_rate = tick_rate
+        self.clock = clock
+        self.condition = Condition()
+        self.players = {}   # name: player
+        self.ramps = {}     # name: running Ramp
+        self.volumes = {}   # name: volume last set, so unchanged volumes are not set again
+        self.exit_program = False
+
+    def register(self, name, player):
+        with self.condition:
+            self.players[name] = player
+            self.volumes[name] = player.audio_get_volume()
+
+    def current_volume(self, name, now=None):
+        '''The volume of a player, where its ramp is at now'''
+        with self.condition:
+            ramp = self.ramps.get(name)
+            if ramp is None:
+                return self.volumes[name]
+            return round(ramp.volume(self.clock() if now is None else now)[0])
+
+    def fade(self, name, target, duration=2, curve='linear'):
+        '''Fades a player to target over duration seconds. Returns an Event set
+        when the fade ends or is cancelled. A running ramp of the player is
+        replaced, the new one starting from the volume it had reached'''
+        with self.condition:
+            now = self.clock()
+            start_volume = self.current_volume(name, now)
+            self.cancel_locked(name)
+            ramp = Ramp(now, duration, start_volume, target, curve)
+            self.ramps[name] = ramp
+            self.condition.notify()
+            return ramp.done
+
+    def fade_all(self, targets, duration=2, curve='linear'):
+        '''Fades several players, {name: target}. Returns their Events'''
+        return [self.fade(name, target, duration=duration, curve=curve) for name, target in targets.items()]
+
+    def set_volume(self, name, volume):
+        '''Cancels any ramp of the player and sets its volume now'''
+        with self.condition:
+            self.cancel_locked(name)
+            self.apply(name, volume)
+
+    def cancel(self, name):
+        '''Stops a player's ramp where it is'''
+        with self.condition:
+            if name in self.ramps:
+                self.apply(name, self.current_volume(name))
+            self.cancel_locked(name)
+
+    def cancel_locked(self, name):
+        ramp = self.ramps.pop(name, None)
+        if ramp is not None:
+            ramp.done.set()
+
+    def apply(self, name, volume):
+        volume = int(round(volume))
+        if self.volumes.get(name) != volume:
+            self.players[name].audio_set_volume(volume)
+            self.volumes[name] = volume
+
+    def tick(self, now=None):
+        '''Sets the volume of every ramping player for time now'''
+        with self.condition:
+            now = self.clock() if now is None else now
+            for name, ramp in list(self.ramps.items()):
+                volume, finished = ramp.volume(now)
+                self.apply(name, volume)
+                if finished:
+                    del self.ramps[name]
+                    ramp.done.set()
+
+    def stop(self):
+        with self.condition:
+            self.exit_program = True
+            self.condition.notify()
+
+    def run(self):
+        with self.condition:
+            while not self.exit_program:
+                if self.ramps:
+                    self.tick()
+                    self.condition.wait(1 / self.tick_rate)
+                else:
+                    self.condition.wait()
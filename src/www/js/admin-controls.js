@@ -124,39 +124,44 @@ export class AdminControls {
     // Check music status
     fetch('./api/music/currenttrack')
       .then(response => response.json())
-      .then(json => {
-        const musicBtn = document.getElementById('music-toggle-btn')
-        const svg = musicBtn.querySelector('svg')
-        if (json.data.is_playing) {
-          // Music note in full green (playing)
-          svg.innerHTML = '<path d="M12 3v10.55c-.59-.34-1.27-.55-2-.55-2.21 0-4 1.79-4 4s1.79 4 4 4 4-1.79 4-4V7h4V3h-6z" fill="#a0ff50"/>'
-          musicBtn.classList.add('state-on')
-        } else {
-          // Music note plain (stopped) - shows you can click to turn ON
-          svg.innerHTML = '<path d="M12 3v10.55c-.59-.34-1.27-.55-2-.55-2.21 0-4 1.79-4 4s1.79 4 4 4 4-1.79 4-4V7h4V3h-6z"/>'
-          musicBtn.classList.remove('state-on')
-        }
-      })
+      .then(json => this.setToggleButtonState('music', json.data.is_playing))
       .catch(err => console.log('Could not check music status'))
     
     // Check ambience status
     fetch('./api/ambience/currenttrack')
       .then(response => response.json())
-      .then(json => {
-        const ambienceBtn = document.getElementById('ambience-toggle-btn')
-        const svg = ambienceBtn.querySelector('svg')
-        if (json.data.is_playing) {
-          // Storm cloud in full green (playing)
-          svg.innerHTML = '<path d="M19.35 10.04C18.67 6.59 15.64 4 12 4c-1.48 0-2.85.43-4.01 1.17C6.65 5.7 5.31 6.96 4.56 8.58 2.61 9.08 1 10.88 1 13c0 2.76 2.24 5 5 5h13c2.21 0 4-1.79 4-4 0-2.05-1.54-3.73-3.54-3.96-.03-.32-.07-.64-.11-.96z" fill="#a0ff50"/><line x1="8" y1="18" x2="8" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="12" y1="18" x2="12" y2="22" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="16" y1="18" x2="16" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/>'
-          ambienceBtn.classList.add('state-on')
-        } else {
-          // Storm cloud plain with green rain (stopped) - shows you can click to turn ON
-          svg.innerHTML = '<path d="M19.35 10.04C18.67 6.59 15.64 4 12 4c-1.48 0-2.85.43-4.01 1.17C6.65 5.7 5.31 6.96 4.56 8.58 2.61 9.08 1 10.88 1 13c0 2.76 2.24 5 5 5h13c2.21 0 4-1.79 4-4 0-2.05-1.54-3.73-3.54-3.96-.03-.32-.07-.64-.11-.96z" fill="currentColor"/><line x1="8" y1="18" x2="8" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="12" y1="18" x2="12" y2="22" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="16" y1="18" x2="16" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/>'
-          ambienceBtn.classList.remove('state-on')
-        }
-      })
+      .then(json => this.setToggleButtonState('ambience', json.data.is_playing))
       .catch(err => console.log('Could not check ambience status'))
   }
+
+  // Set a toggle button icon, from the API or a websocket message
+  setToggleButtonState(player, isPlaying) {
+    if (player === 'music') {
+      const musicBtn = document.getElementById('music-toggle-btn')
+      const svg = musicBtn.querySelector('svg')
+      if (isPlaying) {
+        // Music note in full green (playing)
+        svg.innerHTML = '<path d="M12 3v10.55c-.59-.34-1.27-.55-2-.55-2.21 0-4 1.79-4 4s1.79 4 4 4 4-1.79 4-4V7h4V3h-6z" fill="#a0ff50"/>'
+        musicBtn.classList.add('state-on')
+      } else {
+        // Music note plain (stopped) - shows you can click to turn ON
+        svg.innerHTML = '<path d="M12 3v10.55c-.59-.34-1.27-.55-2-.55-2.21 0-4 1.79-4 4s1.79 4 4 4 4-1.79 4-4V7h4V3h-6z"/>'
+        musicBtn.classList.remove('state-on')
+      }
+    } else {
+      const ambienceBtn = document.getElementById('ambience-toggle-btn')
+      const svg = ambienceBtn.querySelector('svg')
+      if (isPlaying) {
+        // Storm cloud in full green (playing)
+        svg.innerHTML = '<path d="M19.35 10.04C18.67 6.59 15.64 4 12 4c-1.48 0-2.85.43-4.01 1.17C6.65 5.7 5.31 6.96 4.56 8.58 2.61 9.08 1 10.88 1 13c0 2.76 2.24 5 5 5h13c2.21 0 4-1.79 4-4 0-2.05-1.54-3.73-3.54-3.96-.03-.32-.07-.64-.11-.96z" fill="#a0ff50"/><line x1="8" y1="18" x2="8" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="12" y1="18" x2="12" y2="22" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="16" y1="18" x2="16" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/>'
+        ambienceBtn.classList.add('state-on')
+      } else {
+        // Storm cloud plain with green rain (stopped) - shows you can click to turn ON
+        svg.innerHTML = '<path d="M19.35 10.04C18.67 6.59 15.64 4 12 4c-1.48 0-2.85.43-4.01 1.17C6.65 5.7 5.31 6.96 4.56 8.58 2.61 9.08 1 10.88 1 13c0 2.76 2.24 5 5 5h13c2.21 0 4-1.79 4-4 0-2.05-1.54-3.73-3.54-3.96-.03-.32-.07-.64-.11-.96z" fill="currentColor"/><line x1="8" y1="18" x2="8" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="12" y1="18" x2="12" y2="22" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/><line x1="16" y1="18" x2="16" y2="21" stroke="#a0ff50" stroke-width="1.5" stroke-linecap="round"/>'
+        ambienceBtn.classList.remove('state-on')
+      }
+    }
+  }
   
   // Show password modal
   showPasswordModal() {
@@ -214,18 +219,7 @@ export class AdminControls {
         // Don't show toast notifications for admin actions
         // The visual feedback is immediate via the player state changes
         
-        // Update toggle button states after toggle actions
-        if (endpoint.includes('/toggle')) {
-          setTimeout(() => this.updateToggleButtonStates(), 500)
-          // Also update the current track/ambience labels
-          setTimeout(() => this.trackManager.updateCurrentTrack(), 500)
-          setTimeout(() => this.trackManager.updateCurrentAmbience(), 500)
-        }
-        
-        // Update after skip
-        if (endpoint.includes('/skip')) {
-          setTimeout(() => this.trackManager.updateCurrentTrack(), 500)
-        }
+        // Toggle button states and track labels are updated by websocket messages
       })
       .catch(err => {
         // Only show errors
@@ -28,25 +28,41 @@ import { checkAndApplyTicker } from './utils.js'
   // Setup click-to-copy for spectrum labels
   trackManager.setupClickToCopy()
   
-  // Initial updates
-  trackManager.updateCurrentTrack()
-  trackManager.updateCurrentAmbience()
-  trackManager.buildPlaylist()
+  // Initial updates from the REST API, in case the websocket is slow or refused.
+  // The snapshot the websocket server sends on connect replaces them
+  const updateFromApi = () => {
+    trackManager.updateCurrentTrack()
+    trackManager.updateCurrentAmbience()
+    trackManager.buildPlaylist()
+  }
+  updateFromApi()
   
   // Draw initial idle spectrum
   visualizer.drawSpectrum()
   
-  // Connect WebSocket with callbacks
+  // Connect WebSocket with callbacks (the server sends a snapshot on connect)
   connectWebSocket({
-    onMusicChanged: () => {
-      trackManager.updateCurrentTrack()
-      trackManager.buildPlaylist()
+    onSnapshot: () => {
+      trackManager.live = true
     },
-    onAmbienceChanged: () => {
-      trackManager.updateCurrentAmbience()
+    onClose: () => {
+      // Updates stop until a reconnect's snapshot, so show the API's state meanwhile
+      if (trackManager.live) {
+        trackManager.live = false
+        updateFromApi()
+      }
+    },
+    onMusicChanged: (state) => {
+      trackManager.showCurrentTrack(state)
+    },
+    onAmbienceChanged: (state) => {
+      trackManager.showCurrentAmbience(state)
+    },
+    onHistory: (tracks, replace) => {
+      trackManager.addHistory(tracks, replace)
     },
-    onUpdateToggleStates: () => {
-      adminControls.updateToggleButtonStates()
+    onUpdateToggleStates: (player, isPlaying) => {
+      adminControls.setToggleButtonState(player, isPlaying)
     }
   })
   
@@ -6,92 +6,124 @@ export class TrackManager {
   constructor() {
     this.spectrumSongLabel = document.getElementById('spectrum-song-label')
     this.spectrumAmbienceLabel = document.getElementById('spectrum-ambience-label')
+    this.history = []
+    // Set once a websocket snapshot is shown, so slower REST responses do not overwrite it
+    this.live = false
   }
   
   updateCurrentTrack() {
     fetch('./api/music/currenttrack')
       .then(response => response.json())
-      .then(json => {
-        if (json.data.is_playing) {
-          // Remove ticker class first to reset animation
-          this.spectrumSongLabel.classList.remove('ticker')
-          const songText = '♫ ' + json.msg
-          this.spectrumSongLabel.innerHTML = '<span class="label-text">' + songText + '</span>'
-          this.spectrumSongLabel.dataset.fullText = json.msg
-          checkAndApplyTicker(this.spectrumSongLabel)
-          
-          // Update page title and metadata with currently playing track
-          document.title = 'Morph Ovum - ' + json.msg
-          updateMetadata(json.msg)
-        } else {
-          // Show "Music is paused" when not playing
-          this.spectrumSongLabel.classList.remove('ticker')
-          this.spectrumSongLabel.innerHTML = '<span class="label-text">♫ Music is paused</span>'
-          this.spectrumSongLabel.dataset.fullText = 'Music is paused'
-          
-          // Reset page title and metadata when nothing is playing
-          document.title = 'Morph Ovum'
-          updateMetadata(null)
-        }
-      })
+      .then(json => { if (!this.live) this.showCurrentTrack(json.data) })
+  }
+
+  // Show a music player state, as sent by the API or websocket
+  showCurrentTrack(state) {
+    if (state.is_playing) {
+      // Remove ticker class first to reset animation
+      this.spectrumSongLabel.classList.remove('ticker')
+      const songText = '♫ ' + state.track
+      this.spectrumSongLabel.innerHTML = '<span class="label-text">' + songText + '</span>'
+      this.spectrumSongLabel.dataset.fullText = state.track
+      checkAndApplyTicker(this.spectrumSongLabel)
+      
+      // Update page title and metadata with currently playing track
+      document.title = 'Morph Ovum - ' + state.track
+      updateMetadata(state.track)
+    } else {
+      // Show "Music is paused" when not playing
+      this.spectrumSongLabel.classList.remove('ticker')
+      this.spectrumSongLabel.innerHTML = '<span class="label-text">♫ Music is paused</span>'
+      this.spectrumSongLabel.dataset.fullText = 'Music is paused'
+      
+      // Reset page title and metadata when nothing is playing
+      document.title = 'Morph Ovum'
+      updateMetadata(null)
+    }
   }
 
   updateCurrentAmbience() {
     fetch('./api/ambience/currenttrack')
       .then(response => response.json())
-      .then(json => {
-        if (json.data.is_playing) {
-          // Remove ticker class first to reset animation
-          this.spectrumAmbienceLabel.classList.remove('ticker')
-          const ambienceText = '☮ ' + json.msg
-          this.spectrumAmbienceLabel.innerHTML = '<span class="label-text">' + ambienceText + '</span>'
-          this.spectrumAmbienceLabel.dataset.fullText = json.msg
-          checkAndApplyTicker(this.spectrumAmbienceLabel)
+      .then(json => { if (!this.live) this.showCurrentAmbience(json.data) })
+  }
+
+  // Show an ambience player state, as sent by the API or websocket
+  showCurrentAmbience(state) {
+    if (state.is_playing) {
+      // Remove ticker class first to reset animation
+      this.spectrumAmbienceLabel.classList.remove('ticker')
+      const ambienceText = '☮ ' + state.track
+      this.spectrumAmbienceLabel.innerHTML = '<span class="label-text">' + ambienceText + '</span>'
+      this.spectrumAmbienceLabel.dataset.fullText = state.track
+      checkAndApplyTicker(this.spectrumAmbienceLabel)
+    } else {
+      // Show "Ambience is paused" when not playing
+      this.spectrumAmbienceLabel.classList.remove('ticker')
+      this.spectrumAmbienceLabel.innerHTML = '<span class="label-text">☮ Ambience is paused</span>'
+      this.spectrumAmbienceLabel.dataset.fullText = 'Ambience is paused'
+    }
+  }
+
+  // Add history entries ({time, id, track, played}) to the music history (or replace it) and rebuild the track list
+  // An entry with the time and id of one already held updates it, e.g. its played seconds once it has finished
+  addHistory(entries, replace) {
+    if (replace) {
+      this.history = entries.slice()
+    } else {
+      entries.forEach(entry => {
+        const index = this.history.findIndex(held => held.time === entry.time && held.id === entry.id)
+        if (index === -1) {
+          this.history.push(entry)
         } else {
-          // Show "Ambience is paused" when not playing
-          this.spectrumAmbienceLabel.classList.remove('ticker')
-          this.spectrumAmbienceLabel.innerHTML = '<span class="label-text">☮ Ambience is paused</span>'
-          this.spectrumAmbienceLabel.dataset.fullText = 'Ambience is paused'
+          this.history[index] = entry
         }
       })
+      this.history = this.history.slice(-101)
+    }
+    this.renderHistory()
   }
   
   buildPlaylist() {
     fetch('./api/music/history')
       .then(response => response.json())
-      .then(json => {
-        const listItems = json.data.reverse().slice(1).map(track => {
-          const li = document.createElement('li')
-          li.className = 'track-list__track'
-          
-          const trackText = document.createElement('span')
-          trackText.className = 'track-text'
-          trackText.textContent = track
-          
-          const copyIcon = document.createElement('span')
-          copyIcon.className = 'track-copy-icon'
-          copyIcon.innerHTML = '📋'
-          copyIcon.setAttribute('aria-label', 'Copy')
-          
-          li.appendChild(trackText)
-          li.appendChild(copyIcon)
-          
-          // Click to copy functionality
-          li.addEventListener('click', function() {
-            copyToClipboard(track, li)
-          })
-          
-          return li
-        })
-        const trackList = document.querySelector('.track-list')
-        trackList.innerHTML = ''
-
-        const trackListEnding = trackList.querySelector('br')
+      .then(json => { if (!this.live) this.addHistory(json.data.history, true) })
+  }
 
-        listItems.forEach(li => {
-          trackList.insertBefore(li, trackListEnding)
-        })
+  renderHistory() {
+    const listItems = this.history.slice().reverse().slice(1).map(entry => {
+      const track = entry.track
+      const li = document.createElement('li')
+      li.className = 'track-list__track'
+      li.title = 'Played at ' + entry.time
+      
+      const trackText = document.createElement('span')
+      trackText.className = 'track-text'
+      trackText.textContent = track
+      
+      const copyIcon = document.createElement('span')
+      copyIcon.className = 'track-copy-icon'
+      copyIcon.innerHTML = '📋'
+      copyIcon.setAttribute('aria-label', 'Copy')
+      
+      li.appendChild(trackText)
+      li.appendChild(copyIcon)
+      
+      // Click to copy functionality
+      li.addEventListener('click', function() {
+        copyToClipboard(track, li)
       })
+      
+      return li
+    })
+    const trackList = document.querySelector('.track-list')
+    trackList.innerHTML = ''
+
+    const trackListEnding = trackList.querySelector('br')
+
+    listItems.forEach(li => {
+      trackList.insertBefore(li, trackListEnding)
+    })
   }
   
   // Setup click-to-copy for spectrum labels
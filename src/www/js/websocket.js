@@ -11,22 +11,36 @@ export function connectWebSocket(callbacks) {
 
   const ws = new WebSocket(new_uri)
 
+  // Messages carry the player state, so no REST requests are needed on changes
   ws.addEventListener('message', (event) => {
-    switch (event.data) {
-      case 'music_changed':
-      case 'music_paused':
-        if (callbacks.onMusicChanged) callbacks.onMusicChanged()
-        if (callbacks.onUpdateToggleStates) callbacks.onUpdateToggleStates()
+    const message = JSON.parse(event.data)
+    switch (message.event) {
+      case 'snapshot':
+        if (callbacks.onSnapshot) callbacks.onSnapshot()
+        if (callbacks.onMusicChanged) callbacks.onMusicChanged(message.music)
+        if (callbacks.onAmbienceChanged) callbacks.onAmbienceChanged(message.ambience)
+        if (callbacks.onHistory) callbacks.onHistory(message.music.history, true)
+        if (callbacks.onUpdateToggleStates) {
+          callbacks.onUpdateToggleStates('music', message.music.is_playing)
+          callbacks.onUpdateToggleStates('ambience', message.ambience.is_playing)
+        }
         return
-      case 'ambience_changed':
-      case 'ambience_paused':
-        if (callbacks.onAmbienceChanged) callbacks.onAmbienceChanged()
-        if (callbacks.onUpdateToggleStates) callbacks.onUpdateToggleStates()
+      case 'changed':
+      case 'playing':
+      case 'paused':
+        if (message.player === 'music') {
+          if (callbacks.onMusicChanged) callbacks.onMusicChanged(message)
+          if (callbacks.onHistory) callbacks.onHistory(message.history, false)
+        } else if (callbacks.onAmbienceChanged) {
+          callbacks.onAmbienceChanged(message)
+        }
+        if (callbacks.onUpdateToggleStates) callbacks.onUpdateToggleStates(message.player, message.is_playing)
         return
     }
   })
   
   ws.addEventListener("close", () => {
+    if (callbacks.onClose) callbacks.onClose()
     connectWebSocket(callbacks); // Attempt to reconnect after connection closure
   });
 